@@ -1,19 +1,29 @@
 import dataclasses
-import io
 import json
 import logging
 import mimetypes
 import os
+import stat
+import tempfile
+import unicodedata
+from array import array
+from datetime import datetime
+from functools import partial
 from pathlib import Path
-from typing import AsyncGenerator, cast
+from typing import Any, AsyncGenerator, AsyncIterator, Hashable, Optional, Union, cast
 
-from azure.core.exceptions import ResourceNotFoundError
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceModifiedError, ResourceNotFoundError
 from azure.identity.aio import DefaultAzureCredential, get_bearer_token_provider
 from azure.keyvault.secrets.aio import SecretClient
 from azure.monitor.opentelemetry import configure_azure_monitor
 from azure.search.documents.aio import SearchClient
 from azure.search.documents.indexes.aio import SearchIndexClient
-from azure.storage.blob.aio import BlobServiceClient
+from azure.storage.blob.aio import (
+    BlobClient,
+    BlobServiceClient,
+    StorageStreamDownloader,
+)
 from openai import APIError, AsyncAzureOpenAI, AsyncOpenAI
 from opentelemetry.instrumentation.aiohttp_client import AioHttpClientInstrumentor
 from opentelemetry.instrumentation.asgi import OpenTelemetryMiddleware
@@ -21,22 +31,39 @@ from opentelemetry.instrumentation.httpx import HTTPXClientInstrumentor
 from quart import (
     Blueprint,
     Quart,
+    Response,
     abort,
     current_app,
     jsonify,
     make_response,
     request,
-    send_file,
     send_from_directory,
 )
 from quart_cors import cors
+from werkzeug.http import http_date, unquote_etag
 
-from approaches.approach import Approach
+from approaches.approach import Approach, Document
 from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
 from approaches.chatreadretrievereadvision import ChatReadRetrieveReadVisionApproach
 from approaches.retrievethenread import RetrieveThenReadApproach
 from approaches.retrievethenreadvision import RetrieveThenReadVisionApproach
 from core.authentication import AuthenticationHelper
+from core.cache import LRUCache
+from core.contentcache import ContentCache
+from core.conversationstore import (
+    Conversation,
+    ConversationStore,
+    MemoryConversationStore,
+    RedisConversationStore,
+    SQLiteConversationStore,
+)
+from core.historysummarizer import HistorySummarizer
+from core.httpsessions import HTTPSessionRegistry
+from core.jsonprovider import OrjsonProvider, dataclass_to_dict
+from core.searchcache import SearchCache
+from core.singleflight import RequestCoalescer
+from core.streaming import ChunkCoalescer
+from core.thoughtstore import ThoughtStore
 
 CONFIG_OPENAI_TOKEN = "openai_token"
 CONFIG_CREDENTIAL = "azure_credential"
@@ -49,6 +76,18 @@ CONFIG_AUTH_CLIENT = "auth_client"
 CONFIG_GPT4V_DEPLOYED = "gpt4v_deployed"
 CONFIG_SEARCH_CLIENT = "search_client"
 CONFIG_OPENAI_CLIENT = "openai_client"
+CONFIG_CONTENT_CACHE = "content_cache"
+CONFIG_REQUEST_COALESCER = "request_coalescer"
+CONFIG_SEARCH_CACHE = "search_cache"
+CONFIG_HTTP_SESSIONS = "http_sessions"
+CONFIG_CHUNK_COALESCER = "chunk_coalescer"
+CONFIG_THOUGHT_STORE = "thought_store"
+CONFIG_LEAN_THOUGHTS = "lean_thoughts"
+CONFIG_CONVERSATION_STORE = "conversation_store"
+CONFIG_HISTORY_SUMMARIZER = "history_summarizer"
+# Container metadata bumped by prepdocs after each ingestion run, see BlobManager.bump_search_generation
+SEARCH_GENERATION_METADATA = "search_generation"
+CONTENT_CHUNK_SIZE = 4 * 1024 * 1024
 ERROR_MESSAGE = """The app encountered an error processing your request.
 If you are an administrator of the app, view the full error in the logs. See aka.ms/appservice-logs for more information.
 Error type: {error_type}
@@ -85,29 +124,110 @@ async def assets(path):
 
 # Serve content files from blob storage from within the app to keep the example self-contained.
 # *** NOTE *** this assumes that the content files are public, or at least that all users of the app
-# can access all the files. This is also slow and memory hungry.
+# can access all the files.
+# The blob is streamed chunk by chunk rather than buffered, and byte ranges and ETag revalidation
+# are supported so that the browser PDF viewer only fetches what it needs.
 @bp.route("/content/<path>")
 async def content_file(path: str):
     # Remove page number from path, filename-1.txt -> filename.txt
     if path.find("#page=") > 0:
         path_parts = path.rsplit("#page=", 1)
         path = path_parts[0]
-    logging.info("Opening file %s at page %s", path)
+    logging.info("Opening file %s", path)
     blob_container_client = current_app.config[CONFIG_BLOB_CONTAINER_CLIENT]
+    blob_client = blob_container_client.get_blob_client(path)
     try:
-        blob = await blob_container_client.get_blob_client(path).download_blob()
+        blob_properties = await blob_client.get_blob_properties()
     except ResourceNotFoundError:
         logging.exception("Path not found: %s", path)
         abort(404)
-    if not blob.properties or not blob.properties.has_key("content_settings"):
+    if not blob_properties or not blob_properties.content_settings:
         abort(404)
-    mime_type = blob.properties["content_settings"]["content_type"]
+    mime_type = blob_properties.content_settings.content_type or "application/octet-stream"
     if mime_type == "application/octet-stream":
         mime_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
-    blob_file = io.BytesIO()
-    await blob.readinto(blob_file)
-    blob_file.seek(0)
-    return await send_file(blob_file, mimetype=mime_type, as_attachment=False, attachment_filename=path)
+
+    headers = {"Accept-Ranges": "bytes", "Cache-Control": "no-cache"}
+    etag = blob_properties.etag
+    if etag:
+        headers["ETag"] = etag
+    if blob_properties.last_modified:
+        headers["Last-Modified"] = http_date(blob_properties.last_modified)
+
+    # Answer revalidation requests without downloading anything
+    if etag and request.if_none_match and request.if_none_match.contains_weak(unquote_etag(etag)[0] or ""):
+        return Response("", status=304, headers=headers)
+
+    size = blob_properties.size or 0
+    status = 200
+    offset, length = 0, size
+    byte_range = get_requested_range(size, etag, blob_properties.last_modified)
+    if byte_range is False:
+        return Response("", status=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+    elif isinstance(byte_range, tuple):
+        status = 206
+        offset, length = byte_range[0], byte_range[1] - byte_range[0]
+        headers["Content-Range"] = f"bytes {byte_range[0]}-{byte_range[1] - 1}/{size}"
+    headers["Content-Length"] = str(length)
+    if length == 0:
+        return Response(b"", status=status, headers=headers, mimetype=mime_type)
+
+    content_cache: ContentCache = current_app.config[CONFIG_CONTENT_CACHE]
+    cached_content = content_cache.get(path, etag) if etag else None
+    if cached_content:
+        body = cached_content.iter_range(offset, length, CONTENT_CHUNK_SIZE)
+    else:
+        try:
+            # Pin the download to the version whose ETag we are advertising, so ranges are never mixed across uploads
+            blob = await blob_client.download_blob(
+                offset=offset, length=length, etag=etag, match_condition=MatchConditions.IfNotModified
+            )
+        except ResourceModifiedError:
+            abort(412)
+        if etag and byte_range is None and content_cache.can_cache(size):
+            body = content_cache.store_stream(path, etag, size, blob.chunks())
+        else:
+            body = stream_chunks(blob)
+            if etag:
+                # Only part of the blob is sent, so cache all of it for the next ranges
+                content_cache.fill_in_background(path, etag, size, partial(download_chunks, blob_client, etag))
+
+    logging.debug("Content cache stats: %s", content_cache.stats())
+
+    response = await make_response(body, status, headers)
+    response.timeout = None  # type: ignore
+    response.mimetype = mime_type
+    return response
+
+
+async def stream_chunks(blob: StorageStreamDownloader) -> AsyncGenerator[bytes, None]:
+    async for chunk in blob.chunks():
+        yield chunk
+
+
+async def download_chunks(blob_client: BlobClient, etag: str) -> AsyncIterator[bytes]:
+    blob = await blob_client.download_blob(etag=etag, match_condition=MatchConditions.IfNotModified)
+    return blob.chunks()
+
+
+def get_requested_range(
+    size: int, etag: Optional[str], last_modified: Optional[datetime]
+) -> Union[tuple[int, int], bool, None]:
+    """
+    Returns the [start, stop) byte range requested by the client, None to send the whole file,
+    or False if the range can't be satisfied.
+    """
+    if request.range is None or size == 0:
+        return None
+    # Only honour the range if the client's copy is still current
+    if request.if_range.etag and (not etag or request.if_range.etag != unquote_etag(etag)[0]):
+        return None
+    if request.if_range.date and (not last_modified or last_modified > request.if_range.date):
+        return None
+    # Multiple ranges aren't supported, send the whole file in that case
+    if len(request.range.ranges) != 1:
+        return None
+    return request.range.range_for_length(size) or False
 
 
 def error_dict(error: Exception) -> dict:
@@ -123,6 +243,116 @@ def error_response(error: Exception, route: str, status_code: int = 500):
     return jsonify(error_dict(error)), status_code
 
 
+def normalize_messages(messages: list[dict[str, Any]]) -> list[dict[str, Any]]:
+    return [
+        {
+            **message,
+            "content": " ".join(unicodedata.normalize("NFC", message["content"]).split()),
+        }
+        if isinstance(message.get("content"), str)
+        else message
+        for message in messages
+    ]
+
+
+def coalescing_key(
+    approach: Approach, messages: list[dict[str, Any]], context: dict[str, Any], stream: bool
+) -> Hashable:
+    # The search filter includes the security filter, so only users allowed to see the same documents share answers
+    overrides = context.get("overrides", {})
+    return (
+        id(approach),
+        stream,
+        json.dumps(normalize_messages(messages), sort_keys=True, ensure_ascii=False),
+        json.dumps(overrides, sort_keys=True, default=str),
+        approach.build_filter(overrides, context.get("auth_claims", {})),
+    )
+
+
+async def run_approach(
+    approach: Approach, request_json: dict[str, Any], context: dict[str, Any], stream: bool = False
+) -> Union[dict[str, Any], AsyncGenerator[dict[str, Any], None]]:
+    messages = request_json["messages"]
+    session_state = request_json.get("session_state")
+    coalescer: Optional[RequestCoalescer] = current_app.config[CONFIG_REQUEST_COALESCER]
+    if coalescer is None:
+        return await approach.run(messages, stream=stream, context=context, session_state=session_state)
+
+    # Identical concurrent requests share one run of the approach, each caller gets its own session state back
+    async def run() -> Any:
+        return await approach.run(messages, stream=stream, context=context)
+
+    key = coalescing_key(approach, messages, context, stream)
+    if stream:
+        return coalescer.stream(key, run, session_state)
+    return await coalescer.run(key, run, session_state)
+
+
+async def make_thoughts_lean(
+    event: dict[str, Any], thought_store: ThoughtStore, auth_claims: dict[str, Any]
+) -> dict[str, Any]:
+    """
+    Returns a copy of a response or response chunk where the heavy thoughts are replaced by IDs.
+    """
+    choices = event.get("choices")
+    if not choices or not (context := choices[0].get("context")) or not context.get("thoughts"):
+        return event
+    thoughts = await thought_store.make_lean(context["thoughts"], auth_claims.get("oid"))
+    return {**event, "choices": [{**choices[0], "context": {**context, "thoughts": thoughts}}, *choices[1:]]}
+
+
+async def with_lean_thoughts(
+    events: AsyncGenerator[dict[str, Any], None], thought_store: ThoughtStore, auth_claims: dict[str, Any]
+) -> AsyncGenerator[dict[str, Any], None]:
+    async for event in events:
+        yield await make_thoughts_lean(event, thought_store, auth_claims)
+
+
+async def save_conversation_turn(
+    conversation_store: ConversationStore,
+    history_summarizer: Optional[HistorySummarizer],
+    conversation_id: str,
+    conversation: Conversation,
+    new_messages: list[dict[str, Any]],
+    answer: str,
+):
+    """
+    Saves the new messages and answer of a turn, and summarizes the oldest messages once the conversation is long.
+    """
+    conversation.add_messages([*new_messages, {"role": "assistant", "content": answer}], conversation_store.model)
+    await conversation_store.put(conversation_id, conversation)
+    if history_summarizer:
+        history_summarizer.maybe_summarize(conversation_id, conversation)
+
+
+async def with_saved_conversation(
+    events: AsyncGenerator[dict[str, Any], None],
+    conversation_store: ConversationStore,
+    history_summarizer: Optional[HistorySummarizer],
+    conversation_id: str,
+    conversation: Conversation,
+    new_messages: list[dict[str, Any]],
+) -> AsyncGenerator[dict[str, Any], None]:
+    """
+    Passes on the events of a streamed answer, and saves the turn once the answer is complete.
+    """
+    answer = []
+    async for event in events:
+        if event.get("choices") and (content := (event["choices"][0].get("delta") or {}).get("content")):
+            answer.append(content)
+        yield event
+    await save_conversation_turn(
+        conversation_store, history_summarizer, conversation_id, conversation, new_messages, "".join(answer)
+    )
+
+
+def use_lean_thoughts(context: dict[str, Any]) -> bool:
+    # The lean_thoughts override is only honored when the thought store is set up
+    if current_app.config[CONFIG_THOUGHT_STORE] is None:
+        return False
+    return context.get("overrides", {}).get("lean_thoughts", current_app.config[CONFIG_LEAN_THOUGHTS])
+
+
 @bp.route("/ask", methods=["POST"])
 async def ask():
     if not request.is_json:
@@ -138,9 +368,9 @@ async def ask():
             approach = cast(Approach, current_app.config[CONFIG_ASK_VISION_APPROACH])
         else:
             approach = cast(Approach, current_app.config[CONFIG_ASK_APPROACH])
-        r = await approach.run(
-            request_json["messages"], context=context, session_state=request_json.get("session_state")
-        )
+        r = await run_approach(approach, request_json, context)
+        if use_lean_thoughts(context):
+            r = await make_thoughts_lean(r, current_app.config[CONFIG_THOUGHT_STORE], context["auth_claims"])
         return jsonify(r)
     except Exception as error:
         return error_response(error, "/ask")
@@ -149,14 +379,19 @@ async def ask():
 class JSONEncoder(json.JSONEncoder):
     def default(self, o):
         if dataclasses.is_dataclass(o):
-            return dataclasses.asdict(o)
+            return dataclass_to_dict(o)
         return super().default(o)
 
 
+# Streamed events keep the standard library's C encoder, whose output (unlike orjson's) has spaces after separators,
+# so that the NDJSON lines stay the same. It is created once rather than by json.dumps for every streamed event.
+NDJSON_ENCODER = JSONEncoder(ensure_ascii=False)
+
+
 async def format_as_ndjson(r: AsyncGenerator[dict, None]) -> AsyncGenerator[str, None]:
     try:
         async for event in r:
-            yield json.dumps(event, ensure_ascii=False, cls=JSONEncoder) + "\n"
+            yield NDJSON_ENCODER.encode(event) + "\n"
     except Exception as error:
         logging.exception("Exception while generating response stream: %s", error)
         yield json.dumps(error_dict(error))
@@ -178,15 +413,53 @@ async def chat():
         else:
             approach = cast(Approach, current_app.config[CONFIG_CHAT_APPROACH])
 
-        result = await approach.run(
-            request_json["messages"],
-            stream=request_json.get("stream", False),
-            context=context,
-            session_state=request_json.get("session_state"),
-        )
+        # With a conversation store, the session state references the conversation, and only new messages are sent
+        conversation_store: Optional[ConversationStore] = current_app.config[CONFIG_CONVERSATION_STORE]
+        if conversation_store:
+            new_messages = request_json["messages"]
+            if conversation_id := request_json.get("session_state"):
+                conversation = await conversation_store.get(conversation_id, context["auth_claims"].get("oid"))
+                if conversation is None:
+                    return jsonify({"error": "The conversation has expired, send all of its messages again"}), 410
+            else:
+                conversation_id = conversation_store.new_id()
+                conversation = Conversation(owner=context["auth_claims"].get("oid"))
+            request_json = {
+                **request_json,
+                "messages": [*conversation.get_history(), *new_messages],
+                "session_state": conversation_id,
+            }
+
+        result = await run_approach(approach, request_json, context, stream=request_json.get("stream", False))
         if isinstance(result, dict):
+            if conversation_store:
+                await save_conversation_turn(
+                    conversation_store,
+                    current_app.config[CONFIG_HISTORY_SUMMARIZER],
+                    conversation_id,
+                    conversation,
+                    new_messages,
+                    result["choices"][0]["message"]["content"],
+                )
+            if use_lean_thoughts(context):
+                result = await make_thoughts_lean(
+                    result, current_app.config[CONFIG_THOUGHT_STORE], context["auth_claims"]
+                )
             return jsonify(result)
         else:
+            if conversation_store:
+                result = with_saved_conversation(
+                    result,
+                    conversation_store,
+                    current_app.config[CONFIG_HISTORY_SUMMARIZER],
+                    conversation_id,
+                    conversation,
+                    new_messages,
+                )
+            if use_lean_thoughts(context):
+                result = with_lean_thoughts(result, current_app.config[CONFIG_THOUGHT_STORE], context["auth_claims"])
+            if chunk_coalescer := current_app.config[CONFIG_CHUNK_COALESCER]:
+                result = chunk_coalescer.coalesce(result)
             response = await make_response(format_as_ndjson(result))
             response.timeout = None  # type: ignore
             response.mimetype = "application/json-lines"
@@ -195,6 +468,23 @@ async def chat():
         return error_response(error, "/chat")
 
 
+# Send the heavy thoughts left out of lean responses, when the thought process is opened
+@bp.route("/thoughts/<thought_id>", methods=["GET"])
+async def thought(thought_id: str):
+    auth_helper = current_app.config[CONFIG_AUTH_CLIENT]
+    thought_store = current_app.config[CONFIG_THOUGHT_STORE]
+    if thought_store is None:
+        return jsonify({"error": "Lean thoughts are not enabled"}), 404
+    try:
+        auth_claims = await auth_helper.get_auth_claims_if_enabled(request.headers)
+        description = await thought_store.get(thought_id, auth_claims.get("oid"))
+    except Exception as error:
+        return error_response(error, "/thoughts")
+    if description is None:
+        return jsonify({"error": "This thought has expired"}), 404
+    return jsonify({"description": description})
+
+
 # Send MSAL.js settings to the client UI
 @bp.route("/auth_setup", methods=["GET"])
 def auth_setup():
@@ -207,6 +497,26 @@ def config():
     return jsonify({"showGPT4VOptions": current_app.config[CONFIG_GPT4V_DEPLOYED]})
 
 
+def default_app_data_dir() -> str:
+    # Named after the user, so that each user of a shared machine gets their own directory
+    suffix = f"-{os.getuid()}" if hasattr(os, "getuid") else ""
+    return os.path.join(tempfile.gettempdir(), f"azure-search-openai-demo{suffix}")
+
+
+def make_private_directory(path: str) -> str:
+    """
+    Creates a directory only the current user can access, or checks that an existing one is,
+    so that other local users can't read or replace the files kept in it.
+    """
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    status = os.lstat(path)
+    if not stat.S_ISDIR(status.st_mode):
+        raise ValueError(f"{path} must be a directory")
+    if hasattr(os, "getuid") and (status.st_uid != os.getuid() or status.st_mode & 0o077):
+        raise ValueError(f"{path} must be owned by the current user and only accessible to them")
+    return path
+
+
 @bp.before_app_serving
 async def setup_clients():
     # Replace these with your own values, either in environment variables or directly here
@@ -226,6 +536,11 @@ async def setup_clients():
     AZURE_OPENAI_GPT4V_MODEL = os.environ.get("AZURE_OPENAI_GPT4V_MODEL")
     AZURE_OPENAI_CHATGPT_DEPLOYMENT = os.getenv("AZURE_OPENAI_CHATGPT_DEPLOYMENT") if OPENAI_HOST == "azure" else None
     AZURE_OPENAI_EMB_DEPLOYMENT = os.getenv("AZURE_OPENAI_EMB_DEPLOYMENT") if OPENAI_HOST == "azure" else None
+    # Used to generate search queries with a smaller, faster model than the answers, if set
+    OPENAI_QUERY_REWRITE_MODEL = os.getenv("AZURE_OPENAI_QUERY_REWRITE_MODEL")
+    AZURE_OPENAI_QUERY_REWRITE_DEPLOYMENT = (
+        os.getenv("AZURE_OPENAI_QUERY_REWRITE_DEPLOYMENT") if OPENAI_HOST == "azure" else None
+    )
     AZURE_VISION_ENDPOINT = os.getenv("AZURE_VISION_ENDPOINT", "")
     # Used only with non-Azure OpenAI deployments
     OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
@@ -238,6 +553,14 @@ async def setup_clients():
     AZURE_SERVER_APP_SECRET = os.getenv("AZURE_SERVER_APP_SECRET")
     AZURE_CLIENT_APP_ID = os.getenv("AZURE_CLIENT_APP_ID")
     AZURE_AUTH_TENANT_ID = os.getenv("AZURE_AUTH_TENANT_ID", AZURE_TENANT_ID)
+    # Used to skip the On Behalf Of exchange for tokens seen recently, set the size to 0 to disable the cache
+    AUTH_CLAIMS_CACHE_SIZE = int(os.getenv("AUTH_CLAIMS_CACHE_SIZE", 1000))
+    AUTH_TOKEN_EXCHANGE_THREADS = int(os.getenv("AUTH_TOKEN_EXCHANGE_THREADS", 4))
+    AUTH_GROUPS_CACHE_TTL = float(os.getenv("AUTH_GROUPS_CACHE_TTL", 300))
+
+    # Used by the HTTP calls made without an Azure SDK client, to Azure AI Vision and Microsoft Graph
+    HTTP_CONNECTION_LIMIT_PER_HOST = int(os.getenv("HTTP_CONNECTION_LIMIT_PER_HOST", 20))
+    HTTP_KEEPALIVE_TIMEOUT = float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", 30))
 
     KB_FIELDS_CONTENT = os.getenv("KB_FIELDS_CONTENT", "content")
     KB_FIELDS_SOURCEPAGE = os.getenv("KB_FIELDS_SOURCEPAGE", "sourcepage")
@@ -247,6 +570,59 @@ async def setup_clients():
 
     USE_GPT4V = os.getenv("USE_GPT4V", "").lower() == "true"
 
+    # Used for the files the app keeps on the local disk, only the current user can access it
+    APP_DATA_DIR = os.getenv("APP_DATA_DIR", default_app_data_dir())
+
+    # Used to cache the citation files served by /content, set a size to 0 to disable that tier
+    CONTENT_CACHE_MEMORY_BYTES = int(os.getenv("CONTENT_CACHE_MEMORY_BYTES", 64 * 1024 * 1024))
+    CONTENT_CACHE_MEMORY_ITEM_BYTES = int(os.getenv("CONTENT_CACHE_MEMORY_ITEM_BYTES", 2 * 1024 * 1024))
+    # The disk tier is disabled unless a size is set
+    CONTENT_CACHE_DISK_BYTES = int(os.getenv("CONTENT_CACHE_DISK_BYTES", 0))
+    CONTENT_CACHE_DIR = os.getenv("CONTENT_CACHE_DIR")
+    # Used to cache query embeddings, set the size to 0 to disable the cache
+    EMBEDDING_CACHE_BYTES = int(os.getenv("EMBEDDING_CACHE_BYTES", 16 * 1024 * 1024))
+    EMBEDDING_CACHE_TTL = float(os.getenv("EMBEDDING_CACHE_TTL", 3600))
+    # Used to cache the page images sent to GPT-4V, set the size to 0 to disable the cache
+    IMAGE_CACHE_BYTES = int(os.getenv("IMAGE_CACHE_BYTES", 64 * 1024 * 1024))
+    # Maximum number of seconds to wait for the query vectors of the GPT-4V approaches
+    EMBEDDING_TIMEOUT = float(os.getenv("EMBEDDING_TIMEOUT", 10))
+    # Used to retrieve only the fields used to answer from the search index, leaving out the vectors
+    SEARCH_FIELD_PROJECTION = os.getenv("SEARCH_FIELD_PROJECTION", "").lower() == "true"
+    # Used to keep the sources of a prompt below a number of tokens, by default they fill what the model's context allows
+    SOURCES_TOKEN_LIMIT = int(os.environ["SOURCES_TOKEN_LIMIT"]) if os.getenv("SOURCES_TOKEN_LIMIT") else None
+    # Used to merge the overlapping chunks of a page and leave out near-duplicate sources from prompts
+    DEDUPLICATE_SOURCES = os.getenv("DEDUPLICATE_SOURCES", "").lower() == "true"
+    # Used to share one answer between identical concurrent /ask and /chat requests
+    ENABLE_REQUEST_COALESCING = os.getenv("ENABLE_REQUEST_COALESCING", "").lower() == "true"
+    # Used to cache search results, disabled unless a size is set
+    SEARCH_CACHE_BYTES = int(os.getenv("SEARCH_CACHE_BYTES", 0))
+    SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", 300))
+    SEARCH_CACHE_GENERATION_CHECK_INTERVAL = float(os.getenv("SEARCH_CACHE_GENERATION_CHECK_INTERVAL", 60))
+    # Used to merge streamed answer text into fewer, larger events, disabled unless a size is set
+    STREAM_COALESCE_MAX_CHARS = int(os.getenv("STREAM_COALESCE_MAX_CHARS", 0))
+    STREAM_COALESCE_MAX_DELAY = float(os.getenv("STREAM_COALESCE_MAX_DELAY", 0.03))
+    # Used to leave the search results and prompt out of the thoughts of responses, and serve them on demand
+    LEAN_THOUGHTS = os.getenv("LEAN_THOUGHTS", "").lower() == "true"
+    THOUGHT_STORE_PATH = os.getenv("THOUGHT_STORE_PATH")
+    THOUGHT_STORE_TTL = float(os.getenv("THOUGHT_STORE_TTL", 600))
+    # Used to keep chat conversations on the server, so that clients only send their new message: memory, sqlite or redis
+    CONVERSATION_STORE = os.getenv("CONVERSATION_STORE", "")
+    CONVERSATION_STORE_TTL = float(os.getenv("CONVERSATION_STORE_TTL", 24 * 60 * 60))
+    CONVERSATION_STORE_MAX_BYTES = int(os.getenv("CONVERSATION_STORE_MAX_BYTES", 64 * 1024 * 1024))
+    CONVERSATION_STORE_PATH = os.getenv("CONVERSATION_STORE_PATH")
+    CONVERSATION_STORE_REDIS_URL = os.getenv("CONVERSATION_STORE_REDIS_URL")
+    # Used to summarize the oldest messages of stored conversations once they pass this many tokens, if set
+    SUMMARIZE_HISTORY_TOKENS = int(os.getenv("SUMMARIZE_HISTORY_TOKENS", 0))
+    SUMMARIZE_HISTORY_KEEP_MESSAGES = int(os.getenv("SUMMARIZE_HISTORY_KEEP_MESSAGES", 4))
+    # Used to search with the user's question while the chat approach generates the search query
+    ENABLE_SPECULATIVE_RETRIEVAL = os.getenv("ENABLE_SPECULATIVE_RETRIEVAL", "").lower() == "true"
+    # Used to search with the user's question instead of generating a search query: never, first_turn or self_contained
+    SKIP_QUERY_REWRITE = os.getenv("SKIP_QUERY_REWRITE", "never").lower()
+    if SKIP_QUERY_REWRITE not in ("never", "first_turn", "self_contained"):
+        raise ValueError(
+            f"Unknown SKIP_QUERY_REWRITE value: {SKIP_QUERY_REWRITE}, expected never, first_turn or self_contained"
+        )
+
     # Use the current user identity to authenticate with Azure OpenAI, AI Search and Blob Storage (no secrets needed,
     # just use 'az login' locally, and managed identity when deployed on Azure). If you need to use keys, use separate AzureKeyCredential instances with the
     # keys for each service
@@ -264,10 +640,19 @@ async def setup_clients():
         credential=azure_credential,
     )
     blob_client = BlobServiceClient(
-        account_url=f"https://{AZURE_STORAGE_ACCOUNT}.blob.core.windows.net", credential=azure_credential
+        account_url=f"https://{AZURE_STORAGE_ACCOUNT}.blob.core.windows.net",
+        credential=azure_credential,
+        # Keep the per-request buffer small, /content streams the rest of the blob chunk by chunk
+        max_single_get_size=CONTENT_CHUNK_SIZE,
+        max_chunk_get_size=CONTENT_CHUNK_SIZE,
     )
     blob_container_client = blob_client.get_container_client(AZURE_STORAGE_CONTAINER)
 
+    http_sessions = HTTPSessionRegistry(
+        limit_per_host=HTTP_CONNECTION_LIMIT_PER_HOST, keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT
+    )
+    current_app.config[CONFIG_HTTP_SESSIONS] = http_sessions
+
     # Set up authentication helper
     auth_helper = AuthenticationHelper(
         search_index=(await search_index_client.get_index(AZURE_SEARCH_INDEX)) if AZURE_USE_AUTHENTICATION else None,
@@ -277,6 +662,10 @@ async def setup_clients():
         client_app_id=AZURE_CLIENT_APP_ID,
         tenant_id=AZURE_AUTH_TENANT_ID,
         require_access_control=AZURE_ENFORCE_ACCESS_CONTROL,
+        claims_cache_size=AUTH_CLAIMS_CACHE_SIZE,
+        token_exchange_workers=AUTH_TOKEN_EXCHANGE_THREADS,
+        groups_cache_ttl=AUTH_GROUPS_CACHE_TTL,
+        http_sessions=http_sessions,
     )
 
     vision_key = None
@@ -309,9 +698,97 @@ async def setup_clients():
     current_app.config[CONFIG_SEARCH_CLIENT] = search_client
     current_app.config[CONFIG_BLOB_CONTAINER_CLIENT] = blob_container_client
     current_app.config[CONFIG_AUTH_CLIENT] = auth_helper
+    current_app.config[CONFIG_CONTENT_CACHE] = ContentCache(
+        max_memory_bytes=CONTENT_CACHE_MEMORY_BYTES,
+        max_memory_item_bytes=CONTENT_CACHE_MEMORY_ITEM_BYTES,
+        max_disk_bytes=CONTENT_CACHE_DISK_BYTES,
+        disk_directory=(
+            (CONTENT_CACHE_DIR or os.path.join(make_private_directory(APP_DATA_DIR), "content-cache"))
+            if CONTENT_CACHE_DISK_BYTES > 0
+            else None
+        ),
+    )
 
     current_app.config[CONFIG_GPT4V_DEPLOYED] = bool(USE_GPT4V)
 
+    current_app.config[CONFIG_REQUEST_COALESCER] = RequestCoalescer() if ENABLE_REQUEST_COALESCING else None
+    current_app.config[CONFIG_LEAN_THOUGHTS] = LEAN_THOUGHTS
+    thought_store: Optional[ThoughtStore] = None
+    if LEAN_THOUGHTS:
+        thought_store = ThoughtStore(
+            THOUGHT_STORE_PATH or os.path.join(make_private_directory(APP_DATA_DIR), "thoughts.sqlite3"),
+            ttl=THOUGHT_STORE_TTL,
+        )
+    current_app.config[CONFIG_THOUGHT_STORE] = thought_store
+    conversation_store: Optional[ConversationStore] = None
+    if CONVERSATION_STORE == "memory":
+        conversation_store = MemoryConversationStore(
+            OPENAI_CHATGPT_MODEL, CONVERSATION_STORE_TTL, max_bytes=CONVERSATION_STORE_MAX_BYTES
+        )
+    elif CONVERSATION_STORE == "sqlite":
+        conversation_store = SQLiteConversationStore(
+            OPENAI_CHATGPT_MODEL,
+            CONVERSATION_STORE_TTL,
+            path=CONVERSATION_STORE_PATH or os.path.join(make_private_directory(APP_DATA_DIR), "conversations.sqlite3"),
+        )
+    elif CONVERSATION_STORE == "redis":
+        if not CONVERSATION_STORE_REDIS_URL:
+            raise ValueError("CONVERSATION_STORE_REDIS_URL must be set to keep conversations in Redis")
+        try:
+            import redis.asyncio
+        except ImportError as error:
+            raise ValueError(
+                "The redis package must be installed to keep conversations in Redis, see requirements.txt"
+            ) from error
+
+        conversation_store = RedisConversationStore(
+            OPENAI_CHATGPT_MODEL, CONVERSATION_STORE_TTL, client=redis.asyncio.from_url(CONVERSATION_STORE_REDIS_URL)
+        )
+    elif CONVERSATION_STORE:
+        raise ValueError(f"Unknown conversation store: {CONVERSATION_STORE}, expected memory, sqlite or redis")
+    current_app.config[CONFIG_CONVERSATION_STORE] = conversation_store
+    history_summarizer: Optional[HistorySummarizer] = None
+    if SUMMARIZE_HISTORY_TOKENS > 0:
+        if conversation_store is None:
+            raise ValueError("CONVERSATION_STORE must be set to summarize conversation histories")
+        # Summaries are made with the smaller query rewrite model, if set
+        history_summarizer = HistorySummarizer(
+            openai_client,
+            OPENAI_QUERY_REWRITE_MODEL or OPENAI_CHATGPT_MODEL,
+            AZURE_OPENAI_QUERY_REWRITE_DEPLOYMENT if OPENAI_QUERY_REWRITE_MODEL else AZURE_OPENAI_CHATGPT_DEPLOYMENT,
+            conversation_store,
+            max_tokens=SUMMARIZE_HISTORY_TOKENS,
+            keep_messages=SUMMARIZE_HISTORY_KEEP_MESSAGES,
+        )
+    current_app.config[CONFIG_HISTORY_SUMMARIZER] = history_summarizer
+    current_app.config[CONFIG_CHUNK_COALESCER] = (
+        ChunkCoalescer(STREAM_COALESCE_MAX_CHARS, STREAM_COALESCE_MAX_DELAY) if STREAM_COALESCE_MAX_CHARS > 0 else None
+    )
+
+    # Shared by all approaches, the cache key includes the embedding model
+    embedding_cache: Optional[LRUCache[array[float]]] = None
+    if EMBEDDING_CACHE_BYTES > 0:
+        embedding_cache = LRUCache(
+            max_weight=EMBEDDING_CACHE_BYTES,
+            weigh=lambda vector: vector.itemsize * len(vector),
+            ttl=EMBEDDING_CACHE_TTL,
+        )
+
+    async def load_search_generation() -> Optional[str]:
+        properties = await blob_container_client.get_container_properties()
+        return properties.metadata.get(SEARCH_GENERATION_METADATA)
+
+    search_cache: Optional[SearchCache[list[Document]]] = None
+    if SEARCH_CACHE_BYTES > 0:
+        search_cache = SearchCache(
+            max_bytes=SEARCH_CACHE_BYTES,
+            ttl=SEARCH_CACHE_TTL,
+            weigh=lambda documents: sum(document.approximate_size() for document in documents),
+            load_generation=load_search_generation,
+            generation_check_interval=SEARCH_CACHE_GENERATION_CHECK_INTERVAL,
+        )
+    current_app.config[CONFIG_SEARCH_CACHE] = search_cache
+
     # Various approaches to integrate GPT and external knowledge, most applications will use a single one of these patterns
     # or some derivative, here we include several for exploration purposes
     current_app.config[CONFIG_ASK_APPROACH] = RetrieveThenReadApproach(
@@ -326,12 +803,22 @@ async def setup_clients():
         content_field=KB_FIELDS_CONTENT,
         query_language=AZURE_SEARCH_QUERY_LANGUAGE,
         query_speller=AZURE_SEARCH_QUERY_SPELLER,
+        embedding_cache=embedding_cache,
+        search_cache=search_cache,
+        project_search_fields=SEARCH_FIELD_PROJECTION,
+        sources_token_limit=SOURCES_TOKEN_LIMIT,
+        deduplicate_sources=DEDUPLICATE_SOURCES,
     )
 
     if USE_GPT4V:
         if vision_key is None:
             raise ValueError("Vision key must be set (in Key Vault) to use the vision approach.")
 
+        # Data URLs of the page images, keyed by blob name and validated against the blob ETag
+        image_cache: Optional[LRUCache[tuple[str, str]]] = None
+        if IMAGE_CACHE_BYTES > 0:
+            image_cache = LRUCache(max_weight=IMAGE_CACHE_BYTES, weigh=lambda entry: len(entry[0]) + len(entry[1]))
+
         current_app.config[CONFIG_ASK_VISION_APPROACH] = RetrieveThenReadVisionApproach(
             search_client=search_client,
             openai_client=openai_client,
@@ -347,6 +834,14 @@ async def setup_clients():
             content_field=KB_FIELDS_CONTENT,
             query_language=AZURE_SEARCH_QUERY_LANGUAGE,
             query_speller=AZURE_SEARCH_QUERY_SPELLER,
+            embedding_cache=embedding_cache,
+            search_cache=search_cache,
+            embedding_timeout=EMBEDDING_TIMEOUT,
+            image_cache=image_cache,
+            http_sessions=http_sessions,
+            project_search_fields=SEARCH_FIELD_PROJECTION,
+            sources_token_limit=SOURCES_TOKEN_LIMIT,
+            deduplicate_sources=DEDUPLICATE_SOURCES,
         )
 
         current_app.config[CONFIG_CHAT_VISION_APPROACH] = ChatReadRetrieveReadVisionApproach(
@@ -364,6 +859,16 @@ async def setup_clients():
             content_field=KB_FIELDS_CONTENT,
             query_language=AZURE_SEARCH_QUERY_LANGUAGE,
             query_speller=AZURE_SEARCH_QUERY_SPELLER,
+            embedding_cache=embedding_cache,
+            search_cache=search_cache,
+            embedding_timeout=EMBEDDING_TIMEOUT,
+            image_cache=image_cache,
+            http_sessions=http_sessions,
+            query_rewrite_model=OPENAI_QUERY_REWRITE_MODEL,
+            query_rewrite_deployment=AZURE_OPENAI_QUERY_REWRITE_DEPLOYMENT,
+            project_search_fields=SEARCH_FIELD_PROJECTION,
+            sources_token_limit=SOURCES_TOKEN_LIMIT,
+            deduplicate_sources=DEDUPLICATE_SOURCES,
         )
 
     current_app.config[CONFIG_CHAT_APPROACH] = ChatReadRetrieveReadApproach(
@@ -378,17 +883,42 @@ async def setup_clients():
         content_field=KB_FIELDS_CONTENT,
         query_language=AZURE_SEARCH_QUERY_LANGUAGE,
         query_speller=AZURE_SEARCH_QUERY_SPELLER,
+        embedding_cache=embedding_cache,
+        search_cache=search_cache,
+        speculative_retrieval=ENABLE_SPECULATIVE_RETRIEVAL,
+        skip_query_rewrite=SKIP_QUERY_REWRITE,
+        query_rewrite_model=OPENAI_QUERY_REWRITE_MODEL,
+        query_rewrite_deployment=AZURE_OPENAI_QUERY_REWRITE_DEPLOYMENT,
+        project_search_fields=SEARCH_FIELD_PROJECTION,
+        sources_token_limit=SOURCES_TOKEN_LIMIT,
+        deduplicate_sources=DEDUPLICATE_SOURCES,
     )
 
 
 @bp.after_app_serving
 async def close_clients():
+    # Stop the background downloads of the content cache before closing the blob client
+    logging.info("Content cache stats: %s", current_app.config[CONFIG_CONTENT_CACHE].stats())
+    await current_app.config[CONFIG_CONTENT_CACHE].close()
     await current_app.config[CONFIG_SEARCH_CLIENT].close()
     await current_app.config[CONFIG_BLOB_CONTAINER_CLIENT].close()
+    await current_app.config[CONFIG_AUTH_CLIENT].close()
+    await current_app.config[CONFIG_HTTP_SESSIONS].close()
+    if thought_store := current_app.config[CONFIG_THOUGHT_STORE]:
+        await thought_store.close()
+    if history_summarizer := current_app.config[CONFIG_HISTORY_SUMMARIZER]:
+        await history_summarizer.close()
+    if conversation_store := current_app.config[CONFIG_CONVERSATION_STORE]:
+        await conversation_store.close()
+    if coalescer := current_app.config[CONFIG_REQUEST_COALESCER]:
+        logging.info("Request coalescing stats: %s", coalescer.stats())
+    if search_cache := current_app.config[CONFIG_SEARCH_CACHE]:
+        logging.info("Search cache stats: %s", search_cache.stats())
 
 
 def create_app():
     app = Quart(__name__)
+    app.json = OrjsonProvider(app)
     app.register_blueprint(bp)
 
     if os.getenv("APPLICATIONINSIGHTS_CONNECTION_STRING"):
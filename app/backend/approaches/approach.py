@@ -1,4 +1,8 @@
+import asyncio
+import logging
 import os
+import unicodedata
+from array import array
 from dataclasses import dataclass
 from typing import Any, AsyncGenerator, List, Optional, Union, cast
 
@@ -13,11 +17,31 @@ from azure.search.documents.models import (
 from openai import AsyncOpenAI
 
 from core.authentication import AuthenticationHelper
+from core.cache import LRUCache
+from core.httpsessions import HTTPSessionRegistry
+from core.modelhelper import token_counter
+from core.searchcache import SearchCache, vector_fingerprint
+from core.sourcededuper import deduplicate_sources
+from core.sourcepacker import pack_sources
 from text import nonewlines
 
 
 @dataclass
 class Document:
+    # Slots save the per-instance dict of the many documents held by the search cache
+    __slots__ = (
+        "id",
+        "content",
+        "embedding",
+        "image_embedding",
+        "category",
+        "sourcepage",
+        "sourcefile",
+        "oids",
+        "groups",
+        "captions",
+    )
+
     id: Optional[str]
     content: Optional[str]
     embedding: Optional[List[float]]
@@ -52,6 +76,12 @@ class Document:
             else [],
         }
 
+    def approximate_size(self) -> int:
+        """Returns a rough estimate of the memory used by the document, in bytes."""
+        embeddings = len(self.embedding or []) + len(self.image_embedding or [])
+        captions = sum(len(caption.text or "") for caption in self.captions or [])
+        return 256 + len(self.content or "") + captions + embeddings * 32
+
     @classmethod
     def trim_embedding(cls, embedding: Optional[List[float]]) -> Optional[str]:
         """Returns a trimmed list of floats from the vector embedding."""
@@ -73,6 +103,21 @@ class ThoughtStep:
 
 
 class Approach:
+    # Optional cache of query embeddings, keyed by embedding model and normalized query text
+    embedding_cache: Optional[LRUCache["array[float]"]] = None
+    # Optional cache of search results, keyed by query, filter, search options and vector fingerprint
+    search_cache: Optional[SearchCache[List[Document]]] = None
+    # Maximum number of seconds to wait for the query vectors in compute_vectors, None waits indefinitely
+    embedding_timeout: Optional[float] = None
+    # Pooled sessions used for calls to Azure AI Vision, a new session is opened for each call without them
+    http_sessions: Optional[HTTPSessionRegistry] = None
+    # Whether searches only retrieve the fields used to answer, leaving out the vectors, IDs and access control lists
+    project_search_fields: bool = False
+    # Optional maximum number of tokens of the sources in a prompt, below what fits in the model's context
+    sources_token_limit: Optional[int] = None
+    # Whether overlapping chunks of a page are merged, and near-duplicate sources left out of the prompt
+    deduplicate_sources: bool = False
+
     def __init__(
         self,
         search_client: SearchClient,
@@ -83,6 +128,8 @@ class Approach:
         embedding_deployment: Optional[str],  # Not needed for non-Azure OpenAI or for retrieval_mode="text"
         embedding_model: str,
         openai_host: str,
+        embedding_cache: Optional[LRUCache["array[float]"]] = None,
+        search_cache: Optional[SearchCache[List[Document]]] = None,
     ):
         self.search_client = search_client
         self.openai_client = openai_client
@@ -92,6 +139,8 @@ class Approach:
         self.embedding_deployment = embedding_deployment
         self.embedding_model = embedding_model
         self.openai_host = openai_host
+        self.embedding_cache = embedding_cache
+        self.search_cache = search_cache
 
     def build_filter(self, overrides: dict[str, Any], auth_claims: dict[str, Any]) -> Optional[str]:
         exclude_category = overrides.get("exclude_category") or None
@@ -112,42 +161,74 @@ class Approach:
         use_semantic_ranker: bool,
         use_semantic_captions: bool,
     ) -> List[Document]:
-        # Use semantic ranker if requested and if retrieval mode is text or hybrid (vectors + text)
-        if use_semantic_ranker and query_text:
-            results = await self.search_client.search(
-                search_text=query_text,
-                filter=filter,
-                query_type=QueryType.SEMANTIC,
-                query_language=self.query_language,
-                query_speller=self.query_speller,
-                semantic_configuration_name="default",
-                top=top,
-                query_caption="extractive|highlight-false" if use_semantic_captions else None,
-                vector_queries=vectors,
-            )
-        else:
-            results = await self.search_client.search(
-                search_text=query_text or "", filter=filter, top=top, vector_queries=vectors
-            )
+        select = self.get_search_select(use_semantic_captions)
 
-        documents = []
-        async for page in results.by_page():
-            async for document in page:
-                documents.append(
-                    Document(
-                        id=document.get("id"),
-                        content=document.get("content"),
-                        embedding=document.get("embedding"),
-                        image_embedding=document.get("imageEmbedding"),
-                        category=document.get("category"),
-                        sourcepage=document.get("sourcepage"),
-                        sourcefile=document.get("sourcefile"),
-                        oids=document.get("oids"),
-                        groups=document.get("groups"),
-                        captions=cast(List[CaptionResult], document.get("@search.captions")),
-                    )
+        async def search_index() -> List[Document]:
+            # Use semantic ranker if requested and if retrieval mode is text or hybrid (vectors + text)
+            if use_semantic_ranker and query_text:
+                results = await self.search_client.search(
+                    search_text=query_text,
+                    filter=filter,
+                    query_type=QueryType.SEMANTIC,
+                    query_language=self.query_language,
+                    query_speller=self.query_speller,
+                    semantic_configuration_name="default",
+                    top=top,
+                    query_caption="extractive|highlight-false" if use_semantic_captions else None,
+                    vector_queries=vectors,
+                    select=select,
                 )
-        return documents
+            else:
+                results = await self.search_client.search(
+                    search_text=query_text or "", filter=filter, top=top, vector_queries=vectors, select=select
+                )
+
+            documents = []
+            async for page in results.by_page():
+                async for document in page:
+                    documents.append(
+                        Document(
+                            id=document.get("id"),
+                            content=document.get("content"),
+                            embedding=document.get("embedding"),
+                            image_embedding=document.get("imageEmbedding"),
+                            category=document.get("category"),
+                            sourcepage=document.get("sourcepage"),
+                            sourcefile=document.get("sourcefile"),
+                            oids=document.get("oids"),
+                            groups=document.get("groups"),
+                            captions=cast(List[CaptionResult], document.get("@search.captions")),
+                        )
+                    )
+            return documents
+
+        if self.search_cache is None:
+            return await search_index()
+        key = (
+            query_text,
+            filter,
+            top,
+            bool(use_semantic_ranker and query_text),
+            use_semantic_captions,
+            self.query_language,
+            self.query_speller,
+            vector_fingerprint(vectors),
+            tuple(select) if select else None,
+        )
+        # Return a copy of the cached list, so that callers can't change the cached results
+        return list(await self.search_cache.get_or_search(key, search_index))
+
+    def get_search_select(self, use_semantic_captions: bool) -> Optional[List[str]]:
+        """
+        Returns the fields to retrieve from the search index, or None to retrieve all of them.
+        The content is left out when the sources are made of the semantic captions.
+        """
+        if not self.project_search_fields:
+            return None
+        fields = ["sourcepage", "sourcefile", "category"]
+        if not use_semantic_captions:
+            fields.append("content")
+        return fields
 
     def get_sources_content(
         self, results: List[Document], use_semantic_captions: bool, use_image_citation: bool
@@ -165,6 +246,26 @@ class Approach:
                 for doc in results
             ]
 
+    def remove_duplicate_sources(self, sources_content: list[str], model: str) -> tuple[list[str], int]:
+        """
+        Returns the sources without overlapping or near-duplicate content if enabled, and the number of tokens saved.
+        """
+        if not self.deduplicate_sources:
+            return sources_content, 0
+        deduplicated = deduplicate_sources(sources_content)
+        saved_token_count = sum(token_counter.count_texts(sources_content, model)) - sum(
+            token_counter.count_texts(deduplicated, model)
+        )
+        return deduplicated, saved_token_count
+
+    def pack_sources(self, sources_content: list[str], max_tokens: int, model: str) -> list[str]:
+        """
+        Returns the sources that fit in the prompt, truncating the last ones at a sentence boundary if needed.
+        """
+        if self.sources_token_limit is not None:
+            max_tokens = min(max_tokens, self.sources_token_limit)
+        return pack_sources(sources_content, max_tokens, model)
+
     def get_citation(self, sourcepage: str, use_image_citation: bool) -> str:
         if use_image_citation:
             return sourcepage
@@ -178,12 +279,22 @@ class Approach:
             return sourcepage
 
     async def compute_text_embedding(self, q: str):
-        embedding = await self.openai_client.embeddings.create(
-            # Azure Open AI takes the deployment name as the model name
-            model=self.embedding_deployment if self.embedding_deployment else self.embedding_model,
-            input=q,
-        )
-        query_vector = embedding.data[0].embedding
+        # Azure Open AI takes the deployment name as the model name
+        model = self.embedding_deployment if self.embedding_deployment else self.embedding_model
+
+        async def create_embedding() -> List[float]:
+            embedding = await self.openai_client.embeddings.create(model=model, input=q)
+            return embedding.data[0].embedding
+
+        async def create_compact_embedding() -> "array[float]":
+            return array("f", await create_embedding())
+
+        if self.embedding_cache is None:
+            query_vector = await create_embedding()
+        else:
+            # Repeated queries share one embedding call, the vector is kept as float32 like in the search index
+            cache_key = (model, " ".join(unicodedata.normalize("NFC", q).split()))
+            query_vector = (await self.embedding_cache.get_or_load(cache_key, create_compact_embedding)).tolist()
         return RawVectorQuery(vector=query_vector, k=50, fields="embedding")
 
     async def compute_image_embedding(self, q: str, vision_endpoint: str, vision_key: str):
@@ -192,14 +303,63 @@ class Approach:
         headers = {"Content-Type": "application/json", "Ocp-Apim-Subscription-Key": vision_key}
         data = {"text": q}
 
-        async with aiohttp.ClientSession() as session:
+        async def vectorize_text(session: aiohttp.ClientSession) -> List[float]:
             async with session.post(
                 url=endpoint, params=params, headers=headers, json=data, raise_for_status=True
             ) as response:
                 json = await response.json()
-                image_query_vector = json["vector"]
+                return json["vector"]
+
+        if self.http_sessions is None:
+            async with aiohttp.ClientSession() as session:
+                image_query_vector = await vectorize_text(session)
+        else:
+            image_query_vector = await vectorize_text(self.http_sessions.get())
         return RawVectorQuery(vector=image_query_vector, k=50, fields="imageEmbedding")
 
+    async def compute_vectors(
+        self, q: str, vector_fields: List[str], vision_endpoint: str = "", vision_key: str = ""
+    ) -> tuple[List[VectorQuery], List[str]]:
+        """
+        Computes the query vector of each field concurrently, within embedding_timeout seconds.
+        A field that fails or times out is skipped so that the search uses the vectors that did arrive,
+        the error is only raised if no vector arrived. Returns the vectors and the skipped fields.
+        """
+        tasks = {
+            field: asyncio.ensure_future(
+                self.compute_text_embedding(q)
+                if field == "embedding"
+                else self.compute_image_embedding(q, vision_endpoint, vision_key)
+            )
+            for field in vector_fields
+        }
+        if not tasks:
+            return [], []
+        try:
+            await asyncio.wait(tasks.values(), timeout=self.embedding_timeout)
+        finally:
+            # Cancel the stragglers on timeout, and all of them if the request itself is cancelled
+            for task in tasks.values():
+                task.cancel()
+
+        vectors: List[VectorQuery] = []
+        skipped_fields: List[str] = []
+        errors: List[BaseException] = []
+        for field, task in tasks.items():
+            if task.done() and not task.cancelled():
+                error = task.exception()
+            else:
+                error = asyncio.TimeoutError(f"Timed out after {self.embedding_timeout} seconds")
+            if error is None:
+                vectors.append(task.result())
+            else:
+                logging.warning("Unable to compute the %s vector, searching without it: %r", field, error)
+                skipped_fields.append(field)
+                errors.append(error)
+        if not vectors:
+            raise errors[0]
+        return vectors, skipped_fields
+
     async def run(
         self, messages: list[dict], stream: bool = False, session_state: Any = None, context: dict[str, Any] = {}
     ) -> Union[dict[str, Any], AsyncGenerator[dict[str, Any], None]]:
@@ -11,7 +11,9 @@ from openai.types.chat import (
 )
 
 from approaches.approach import Approach
+from core.followupquestions import FollowupQuestionParser
 from core.messagebuilder import MessageBuilder
+from core.streaming import chunk_to_dict
 
 
 class ChatApproach(Approach, ABC):
@@ -96,24 +98,69 @@ class ChatApproach(Approach, ABC):
         message_builder = MessageBuilder(system_prompt, model_id)
 
         # Add examples to show the chat what responses we want. It will try to mimic any responses and make sure they match the rules laid out in the system message.
-        for shot in reversed(few_shots):
-            message_builder.insert_message(shot.get("role"), shot.get("content"))
-
-        append_index = len(few_shots) + 1
-
-        message_builder.insert_message(self.USER, user_content, index=append_index)
-        total_token_count = message_builder.count_tokens_for_message(dict(message_builder.messages[-1]))  # type: ignore
-
-        newest_to_oldest = list(reversed(history[:-1]))
-        for message in newest_to_oldest:
-            potential_message_count = message_builder.count_tokens_for_message(message)
-            if (total_token_count + potential_message_count) > max_tokens:
-                logging.debug("Reached max tokens of %d, history will be truncated", max_tokens)
-                break
-            message_builder.insert_message(message["role"], message["content"], index=append_index)
-            total_token_count += potential_message_count
+        messages = message_builder.messages
+        messages.extend(message_builder.make_message(shot.get("role"), shot.get("content")) for shot in few_shots)
+
+        user_message = message_builder.make_message(self.USER, user_content)
+
+        # Keep the newest messages that fit in the remaining tokens
+        newest_to_oldest = history[-2::-1]
+        user_token_count = message_builder.count_tokens_for_message(dict(user_message))  # type: ignore
+        kept, _ = self.count_newest_history(message_builder, newest_to_oldest, max_tokens - user_token_count)
+        if kept < len(newest_to_oldest):
+            logging.debug("Reached max tokens of %d, history will be truncated", max_tokens)
+        messages.extend(
+            message_builder.make_message(message["role"], message["content"])
+            for message in reversed(newest_to_oldest[:kept])
+        )
+        messages.append(user_message)
         return message_builder.messages
 
+    def count_newest_history(
+        self, message_builder: MessageBuilder, newest_to_oldest: list[dict[str, str]], max_tokens: int
+    ) -> tuple[int, int]:
+        """
+        Returns how many of the newest history messages fit in max_tokens, and their number of tokens.
+        Messages are counted a batch at a time, sized from an estimate of how many more messages fit,
+        so that the older messages past the cutoff are rarely counted.
+        """
+        kept, token_count = 0, 0
+        while kept < len(newest_to_oldest):
+            # Estimate generously, at 3 characters per token plus the role, so that the batch rarely goes
+            # past the first message that doesn't fit
+            end, estimate = kept, 0
+            while end < len(newest_to_oldest) and (end == kept or estimate <= max_tokens - token_count):
+                estimate += len(newest_to_oldest[end]["content"]) // 3 + 3
+                end += 1
+            for message_token_count in message_builder.count_tokens_for_messages(newest_to_oldest[kept:end]):
+                if token_count + message_token_count > max_tokens:
+                    return kept, token_count
+                token_count += message_token_count
+                kept += 1
+        return kept, token_count
+
+    def get_sources_token_limit(
+        self,
+        system_prompt: str,
+        model_id: str,
+        history: list[dict[str, str]],
+        user_content: str,
+        max_tokens: int,
+    ) -> int:
+        """
+        Returns the number of tokens left for the sources of the answer prompt, after the system prompt,
+        the user message without its sources and the newest history messages.
+        The history may take up to half of the tokens, so that a long conversation doesn't crowd out the sources.
+        """
+        message_builder = MessageBuilder(system_prompt, model_id)
+        user_message = message_builder.make_message(self.USER, user_content)
+        prompt_token_count = sum(
+            message_builder.count_tokens_for_messages([message_builder.messages[0], user_message])  # type: ignore
+        )
+        max_history_token_count = (max_tokens - prompt_token_count) // 2
+        _, history_token_count = self.count_newest_history(message_builder, history[-2::-1], max_history_token_count)
+        return max_tokens - prompt_token_count - history_token_count
+
     async def run_without_streaming(
         self,
         history: list[dict[str, str]],
@@ -157,40 +204,45 @@ class ChatApproach(Approach, ABC):
             "object": "chat.completion.chunk",
         }
 
-        followup_questions_started = False
-        followup_content = ""
+        followup_parser = FollowupQuestionParser() if overrides.get("suggest_followup_questions") else None
         async for event_chunk in await chat_coroutine:
             # "2023-07-01-preview" API version has a bug where first response has empty choices
-            event = event_chunk.model_dump()  # Convert pydantic model to dict
+            event = chunk_to_dict(event_chunk)  # Convert pydantic model to dict
             if event["choices"]:
-                # if event contains << and not >>, it is start of follow-up question, truncate
+                if followup_parser is None:
+                    yield event
+                    continue
+                # Leave the follow-up questions out of the answer, and send each one as soon as it is complete
                 content = event["choices"][0]["delta"].get("content")
                 content = content or ""  # content may either not exist in delta, or explicitly be None
-                if overrides.get("suggest_followup_questions") and "<<" in content:
-                    followup_questions_started = True
-                    earlier_content = content[: content.index("<<")]
-                    if earlier_content:
-                        event["choices"][0]["delta"]["content"] = earlier_content
-                        yield event
-                    followup_content += content[content.index("<<") :]
-                elif followup_questions_started:
-                    followup_content += content
-                else:
+                answer_content, followup_questions = followup_parser.feed(content)
+                if answer_content:
+                    event["choices"][0]["delta"]["content"] = answer_content
+                    yield event
+                elif not content and not followup_parser.started:
                     yield event
-        if followup_content:
-            _, followup_questions = self.extract_followup_questions(followup_content)
+                if followup_questions:
+                    # The frontend replaces the context keys of earlier events, so send all the questions so far
+                    yield self.make_followup_questions_event(followup_parser.questions)
+        if followup_parser and (remaining_content := followup_parser.flush()):
             yield {
-                "choices": [
-                    {
-                        "delta": {"role": self.ASSISTANT},
-                        "context": {"followup_questions": followup_questions},
-                        "finish_reason": None,
-                        "index": 0,
-                    }
-                ],
+                "choices": [{"delta": {"content": remaining_content}, "finish_reason": None, "index": 0}],
                 "object": "chat.completion.chunk",
             }
 
+    def make_followup_questions_event(self, followup_questions: list[str]) -> dict[str, Any]:
+        return {
+            "choices": [
+                {
+                    "delta": {"role": self.ASSISTANT},
+                    "context": {"followup_questions": list(followup_questions)},
+                    "finish_reason": None,
+                    "index": 0,
+                }
+            ],
+            "object": "chat.completion.chunk",
+        }
+
     async def run(
         self, messages: list[dict], stream: bool = False, session_state: Any = None, context: dict[str, Any] = {}
     ) -> Union[dict[str, Any], AsyncGenerator[dict[str, Any], None]]:
@@ -1,3 +1,6 @@
+import asyncio
+import logging
+from array import array
 from typing import Any, Coroutine, Literal, Optional, Union, overload
 
 from azure.search.documents.aio import SearchClient
@@ -8,10 +11,13 @@ from openai.types.chat import (
     ChatCompletionChunk,
 )
 
-from approaches.approach import ThoughtStep
+from approaches.approach import Document, ThoughtStep
 from approaches.chatapproach import ChatApproach
 from core.authentication import AuthenticationHelper
+from core.cache import LRUCache
 from core.modelhelper import get_token_limit
+from core.queryhelper import is_self_contained, query_similarity
+from core.searchcache import SearchCache
 
 
 class ChatReadRetrieveReadApproach(ChatApproach):
@@ -22,6 +28,10 @@ class ChatReadRetrieveReadApproach(ChatApproach):
     original user question, and search results to OpenAI to generate a response.
     """
 
+    # Minimum similarity between the generated search query and the user's question
+    # for the speculative search results to be used in place of a search with the generated query
+    speculative_retrieval_min_similarity = 0.8
+
     def __init__(
         self,
         *,
@@ -36,6 +46,15 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         content_field: str,
         query_language: str,
         query_speller: str,
+        embedding_cache: Optional[LRUCache["array[float]"]] = None,
+        search_cache: Optional[SearchCache[list[Document]]] = None,
+        speculative_retrieval: bool = False,
+        skip_query_rewrite: str = "never",
+        query_rewrite_model: Optional[str] = None,
+        query_rewrite_deployment: Optional[str] = None,  # Not needed for non-Azure OpenAI
+        project_search_fields: bool = False,
+        sources_token_limit: Optional[int] = None,
+        deduplicate_sources: bool = False,
     ):
         self.search_client = search_client
         self.openai_client = openai_client
@@ -48,7 +67,20 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         self.content_field = content_field
         self.query_language = query_language
         self.query_speller = query_speller
+        self.embedding_cache = embedding_cache
+        self.search_cache = search_cache
+        self.speculative_retrieval = speculative_retrieval
+        # When to search with the user's question instead of generating a search query:
+        # "never", "first_turn" or "self_contained" (first turn or a follow-up that doesn't refer to earlier messages)
+        self.skip_query_rewrite = skip_query_rewrite
         self.chatgpt_token_limit = get_token_limit(chatgpt_model)
+        # The search query can be generated by a smaller, faster model than the answer
+        self.query_rewrite_model = query_rewrite_model or chatgpt_model
+        self.query_rewrite_deployment = query_rewrite_deployment if query_rewrite_model else chatgpt_deployment
+        self.query_rewrite_token_limit = get_token_limit(self.query_rewrite_model)
+        self.project_search_fields = project_search_fields
+        self.sources_token_limit = sources_token_limit
+        self.deduplicate_sources = deduplicate_sources
 
     @property
     def system_message_chat_conversation(self):
@@ -115,44 +147,79 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         ]
 
         # STEP 1: Generate an optimized keyword search query based on the chat history and the last question
-        messages = self.get_messages_from_history(
-            system_prompt=self.query_prompt_template,
-            model_id=self.chatgpt_model,
-            history=history,
-            user_content=user_query_request,
-            max_tokens=self.chatgpt_token_limit - len(user_query_request),
-            few_shots=self.query_prompt_few_shots,
-        )
+        query_rewrite = self.get_query_rewrite_decision(history)
+        speculative_search: Optional[asyncio.Future[list[Document]]] = None
+        query_text: Optional[str]
+        if query_rewrite != "generated":
+            query_text = original_user_query
+        else:
+            messages = self.get_messages_from_history(
+                system_prompt=self.query_prompt_template,
+                model_id=self.query_rewrite_model,
+                history=history,
+                user_content=user_query_request,
+                max_tokens=self.query_rewrite_token_limit - len(user_query_request),
+                few_shots=self.query_prompt_few_shots,
+            )
 
-        chat_completion: ChatCompletion = await self.openai_client.chat.completions.create(
-            messages=messages,  # type: ignore
-            # Azure Open AI takes the deployment name as the model name
-            model=self.chatgpt_deployment if self.chatgpt_deployment else self.chatgpt_model,
-            temperature=0.0,
-            max_tokens=100,  # Setting too low risks malformed JSON, setting too high may affect performance
-            n=1,
-            functions=functions,
-            function_call="auto",
-        )
+            # Speculatively search with the user's question while the search query is generated,
+            # as it often generates the same terms for a self-contained question
+            if self.speculative_retrieval:
+                speculative_search = asyncio.ensure_future(
+                    self.retrieve(
+                        original_user_query,
+                        has_text,
+                        has_vector,
+                        top,
+                        filter,
+                        use_semantic_ranker,
+                        use_semantic_captions,
+                    )
+                )
+                # Mark a failure as retrieved, as the results may be discarded without being awaited
+                speculative_search.add_done_callback(lambda done: done.cancelled() or done.exception())
 
-        query_text = self.get_search_query(chat_completion, original_user_query)
+            try:
+                chat_completion: ChatCompletion = await self.openai_client.chat.completions.create(
+                    messages=messages,  # type: ignore
+                    # Azure Open AI takes the deployment name as the model name
+                    model=self.query_rewrite_deployment if self.query_rewrite_deployment else self.query_rewrite_model,
+                    temperature=0.0,
+                    max_tokens=100,  # Setting too low risks malformed JSON, setting too high may affect performance
+                    n=1,
+                    functions=functions,
+                    function_call="auto",
+                )
+            except BaseException:
+                if speculative_search:
+                    speculative_search.cancel()
+                raise
 
-        # STEP 2: Retrieve relevant documents from the search index with the GPT optimized query
+            query_text = self.get_search_query(chat_completion, original_user_query)
 
-        # If retrieval mode includes vectors, compute an embedding for the query
-        vectors: list[VectorQuery] = []
-        if has_vector:
-            vectors.append(await self.compute_text_embedding(query_text))
+        # STEP 2: Retrieve relevant documents from the search index with the GPT optimized query
+        search_thought_props: dict[str, Any] = {
+            "use_semantic_captions": use_semantic_captions,
+            "has_vector": has_vector,
+        }
+        if self.skip_query_rewrite != "never":
+            search_thought_props["query_rewrite"] = query_rewrite
+        results: Optional[list[Document]] = None
+        if speculative_search:
+            results = await self.get_speculative_results(speculative_search, query_text, original_user_query)
+            search_thought_props["speculative_retrieval"] = results is not None
+            if results is not None:
+                # The results come from a search with the user's question, not the generated query
+                search_thought_props["searched_query"] = original_user_query
+        if results is None:
+            results = await self.retrieve(
+                query_text, has_text, has_vector, top, filter, use_semantic_ranker, use_semantic_captions
+            )
 
         # Only keep the text query if the retrieval mode uses text, otherwise drop it
         if not has_text:
             query_text = None
 
-        results = await self.search(top, query_text, filter, vectors, use_semantic_ranker, use_semantic_captions)
-
-        sources_content = self.get_sources_content(results, use_semantic_captions, use_image_citation=False)
-        content = "\n".join(sources_content)
-
         # STEP 3: Generate a contextual and content specific answer using the search results and chat history
 
         # Allow client to replace the entire prompt, or to inject into the exiting prompt using >>>
@@ -163,6 +230,16 @@ class ChatReadRetrieveReadApproach(ChatApproach):
 
         response_token_limit = 1024
         messages_token_limit = self.chatgpt_token_limit - response_token_limit
+        sources_token_limit = self.get_sources_token_limit(
+            system_message, self.chatgpt_model, history, original_user_query + "\n\nSources:\n", messages_token_limit
+        )
+        sources_content, deduplicated_token_count = self.remove_duplicate_sources(
+            self.get_sources_content(results, use_semantic_captions, use_image_citation=False), self.chatgpt_model
+        )
+        if self.deduplicate_sources:
+            search_thought_props["deduplicated_tokens"] = deduplicated_token_count
+        sources_content = self.pack_sources(sources_content, sources_token_limit, self.chatgpt_model)
+        content = "\n".join(sources_content)
         messages = self.get_messages_from_history(
             system_prompt=system_message,
             model_id=self.chatgpt_model,
@@ -184,7 +261,7 @@ class ChatReadRetrieveReadApproach(ChatApproach):
                 ThoughtStep(
                     "Generated search query",
                     query_text,
-                    {"use_semantic_captions": use_semantic_captions, "has_vector": has_vector},
+                    search_thought_props,
                 ),
                 ThoughtStep("Results", [result.serialize_for_results() for result in results]),
                 ThoughtStep("Prompt", [str(message) for message in messages]),
@@ -201,3 +278,51 @@ class ChatReadRetrieveReadApproach(ChatApproach):
             stream=should_stream,
         )
         return (extra_info, chat_coroutine)
+
+    def get_query_rewrite_decision(self, history: list[dict[str, str]]) -> str:
+        """
+        Returns "generated" if a search query should be generated from the conversation,
+        otherwise the reason for searching with the user's question as is.
+        """
+        if self.skip_query_rewrite == "never":
+            return "generated"
+        if len(history) == 1:
+            return "skipped_first_turn"
+        if self.skip_query_rewrite == "self_contained" and is_self_contained(history[-1]["content"]):
+            return "skipped_self_contained"
+        return "generated"
+
+    async def retrieve(
+        self,
+        query_text: str,
+        has_text: bool,
+        has_vector: bool,
+        top: int,
+        filter: Optional[str],
+        use_semantic_ranker: bool,
+        use_semantic_captions: bool,
+    ) -> list[Document]:
+        # If retrieval mode includes vectors, compute an embedding for the query
+        vectors: list[VectorQuery] = []
+        if has_vector:
+            vectors.append(await self.compute_text_embedding(query_text))
+
+        return await self.search(
+            top, query_text if has_text else None, filter, vectors, use_semantic_ranker, use_semantic_captions
+        )
+
+    async def get_speculative_results(
+        self, speculative_search: "asyncio.Future[list[Document]]", query_text: str, original_user_query: str
+    ) -> Optional[list[Document]]:
+        """
+        Returns the results of the speculative search if the generated query is close enough to the user's question,
+        otherwise cancels it and returns None.
+        """
+        if query_similarity(query_text, original_user_query) < self.speculative_retrieval_min_similarity:
+            speculative_search.cancel()
+            return None
+        try:
+            return await speculative_search
+        except Exception as error:
+            logging.warning("Speculative search failed, searching with the generated query: %s", error)
+            return None
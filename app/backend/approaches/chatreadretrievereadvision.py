@@ -1,6 +1,8 @@
+from array import array
 from typing import Any, Coroutine, Optional, Union
 
 from azure.search.documents.aio import SearchClient
+from azure.search.documents.models import VectorQuery
 from azure.storage.blob.aio import ContainerClient
 from openai import AsyncOpenAI, AsyncStream
 from openai.types.chat import (
@@ -10,11 +12,14 @@ from openai.types.chat import (
     ChatCompletionContentPartParam,
 )
 
-from approaches.approach import ThoughtStep
+from approaches.approach import Document, ThoughtStep
 from approaches.chatapproach import ChatApproach
 from core.authentication import AuthenticationHelper
-from core.imageshelper import fetch_image
+from core.cache import LRUCache
+from core.httpsessions import HTTPSessionRegistry
+from core.imageshelper import fetch_images
 from core.modelhelper import get_token_limit
+from core.searchcache import SearchCache
 
 
 class ChatReadRetrieveReadVisionApproach(ChatApproach):
@@ -42,6 +47,16 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
         query_speller: str,
         vision_endpoint: str,
         vision_key: str,
+        embedding_cache: Optional[LRUCache["array[float]"]] = None,
+        search_cache: Optional[SearchCache[list[Document]]] = None,
+        embedding_timeout: Optional[float] = None,
+        image_cache: Optional[LRUCache[tuple[str, str]]] = None,
+        http_sessions: Optional[HTTPSessionRegistry] = None,
+        query_rewrite_model: Optional[str] = None,
+        query_rewrite_deployment: Optional[str] = None,  # Not needed for non-Azure OpenAI
+        project_search_fields: bool = False,
+        sources_token_limit: Optional[int] = None,
+        deduplicate_sources: bool = False,
     ):
         self.search_client = search_client
         self.blob_container_client = blob_container_client
@@ -57,7 +72,19 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
         self.query_speller = query_speller
         self.vision_endpoint = vision_endpoint
         self.vision_key = vision_key
+        self.embedding_cache = embedding_cache
+        self.search_cache = search_cache
+        self.embedding_timeout = embedding_timeout
+        self.image_cache = image_cache
+        self.http_sessions = http_sessions
         self.chatgpt_token_limit = get_token_limit(gpt4v_model)
+        # The search query can be generated by a smaller, faster model than the answer
+        self.query_rewrite_model = query_rewrite_model or gpt4v_model
+        self.query_rewrite_deployment = query_rewrite_deployment if query_rewrite_model else gpt4v_deployment
+        self.query_rewrite_token_limit = get_token_limit(self.query_rewrite_model)
+        self.project_search_fields = project_search_fields
+        self.sources_token_limit = sources_token_limit
+        self.deduplicate_sources = deduplicate_sources
 
     @property
     def system_message_chat_conversation(self):
@@ -101,15 +128,15 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
 
         messages = self.get_messages_from_history(
             system_prompt=self.query_prompt_template,
-            model_id=self.gpt4v_model,
+            model_id=self.query_rewrite_model,
             history=history,
             user_content=user_query_request,
-            max_tokens=self.chatgpt_token_limit - len(" ".join(user_query_request)),
+            max_tokens=self.query_rewrite_token_limit - len(" ".join(user_query_request)),
             few_shots=self.query_prompt_few_shots,
         )
 
         chat_completion: ChatCompletion = await self.openai_client.chat.completions.create(
-            model=self.gpt4v_deployment if self.gpt4v_deployment else self.gpt4v_model,
+            model=self.query_rewrite_deployment if self.query_rewrite_deployment else self.query_rewrite_model,
             messages=messages,
             temperature=overrides.get("temperature") or 0.0,
             max_tokens=100,
@@ -121,23 +148,18 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
         # STEP 2: Retrieve relevant documents from the search index with the GPT optimized query
 
         # If retrieval mode includes vectors, compute an embedding for the query
-        vectors = []
+        vectors: list[VectorQuery] = []
+        skipped_vector_fields: list[str] = []
         if has_vector:
-            for field in vector_fields:
-                vector = (
-                    await self.compute_text_embedding(query_text)
-                    if field == "embedding"
-                    else await self.compute_image_embedding(query_text, self.vision_endpoint, self.vision_key)
-                )
-                vectors.append(vector)
+            vectors, skipped_vector_fields = await self.compute_vectors(
+                query_text, vector_fields, self.vision_endpoint, self.vision_key
+            )
 
         # Only keep the text query if the retrieval mode uses text, otherwise drop it
         if not has_text:
             query_text = None
 
         results = await self.search(top, query_text, filter, vectors, use_semantic_ranker, use_semantic_captions)
-        sources_content = self.get_sources_content(results, use_semantic_captions, use_image_citation=True)
-        content = "\n".join(sources_content)
 
         # STEP 3: Generate a contextual and content specific answer using the search results and chat history
 
@@ -149,6 +171,15 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
 
         response_token_limit = 1024
         messages_token_limit = self.chatgpt_token_limit - response_token_limit
+        # The tokens of the images are not counted, see MessageBuilder.count_tokens_for_messages
+        sources_token_limit = self.get_sources_token_limit(
+            system_message, self.gpt4v_model, history, original_user_query + "\n\nSources:\n", messages_token_limit
+        )
+        sources_content, deduplicated_token_count = self.remove_duplicate_sources(
+            self.get_sources_content(results, use_semantic_captions, use_image_citation=True), self.gpt4v_model
+        )
+        sources_content = self.pack_sources(sources_content, sources_token_limit, self.gpt4v_model)
+        content = "\n".join(sources_content)
 
         user_content: list[ChatCompletionContentPartParam] = [{"text": original_user_query, "type": "text"}]
         image_list: list[ChatCompletionContentPartImageParam] = []
@@ -156,10 +187,8 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
         if include_gtpV_text:
             user_content.append({"text": "\n\nSources:\n" + content, "type": "text"})
         if include_gtpV_images:
-            for result in results:
-                url = await fetch_image(self.blob_container_client, result)
-                if url:
-                    image_list.append({"image_url": url, "type": "image_url"})
+            for url in await fetch_images(self.blob_container_client, results, self.image_cache):
+                image_list.append({"image_url": url, "type": "image_url"})
             user_content.extend(image_list)
 
         messages = self.get_messages_from_history(
@@ -170,6 +199,12 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
             max_tokens=messages_token_limit,
         )
 
+        search_props: dict[str, Any] = {"use_semantic_captions": use_semantic_captions, "vector_fields": vector_fields}
+        if skipped_vector_fields:
+            search_props["skipped_vector_fields"] = skipped_vector_fields
+        if self.deduplicate_sources:
+            search_props["deduplicated_tokens"] = deduplicated_token_count
+
         data_points = {
             "text": sources_content,
             "images": [d["image_url"] for d in image_list],
@@ -185,7 +220,7 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
                 ThoughtStep(
                     "Generated search query",
                     query_text,
-                    {"use_semantic_captions": use_semantic_captions, "vector_fields": vector_fields},
+                    search_props,
                 ),
                 ThoughtStep("Results", [result.serialize_for_results() for result in results]),
                 ThoughtStep("Prompt", [str(message) for message in messages]),
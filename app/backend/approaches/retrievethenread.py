@@ -1,13 +1,17 @@
 import os
+from array import array
 from typing import Any, AsyncGenerator, Optional, Union
 
 from azure.search.documents.aio import SearchClient
 from azure.search.documents.models import VectorQuery
 from openai import AsyncOpenAI
 
-from approaches.approach import Approach, ThoughtStep
+from approaches.approach import Approach, Document, ThoughtStep
 from core.authentication import AuthenticationHelper
+from core.cache import LRUCache
 from core.messagebuilder import MessageBuilder
+from core.modelhelper import get_token_limit
+from core.searchcache import SearchCache
 
 # Replace these with your own values, either in environment variables or directly here
 AZURE_STORAGE_ACCOUNT = os.getenv("AZURE_STORAGE_ACCOUNT")
@@ -56,6 +60,11 @@ info4.pdf: In-network institutions include Overlake, Swedish and others in the r
         content_field: str,
         query_language: str,
         query_speller: str,
+        embedding_cache: Optional[LRUCache["array[float]"]] = None,
+        search_cache: Optional[SearchCache[list[Document]]] = None,
+        project_search_fields: bool = False,
+        sources_token_limit: Optional[int] = None,
+        deduplicate_sources: bool = False,
     ):
         self.search_client = search_client
         self.chatgpt_deployment = chatgpt_deployment
@@ -69,6 +78,12 @@ info4.pdf: In-network institutions include Overlake, Swedish and others in the r
         self.content_field = content_field
         self.query_language = query_language
         self.query_speller = query_speller
+        self.embedding_cache = embedding_cache
+        self.search_cache = search_cache
+        self.project_search_fields = project_search_fields
+        self.sources_token_limit = sources_token_limit
+        self.deduplicate_sources = deduplicate_sources
+        self.chatgpt_token_limit = get_token_limit(chatgpt_model)
 
     async def run(
         self,
@@ -97,21 +112,29 @@ info4.pdf: In-network institutions include Overlake, Swedish and others in the r
 
         results = await self.search(top, query_text, filter, vectors, use_semantic_ranker, use_semantic_captions)
 
-        user_content = [q]
-
         template = overrides.get("prompt_template") or self.system_chat_template
         model = self.chatgpt_model
         message_builder = MessageBuilder(template, model)
 
         # Process results
-        sources_content = self.get_sources_content(results, use_semantic_captions, use_image_citation=False)
+        message_builder.insert_message("user", q + "\n" + "Sources:\n ")
+        message_builder.insert_message("assistant", self.answer)
+        message_builder.insert_message("user", self.question)
+        # Fill the tokens left by the prompt without its sources
+        response_token_limit = 1024
+        sources_token_limit = (
+            self.chatgpt_token_limit
+            - response_token_limit
+            - sum(message_builder.count_tokens_for_messages(message_builder.messages))  # type: ignore
+        )
+        sources_content, deduplicated_token_count = self.remove_duplicate_sources(
+            self.get_sources_content(results, use_semantic_captions, use_image_citation=False), model
+        )
+        sources_content = self.pack_sources(sources_content, sources_token_limit, model)
 
         # Append user message
         content = "\n".join(sources_content)
-        user_content = q + "\n" + f"Sources:\n {content}"
-        message_builder.insert_message("user", user_content)
-        message_builder.insert_message("assistant", self.answer)
-        message_builder.insert_message("user", self.question)
+        message_builder.messages[-1] = message_builder.make_message("user", q + "\n" + f"Sources:\n {content}")
 
         chat_completion = (
             await self.openai_client.chat.completions.create(
@@ -119,11 +142,15 @@ info4.pdf: In-network institutions include Overlake, Swedish and others in the r
                 model=self.chatgpt_deployment if self.chatgpt_deployment else self.chatgpt_model,
                 messages=message_builder.messages,
                 temperature=overrides.get("temperature") or 0.3,
-                max_tokens=1024,
+                max_tokens=response_token_limit,
                 n=1,
             )
         ).model_dump()
 
+        search_props: dict[str, Any] = {"use_semantic_captions": use_semantic_captions}
+        if self.deduplicate_sources:
+            search_props["deduplicated_tokens"] = deduplicated_token_count
+
         data_points = {"text": sources_content}
         extra_info = {
             "data_points": data_points,
@@ -131,9 +158,7 @@ info4.pdf: In-network institutions include Overlake, Swedish and others in the r
                 ThoughtStep(
                     "Search Query",
                     query_text,
-                    {
-                        "use_semantic_captions": use_semantic_captions,
-                    },
+                    search_props,
                 ),
                 ThoughtStep("Results", [result.serialize_for_results() for result in results]),
                 ThoughtStep("Prompt", [str(message) for message in message_builder.messages]),
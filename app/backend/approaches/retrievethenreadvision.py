@@ -1,7 +1,9 @@
 import os
+from array import array
 from typing import Any, AsyncGenerator, Optional, Union
 
 from azure.search.documents.aio import SearchClient
+from azure.search.documents.models import VectorQuery
 from azure.storage.blob.aio import ContainerClient
 from openai import AsyncOpenAI
 from openai.types.chat import (
@@ -9,10 +11,14 @@ from openai.types.chat import (
     ChatCompletionContentPartParam,
 )
 
-from approaches.approach import Approach, ThoughtStep
+from approaches.approach import Approach, Document, ThoughtStep
 from core.authentication import AuthenticationHelper
-from core.imageshelper import fetch_image
+from core.cache import LRUCache
+from core.httpsessions import HTTPSessionRegistry
+from core.imageshelper import fetch_images
 from core.messagebuilder import MessageBuilder
+from core.modelhelper import get_token_limit
+from core.searchcache import SearchCache
 
 # Replace these with your own values, either in environment variables or directly here
 AZURE_STORAGE_ACCOUNT = os.getenv("AZURE_STORAGE_ACCOUNT")
@@ -54,6 +60,14 @@ class RetrieveThenReadVisionApproach(Approach):
         query_speller: str,
         vision_endpoint: str,
         vision_key: str,
+        embedding_cache: Optional[LRUCache["array[float]"]] = None,
+        search_cache: Optional[SearchCache[list[Document]]] = None,
+        embedding_timeout: Optional[float] = None,
+        image_cache: Optional[LRUCache[tuple[str, str]]] = None,
+        http_sessions: Optional[HTTPSessionRegistry] = None,
+        project_search_fields: bool = False,
+        sources_token_limit: Optional[int] = None,
+        deduplicate_sources: bool = False,
     ):
         self.search_client = search_client
         self.blob_container_client = blob_container_client
@@ -69,6 +83,15 @@ class RetrieveThenReadVisionApproach(Approach):
         self.query_speller = query_speller
         self.vision_endpoint = vision_endpoint
         self.vision_key = vision_key
+        self.embedding_cache = embedding_cache
+        self.search_cache = search_cache
+        self.embedding_timeout = embedding_timeout
+        self.image_cache = image_cache
+        self.http_sessions = http_sessions
+        self.gpt4v_token_limit = get_token_limit(gpt4v_model)
+        self.project_search_fields = project_search_fields
+        self.sources_token_limit = sources_token_limit
+        self.deduplicate_sources = deduplicate_sources
 
     async def run(
         self,
@@ -94,15 +117,12 @@ class RetrieveThenReadVisionApproach(Approach):
 
         # If retrieval mode includes vectors, compute an embedding for the query
 
-        vectors = []
+        vectors: list[VectorQuery] = []
+        skipped_vector_fields: list[str] = []
         if has_vector:
-            for field in vector_fields:
-                vector = (
-                    await self.compute_text_embedding(q)
-                    if field == "embedding"
-                    else await self.compute_image_embedding(q, self.vision_endpoint, self.vision_key)
-                )
-                vectors.append(vector)
+            vectors, skipped_vector_fields = await self.compute_vectors(
+                q, vector_fields, self.vision_endpoint, self.vision_key
+            )
 
         # Only keep the text query if the retrieval mode uses text, otherwise drop it
         query_text = q if has_text else None
@@ -117,17 +137,28 @@ class RetrieveThenReadVisionApproach(Approach):
         message_builder = MessageBuilder(template, model)
 
         # Process results
-
-        sources_content = self.get_sources_content(results, use_semantic_captions, use_image_citation=True)
+        # Fill the tokens left by the prompt without its sources, the tokens of the images are not counted
+        response_token_limit = 1024
+        sources_token_limit = (
+            self.gpt4v_token_limit
+            - response_token_limit
+            - sum(
+                message_builder.count_tokens_for_messages(
+                    [message_builder.messages[0], message_builder.make_message("user", q)]  # type: ignore
+                )
+            )
+        )
+        sources_content, deduplicated_token_count = self.remove_duplicate_sources(
+            self.get_sources_content(results, use_semantic_captions, use_image_citation=True), model
+        )
+        sources_content = self.pack_sources(sources_content, sources_token_limit, model)
 
         if include_gtpV_text:
             content = "\n".join(sources_content)
             user_content.append({"text": content, "type": "text"})
         if include_gtpV_images:
-            for result in results:
-                url = await fetch_image(self.blob_container_client, result)
-                if url:
-                    image_list.append({"image_url": url, "type": "image_url"})
+            for url in await fetch_images(self.blob_container_client, results, self.image_cache):
+                image_list.append({"image_url": url, "type": "image_url"})
             user_content.extend(image_list)
 
         # Append user message
@@ -138,11 +169,17 @@ class RetrieveThenReadVisionApproach(Approach):
                 model=self.gpt4v_deployment if self.gpt4v_deployment else self.gpt4v_model,
                 messages=message_builder.messages,
                 temperature=overrides.get("temperature") or 0.3,
-                max_tokens=1024,
+                max_tokens=response_token_limit,
                 n=1,
             )
         ).model_dump()
 
+        search_props: dict[str, Any] = {"use_semantic_captions": use_semantic_captions, "vector_fields": vector_fields}
+        if skipped_vector_fields:
+            search_props["skipped_vector_fields"] = skipped_vector_fields
+        if self.deduplicate_sources:
+            search_props["deduplicated_tokens"] = deduplicated_token_count
+
         data_points = {
             "text": sources_content,
             "images": [d["image_url"] for d in image_list],
@@ -154,7 +191,7 @@ class RetrieveThenReadVisionApproach(Approach):
                 ThoughtStep(
                     "Search Query",
                     query_text,
-                    {"use_semantic_captions": use_semantic_captions, "vector_fields": vector_fields},
+                    search_props,
                 ),
                 ThoughtStep("Results", [result.serialize_for_results() for result in results]),
                 ThoughtStep("Prompt", [str(message) for message in message_builder.messages]),
@@ -1,14 +1,23 @@
 # Refactored from https://github.com/Azure-Samples/ms-identity-python-on-behalf-of
 
+import asyncio
+import base64
+import hashlib
 import json
 import logging
-from typing import Any, Optional
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Awaitable, Callable, Optional
 
 import aiohttp
 from azure.search.documents.indexes.models import SearchIndex
 from msal import ConfidentialClientApplication
 from msal.token_cache import TokenCache
 
+from core.cache import LRUCache
+from core.httpsessions import HTTPSessionRegistry
+
 
 # AuthError is raised when the authentication token sent by the client UI cannot be parsed or there is an authentication error accessing the graph API
 class AuthError(Exception):
@@ -22,6 +31,7 @@ class AuthError(Exception):
 
 class AuthenticationHelper:
     scope: str = "https://graph.microsoft.com/.default"
+    groups_max_staleness: float = 3600
 
     def __init__(
         self,
@@ -32,6 +42,11 @@ class AuthenticationHelper:
         client_app_id: Optional[str],
         tenant_id: Optional[str],
         require_access_control: bool = False,
+        claims_cache_size: int = 1000,
+        claims_cache_ttl: float = 3600,
+        token_exchange_workers: int = 4,
+        groups_cache_ttl: float = 300,
+        http_sessions: Optional[HTTPSessionRegistry] = None,
     ):
         self.use_authentication = use_authentication
         self.server_app_id = server_app_id
@@ -47,9 +62,26 @@ class AuthenticationHelper:
             self.confidential_client = ConfidentialClientApplication(
                 server_app_id, authority=self.authority, client_credential=server_app_secret, token_cache=TokenCache()
             )
+            # MSAL is synchronous, so the On Behalf Of exchange runs on a few dedicated threads instead of the event loop
+            self.token_exchange_executor: Optional[ThreadPoolExecutor] = ThreadPoolExecutor(
+                max_workers=token_exchange_workers, thread_name_prefix="obo"
+            )
         else:
             self.has_auth_fields = False
             self.require_access_control = False
+            self.token_exchange_executor = None
+        # Auth claims keyed by a hash of the access token, each kept until the token expires at the latest
+        self.claims_cache: LRUCache[dict[str, Any]] = LRUCache(claims_cache_size, ttl=claims_cache_ttl)
+        # Group memberships read from Microsoft Graph keyed by oid, with the time they were read.
+        # They are refreshed in the background once older than groups_cache_ttl, and dropped after an hour.
+        self.groups_cache_ttl = groups_cache_ttl
+        self.groups_cache: LRUCache[tuple[float, list[str]]] = LRUCache(
+            claims_cache_size, ttl=max(groups_cache_ttl, AuthenticationHelper.groups_max_staleness)
+        )
+        self.groups_refreshes: dict[str, asyncio.Future] = {}
+        # Sessions created for this helper alone are closed with it, shared ones are closed by their owner
+        self.owns_http_sessions = http_sessions is None
+        self.http_sessions = http_sessions or HTTPSessionRegistry()
 
     def get_auth_setup_for_client(self) -> dict[str, Any]:
         # returns MSAL.js settings used by the client app
@@ -109,6 +141,16 @@ class AuthenticationHelper:
 
         raise AuthError(error="Authorization header is expected", status_code=401)
 
+    @staticmethod
+    def get_token_expiry(token: str) -> Optional[float]:
+        # Reads the exp claim of a JWT without validating it, the token is validated by the On Behalf Of exchange
+        try:
+            payload = token.split(".")[1]
+            claims = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+            return float(claims["exp"])
+        except (IndexError, KeyError, TypeError, ValueError):
+            return None
+
     def build_security_filters(self, overrides: dict[str, Any], auth_claims: dict[str, Any]):
         # Build different permutations of the oid or groups security filter using OData filters
         # https://learn.microsoft.com/azure/search/search-security-trimming-for-azure-search
@@ -143,34 +185,75 @@ class AuthenticationHelper:
             return None
 
     @staticmethod
-    async def list_groups(graph_resource_access_token: dict) -> list[str]:
+    async def list_groups(
+        graph_resource_access_token: dict, session: Optional[aiohttp.ClientSession] = None
+    ) -> list[str]:
+        if session is None:
+            async with aiohttp.ClientSession() as session:
+                return await AuthenticationHelper.list_groups(graph_resource_access_token, session)
+
+        # The session may be shared, so the token is sent with each request rather than set on the session
         headers = {"Authorization": "Bearer " + graph_resource_access_token["access_token"]}
         groups = []
-        async with aiohttp.ClientSession(headers=headers) as session:
-            resp_json = None
-            resp_status = None
-            async with session.get(url="https://graph.microsoft.com/v1.0/me/transitiveMemberOf?$select=id") as resp:
-                resp_json = await resp.json()
-                resp_status = resp.status
-                if resp_status != 200:
-                    raise AuthError(error=json.dumps(resp_json), status_code=resp_status)
-
-            while resp_status == 200:
-                value = resp_json["value"]
-                for group in value:
-                    groups.append(group["id"])
-                next_link = resp_json.get("@odata.nextLink")
-                if next_link:
-                    async with session.get(url=next_link) as resp:
-                        resp_json = await resp.json()
-                        resp_status = resp.status
-                else:
-                    break
+        resp_json = None
+        resp_status = None
+        # Each nextLink carries an opaque skip token, so pages can only be read one after the other.
+        # Asking for the largest page size keeps the number of round trips down.
+        async with session.get(
+            url="https://graph.microsoft.com/v1.0/me/transitiveMemberOf?$select=id&$top=999", headers=headers
+        ) as resp:
+            resp_json = await resp.json()
+            resp_status = resp.status
             if resp_status != 200:
                 raise AuthError(error=json.dumps(resp_json), status_code=resp_status)
 
+        while resp_status == 200:
+            value = resp_json["value"]
+            for group in value:
+                groups.append(group["id"])
+            next_link = resp_json.get("@odata.nextLink")
+            if next_link:
+                async with session.get(url=next_link, headers=headers) as resp:
+                    resp_json = await resp.json()
+                    resp_status = resp.status
+            else:
+                break
+        if resp_status != 200:
+            raise AuthError(error=json.dumps(resp_json), status_code=resp_status)
+
         return groups
 
+    async def get_groups(self, oid: str, graph_resource_access_token: dict) -> list[str]:
+        """
+        Returns the groups of the user, from the cache when possible.
+        A stale entry is still returned, and refreshed in the background for the next requests.
+        """
+
+        async def load_groups() -> tuple[float, list[str]]:
+            groups = await AuthenticationHelper.list_groups(graph_resource_access_token, self.http_sessions.get())
+            return time.monotonic(), groups
+
+        read_at, groups = await self.groups_cache.get_or_load(oid, load_groups)
+        if time.monotonic() - read_at > self.groups_cache_ttl and oid not in self.groups_refreshes:
+            refresh = asyncio.ensure_future(self.refresh_groups(oid, load_groups))
+            self.groups_refreshes[oid] = refresh
+            refresh.add_done_callback(lambda done: self.groups_refreshes.pop(oid, None))
+        return groups
+
+    async def refresh_groups(self, oid: str, load_groups: Callable[[], Awaitable[tuple[float, list[str]]]]):
+        try:
+            self.groups_cache.put(oid, await load_groups())
+        except Exception:
+            logging.exception("Exception refreshing the groups of %s, keeping the cached groups", oid)
+
+    async def close(self):
+        if self.token_exchange_executor:
+            self.token_exchange_executor.shutdown(wait=False)
+        for refresh in list(self.groups_refreshes.values()):
+            refresh.cancel()
+        if self.owns_http_sessions:
+            await self.http_sessions.close()
+
     async def get_auth_claims_if_enabled(self, headers: dict) -> dict[str, Any]:
         if not self.use_authentication:
             return {}
@@ -179,8 +262,16 @@ class AuthenticationHelper:
             # The scope is set to the Microsoft Graph API, which may need to be called for more authorization information
             # https://learn.microsoft.com/en-us/azure/active-directory/develop/v2-oauth2-on-behalf-of-flow
             auth_token = AuthenticationHelper.get_token_auth_header(headers)
-            graph_resource_access_token = self.confidential_client.acquire_token_on_behalf_of(
-                user_assertion=auth_token, scopes=["https://graph.microsoft.com/.default"]
+            token_hash = hashlib.sha256(auth_token.encode()).hexdigest()
+            if cached_auth_claims := self.claims_cache.get(token_hash):
+                return dict(cached_auth_claims)
+            graph_resource_access_token = await asyncio.get_running_loop().run_in_executor(
+                self.token_exchange_executor,
+                partial(
+                    self.confidential_client.acquire_token_on_behalf_of,
+                    user_assertion=auth_token,
+                    scopes=["https://graph.microsoft.com/.default"],
+                ),
             )
             if "error" in graph_resource_access_token:
                 raise AuthError(error=str(graph_resource_access_token), status_code=401)
@@ -201,7 +292,12 @@ class AuthenticationHelper:
             )
             if missing_groups_claim or has_group_overage_claim:
                 # Read the user's groups from Microsoft Graph
-                auth_claims["groups"] = await AuthenticationHelper.list_groups(graph_resource_access_token)
+                auth_claims["groups"] = await self.get_groups(id_token_claims["oid"], graph_resource_access_token)
+
+            # Tokens without a readable expiry are exchanged every time
+            if expires_at := AuthenticationHelper.get_token_expiry(auth_token):
+                if (ttl := expires_at - time.time()) > 0:
+                    self.claims_cache.put(token_hash, auth_claims, ttl=ttl)
             return auth_claims
         except AuthError as e:
             print(e.error)
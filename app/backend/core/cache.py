@@ -0,0 +1,112 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Generic, Hashable, Optional, TypeVar
+
+V = TypeVar("V")
+
+
+class LRUCache(Generic[V]):
+    """
+    A least recently used cache bounded by the total weight of its values (for example their size in bytes),
+    with an optional time to live for each value.
+    Attributes:
+        max_weight (int): The maximum total weight of the cached values, 0 disables the cache.
+        ttl (float): The number of seconds a value stays valid, or None if values never expire.
+        hits (int): The number of successful lookups.
+        misses (int): The number of failed lookups, including lookups of expired values.
+        evictions (int): The number of values removed to make room for newer ones.
+    """
+
+    def __init__(
+        self,
+        max_weight: int,
+        weigh: Callable[[V], int] = lambda value: 1,
+        on_evict: Optional[Callable[[Hashable, V], None]] = None,
+        ttl: Optional[float] = None,
+    ):
+        self.max_weight = max_weight
+        self.weigh = weigh
+        self.on_evict = on_evict
+        self.ttl = ttl
+        self.weight = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: OrderedDict[Hashable, tuple[V, int, float]] = OrderedDict()
+        self._loading: dict[Hashable, asyncio.Future] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        entry = self._entries.get(key)
+        return entry is not None and entry[2] > time.monotonic()
+
+    def get(self, key: Hashable) -> Optional[V]:
+        entry = self._entries.get(key)
+        if entry is None or entry[2] <= time.monotonic():
+            if entry is not None:
+                self.pop(key)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key: Hashable, value: V, ttl: Optional[float] = None) -> bool:
+        """
+        Stores a value, evicting the least recently used values if needed.
+        The ttl argument shortens the time to live of this value, it can't extend the cache ttl.
+        Returns False if the value is too heavy to ever fit in the cache.
+        """
+        weight = self.weigh(value)
+        if weight > self.max_weight:
+            return False
+        self.pop(key)
+        ttls = [limit for limit in (self.ttl, ttl) if limit is not None]
+        expires_at = time.monotonic() + min(ttls) if ttls else float("inf")
+        self._entries[key] = (value, weight, expires_at)
+        self.weight += weight
+        while self.weight > self.max_weight:
+            evicted_key, (evicted_value, evicted_weight, _) = self._entries.popitem(last=False)
+            self.weight -= evicted_weight
+            self.evictions += 1
+            if self.on_evict:
+                self.on_evict(evicted_key, evicted_value)
+        return True
+
+    async def get_or_load(self, key: Hashable, load: Callable[[], Awaitable[V]]) -> V:
+        """
+        Returns the cached value, or loads and caches it.
+        Concurrent calls for the same key share a single load, and a failed load is not cached.
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+        future = self._loading.get(key)
+        if future is None:
+            future = asyncio.ensure_future(load())
+            self._loading[key] = future
+            future.add_done_callback(lambda done: self._loaded(key, done))
+        # Shield the shared load, so that a cancelled caller doesn't cancel it for the others
+        return await asyncio.shield(future)
+
+    def _loaded(self, key: Hashable, future: asyncio.Future):
+        self._loading.pop(key, None)
+        if not future.cancelled() and future.exception() is None:
+            self.put(key, future.result())
+
+    def pop(self, key: Hashable) -> Optional[V]:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return None
+        self.weight -= entry[1]
+        return entry[0]
+
+    def keys(self) -> list[Hashable]:
+        return list(self._entries.keys())
+
+    def clear(self):
+        self._entries.clear()
+        self.weight = 0
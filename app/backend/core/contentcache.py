@@ -0,0 +1,244 @@
+import asyncio
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+from typing import (
+    IO,
+    Any,
+    AsyncGenerator,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    NamedTuple,
+    Optional,
+)
+
+from .cache import LRUCache
+
+
+def process_exists(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # The process exists, but belongs to another user
+        return True
+    return True
+
+
+class CachedFile(NamedTuple):
+    path: str
+    size: int
+
+
+class CachedContent:
+    """
+    A cache hit, either held in memory or in a file on the local disk.
+    """
+
+    def __init__(self, data: Optional[bytes] = None, file: Optional[IO[bytes]] = None):
+        self.data = data
+        self.file = file
+
+    async def iter_range(self, offset: int, length: int, chunk_size: int) -> AsyncGenerator[bytes, None]:
+        if self.data is not None:
+            for start in range(offset, offset + length, chunk_size):
+                yield self.data[start : min(start + chunk_size, offset + length)]
+            return
+        if self.file is None:
+            return
+        try:
+            await asyncio.to_thread(self.file.seek, offset)
+            remaining = length
+            while remaining > 0:
+                chunk = await asyncio.to_thread(self.file.read, min(chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+        finally:
+            self.file.close()
+
+
+class ContentCache:
+    """
+    A two-tier least recently used cache for the citation files served by /content.
+    Small files are kept in memory, larger files are kept in a size-capped directory on the local disk.
+    Entries are keyed by blob name and ETag, so a re-uploaded blob is never served from a stale entry.
+    Blobs are cached as they are sent whole, or downloaded in the background for the byte range requests
+    of PDF viewers, which never ask for the whole file.
+    """
+
+    DIRECTORY_PREFIX = "content-"
+
+    def __init__(
+        self,
+        max_memory_bytes: int,
+        max_memory_item_bytes: int,
+        max_disk_bytes: int,
+        disk_directory: Optional[str] = None,
+    ):
+        self.max_memory_item_bytes = max_memory_item_bytes
+        self.memory: LRUCache[bytes] = LRUCache(max_memory_bytes, weigh=len)
+        self.disk: LRUCache[CachedFile] = LRUCache(
+            max_disk_bytes, weigh=lambda cached_file: cached_file.size, on_evict=self._remove_file
+        )
+        # Each worker process keeps its own directory, so that workers never evict each other's files
+        self.directory: Optional[str] = None
+        if max_disk_bytes > 0:
+            if not disk_directory:
+                raise ValueError("A disk directory must be set to cache content on the disk")
+            os.makedirs(disk_directory, exist_ok=True)
+            self._remove_stale_directories(disk_directory)
+            self.directory = os.path.join(disk_directory, f"{self.DIRECTORY_PREFIX}{os.getpid()}")
+            # Left behind by an earlier process with the same ID
+            shutil.rmtree(self.directory, ignore_errors=True)
+            os.makedirs(self.directory)
+        self.misses = 0
+        self.etags: dict[str, str] = {}
+        self._fills: dict[tuple[str, str], asyncio.Task] = {}
+
+    @classmethod
+    def _remove_stale_directories(cls, disk_directory: str):
+        """
+        Removes the directories of worker processes that exited without closing their cache,
+        for example when they were killed after a timeout.
+        """
+        # Checking whether a process exists with os.kill is only safe on POSIX
+        if os.name != "posix":
+            return
+        for name in os.listdir(disk_directory):
+            pid = name[len(cls.DIRECTORY_PREFIX) :]
+            if name.startswith(cls.DIRECTORY_PREFIX) and pid.isdigit() and not process_exists(int(pid)):
+                shutil.rmtree(os.path.join(disk_directory, name), ignore_errors=True)
+
+    @staticmethod
+    def _remove_file(key: Any, cached_file: CachedFile):
+        try:
+            os.remove(cached_file.path)
+        except OSError:
+            logging.warning("Unable to remove cached content file %s", cached_file.path)
+
+    def can_cache(self, size: int) -> bool:
+        return size <= min(self.max_memory_item_bytes, self.memory.max_weight) or (
+            self.directory is not None and size <= self.disk.max_weight
+        )
+
+    def get(self, blob_name: str, etag: str) -> Optional[CachedContent]:
+        key = (blob_name, etag)
+        if key in self.memory:
+            return CachedContent(data=self.memory.get(key))
+        if key in self.disk:
+            cached_file = self.disk.get(key)
+            if cached_file:
+                try:
+                    # Open right away so that an eviction can't remove the file before it is read
+                    return CachedContent(file=open(cached_file.path, "rb"))
+                except OSError:
+                    self.disk.pop(key)
+        self.misses += 1
+        return None
+
+    def invalidate(self, blob_name: str):
+        if etag := self.etags.pop(blob_name, None):
+            self.memory.pop((blob_name, etag))
+            if cached_file := self.disk.pop((blob_name, etag)):
+                self._remove_file((blob_name, etag), cached_file)
+
+    def _track(self, blob_name: str, etag: str):
+        # A different ETag means the blob was re-uploaded, so drop the outdated entry
+        if self.etags.get(blob_name) != etag:
+            self.invalidate(blob_name)
+            self.etags[blob_name] = etag
+
+    async def store_stream(
+        self, blob_name: str, etag: str, size: int, chunks: AsyncIterator[bytes]
+    ) -> AsyncGenerator[bytes, None]:
+        """
+        Passes the chunks of a whole blob through, and caches the blob once all of them have been sent.
+        Nothing is cached if the stream is interrupted, for example when the client disconnects.
+        """
+        key = (blob_name, etag)
+        if size <= min(self.max_memory_item_bytes, self.memory.max_weight):
+            buffer = bytearray()
+            async for chunk in chunks:
+                buffer.extend(chunk)
+                yield chunk
+            if len(buffer) == size:
+                self._track(blob_name, etag)
+                self.memory.put(key, bytes(buffer))
+            return
+
+        if self.directory is None:
+            async for chunk in chunks:
+                yield chunk
+            return
+
+        file = tempfile.NamedTemporaryFile(dir=self.directory, delete=False)
+        written = 0
+        try:
+            async for chunk in chunks:
+                await asyncio.to_thread(file.write, chunk)
+                written += len(chunk)
+                yield chunk
+            await asyncio.to_thread(file.close)
+            if written == size:
+                path = os.path.join(self.directory, hashlib.sha256(f"{blob_name}:{etag}".encode()).hexdigest())
+                os.replace(file.name, path)
+                self._track(blob_name, etag)
+                if self.disk.put(key, CachedFile(path, size)):
+                    return
+                os.remove(path)
+        finally:
+            file.close()
+            if os.path.exists(file.name):
+                os.remove(file.name)
+
+    def fill_in_background(
+        self, blob_name: str, etag: str, size: int, download: Callable[[], Awaitable[AsyncIterator[bytes]]]
+    ):
+        """
+        Starts caching a whole blob from a download in the background, unless it is already being cached.
+        """
+        key = (blob_name, etag)
+        if key in self._fills or not self.can_cache(size):
+            return
+
+        async def fill():
+            try:
+                async for _ in self.store_stream(blob_name, etag, size, await download()):
+                    pass
+            except Exception as error:
+                # The blob is still served from storage, so a failed fill is only logged
+                logging.warning("Failed to cache content %s: %s", blob_name, error)
+
+        task = asyncio.create_task(fill())
+        self._fills[key] = task
+        task.add_done_callback(lambda _: self._fills.pop(key, None))
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "hits": self.memory.hits + self.disk.hits,
+            "misses": self.misses,
+            "evictions": self.memory.evictions + self.disk.evictions,
+            "memory_hits": self.memory.hits,
+            "memory_evictions": self.memory.evictions,
+            "memory_bytes": self.memory.weight,
+            "disk_hits": self.disk.hits,
+            "disk_evictions": self.disk.evictions,
+            "disk_bytes": self.disk.weight,
+        }
+
+    async def close(self):
+        fills = list(self._fills.values())
+        for fill in fills:
+            fill.cancel()
+        await asyncio.gather(*fills, return_exceptions=True)
+        self.memory.clear()
+        self.disk.clear()
+        self.etags.clear()
+        if self.directory:
+            shutil.rmtree(self.directory, ignore_errors=True)
@@ -0,0 +1,194 @@
+import dataclasses
+import json
+import secrets
+import sqlite3
+import time
+import unicodedata
+from abc import ABC, abstractmethod
+from typing import Any, Optional
+
+from .cache import LRUCache
+from .modelhelper import get_encoding, token_counter
+from .sqlitetable import SQLiteTable
+
+
+@dataclasses.dataclass
+class Conversation:
+    """
+    The messages of a chat conversation kept on the server.
+    Attributes:
+        owner (str): The ID of the user who started the conversation, or None without authentication.
+        messages (list): The messages, with NFC-normalized content.
+        token_counts (list): The number of tokens of the content of each message.
+        encoding (str): The name of the encoding the tokens were counted with.
+        summary (str): The content of a system message summarizing the oldest messages, or None.
+        summarized_count (int): The number of oldest messages replaced by the summary.
+        summary_token_count (int): The number of tokens of the summary.
+    """
+
+    owner: Optional[str]
+    messages: list[dict[str, str]] = dataclasses.field(default_factory=list)
+    token_counts: list[int] = dataclasses.field(default_factory=list)
+    encoding: str = ""
+    summary: Optional[str] = None
+    summarized_count: int = 0
+    summary_token_count: int = 0
+
+    def get_history(self) -> list[dict[str, str]]:
+        """
+        Returns the messages to answer from, with the summarized messages replaced by their summary.
+        """
+        if self.summary is None:
+            return list(self.messages)
+        return [{"role": "system", "content": self.summary}, *self.messages[self.summarized_count :]]
+
+    def get_unsummarized_token_count(self) -> int:
+        return sum(self.token_counts[self.summarized_count :])
+
+    def add_messages(self, messages: list[dict[str, Any]], model: str):
+        """
+        Appends messages with normalized content, and counts their tokens.
+        """
+        for message in messages:
+            if not isinstance(message.get("content"), str):
+                raise ValueError("Only messages with text content can be kept in a conversation")
+        self.messages.extend(
+            {"role": message["role"], "content": unicodedata.normalize("NFC", message["content"])}
+            for message in messages
+        )
+        encoding = get_encoding(model).name
+        if encoding != self.encoding:
+            # The model changed since the conversation started, so count all of its messages again
+            self.token_counts = []
+            self.encoding = encoding
+            if self.summary is not None:
+                self.summary_token_count = token_counter.count_texts([self.summary], model)[0]
+        uncounted = [message["content"] for message in self.messages[len(self.token_counts) :]]
+        self.token_counts.extend(token_counter.count_texts(uncounted, model))
+
+    def remember_token_counts(self, model: str):
+        """
+        Adds the token counts of the messages to the token counter, so that the history isn't encoded again.
+        """
+        if self.encoding == get_encoding(model).name:
+            token_counter.add_counts([message["content"] for message in self.messages], self.token_counts, model)
+            if self.summary is not None:
+                token_counter.add_counts([self.summary], [self.summary_token_count], model)
+
+
+class ConversationStore(ABC):
+    """
+    A store of the chat conversations referenced by the session state of responses,
+    so that clients only send the new message of each turn.
+    Conversations are kept for ttl seconds after their last turn, and can only be continued by the user who started them.
+    Attributes:
+        model (str): The model the tokens of the messages are counted for.
+        ttl (float): The number of seconds a conversation is kept for after its last turn.
+    """
+
+    def __init__(self, model: str, ttl: float):
+        self.model = model
+        self.ttl = ttl
+
+    def new_id(self) -> str:
+        return secrets.token_urlsafe(16)
+
+    async def get(self, conversation_id: str, owner: Optional[str]) -> Optional[Conversation]:
+        """
+        Returns a conversation, or None if it expired or belongs to another user.
+        """
+        data = await self.load(conversation_id)
+        if data is None:
+            return None
+        conversation = Conversation(**json.loads(data))
+        if conversation.owner != owner:
+            return None
+        conversation.remember_token_counts(self.model)
+        return conversation
+
+    async def put(self, conversation_id: str, conversation: Conversation):
+        await self.save(conversation_id, json.dumps(dataclasses.asdict(conversation), ensure_ascii=False))
+
+    @abstractmethod
+    async def load(self, conversation_id: str) -> Optional[str]:
+        pass
+
+    @abstractmethod
+    async def save(self, conversation_id: str, data: str):
+        pass
+
+    async def close(self):
+        pass
+
+
+class MemoryConversationStore(ConversationStore):
+    """
+    Keeps conversations in the memory of the process, which only works with a single worker process.
+    """
+
+    def __init__(self, model: str, ttl: float, max_bytes: int):
+        super().__init__(model, ttl)
+        self.cache: LRUCache[str] = LRUCache(max_weight=max_bytes, weigh=len, ttl=ttl)
+
+    async def load(self, conversation_id: str) -> Optional[str]:
+        return self.cache.get(conversation_id)
+
+    async def save(self, conversation_id: str, data: str):
+        self.cache.put(conversation_id, data)
+
+
+class SQLiteConversationStore(ConversationStore):
+    """
+    Keeps conversations in a SQLite database, shared by the worker processes of an instance.
+    """
+
+    def __init__(self, model: str, ttl: float, path: str):
+        super().__init__(model, ttl)
+        self.table = SQLiteTable(
+            path, "conversations", "id TEXT PRIMARY KEY, expires_at REAL NOT NULL, data TEXT NOT NULL"
+        )
+
+    async def load(self, conversation_id: str) -> Optional[str]:
+        def select(connection: sqlite3.Connection) -> Optional[str]:
+            row = connection.execute(
+                "SELECT data FROM conversations WHERE id = ? AND expires_at >= ?", (conversation_id, time.time())
+            ).fetchone()
+            return row[0] if row else None
+
+        return await self.table.read(select)
+
+    async def save(self, conversation_id: str, data: str):
+        def upsert(connection: sqlite3.Connection):
+            connection.execute(
+                "INSERT OR REPLACE INTO conversations (id, expires_at, data) VALUES (?, ?, ?)",
+                (conversation_id, time.time() + self.ttl, data),
+            )
+
+        await self.table.write(upsert)
+
+    async def close(self):
+        await self.table.close()
+
+
+class RedisConversationStore(ConversationStore):
+    """
+    Keeps conversations in a Redis-compatible cache, such as Azure Cache for Redis, shared by every instance.
+    Attributes:
+        client: A redis.asyncio.Redis client.
+    """
+
+    KEY_PREFIX = "conversation:"
+
+    def __init__(self, model: str, ttl: float, client: Any):
+        super().__init__(model, ttl)
+        self.client = client
+
+    async def load(self, conversation_id: str) -> Optional[str]:
+        data = await self.client.get(self.KEY_PREFIX + conversation_id)
+        return data.decode() if isinstance(data, bytes) else data
+
+    async def save(self, conversation_id: str, data: str):
+        await self.client.set(self.KEY_PREFIX + conversation_id, data, ex=max(int(self.ttl), 1))
+
+    async def close(self):
+        await self.client.close()
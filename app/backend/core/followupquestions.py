@@ -0,0 +1,76 @@
+from typing import Optional
+
+
+class FollowupQuestionParser:
+    """
+    Splits a streamed answer into the answer text and the follow-up questions enclosed in << and >> that end it,
+    one chunk at a time, even when a delimiter is split across chunks.
+    Like ChatApproach.extract_followup_questions, everything after the first << is left out of the answer,
+    and a follow-up question is any non-empty text without > between << and >>.
+    Attributes:
+        questions (list[str]): The follow-up questions found so far.
+        started (bool): Whether the follow-up questions have started, so that the rest isn't part of the answer.
+    """
+
+    def __init__(self):
+        self.questions: list[str] = []
+        self.started = False
+        # A trailing < that may be the start of a delimiter
+        self._pending_lt = False
+        # The follow-up question being read, or None when outside of << and >>
+        self._question: Optional[list[str]] = None
+        # A > read inside a question, that may be the start of >>
+        self._pending_gt = False
+
+    def feed(self, content: str) -> tuple[str, list[str]]:
+        """
+        Returns the part of the chunk that belongs to the answer, and the follow-up questions completed by the chunk.
+        """
+        if not self.started:
+            text = "<" + content if self._pending_lt else content
+            self._pending_lt = False
+            start = text.find("<<")
+            if start == -1:
+                if text.endswith("<"):
+                    self._pending_lt = True
+                    return text[:-1], []
+                return text, []
+            self.started = True
+            self._question = []
+            return text[:start], self._parse(text[start + 2 :])
+        return "", self._parse(content)
+
+    def flush(self) -> str:
+        """
+        Returns the answer text held back at the end of the stream, if any.
+        """
+        if self._pending_lt and not self.started:
+            self._pending_lt = False
+            return "<"
+        return ""
+
+    def _parse(self, text: str) -> list[str]:
+        completed = []
+        for char in text:
+            if self._question is None:
+                if char == "<" and self._pending_lt:
+                    self._question = []
+                    self._pending_lt = False
+                else:
+                    self._pending_lt = char == "<"
+            elif self._pending_gt:
+                self._pending_gt = False
+                question = "".join(self._question)
+                self._question = None
+                if char == ">":
+                    if question:
+                        completed.append(question)
+                else:
+                    # A single > ends the question without completing it
+                    self._pending_lt = char == "<"
+            elif char == ">":
+                self._pending_gt = True
+            else:
+                self._question.append(char)
+        self.questions.extend(completed)
+        return completed
@@ -0,0 +1,134 @@
+import asyncio
+import logging
+from typing import Optional
+
+from openai import AsyncOpenAI
+
+from .conversationstore import Conversation, ConversationStore
+from .modelhelper import get_token_limit, token_counter
+
+
+class HistorySummarizer:
+    """
+    Compacts the oldest messages of long conversations into a summary kept with the conversation,
+    so that later turns send the summary instead of those messages to the chat model.
+    Summaries are made in the background once the unsummarized messages of a conversation pass max_tokens,
+    and cover all of them but the newest keep_messages, which are always sent as is.
+    When those messages don't fit in the model with the summary, only the oldest ones that fit are summarized,
+    and the others are left for the next summary.
+    Attributes:
+        max_tokens (int): The number of tokens of unsummarized messages that starts a summary.
+        keep_messages (int): The number of newest messages left out of summaries.
+    """
+
+    SUMMARY_PREFIX = "Summary of the earlier conversation:\n"
+    # The tokens of the role and separators of each line of the transcript, and of the chat message format
+    LINE_TOKEN_COUNT = 4
+    MESSAGE_TOKEN_COUNT = 8
+
+    summary_prompt = (
+        "Summarize the conversation below between a user and an assistant answering questions about company documents. "
+        + "Keep the facts, names, numbers and source names in square brackets that later questions may refer to. "
+        + "Only answer with the summary, in the language of the conversation."
+    )
+
+    def __init__(
+        self,
+        openai_client: AsyncOpenAI,
+        model: str,
+        deployment: Optional[str],  # Not needed for non-Azure OpenAI
+        conversation_store: ConversationStore,
+        max_tokens: int,
+        keep_messages: int = 4,
+        summary_token_limit: int = 500,
+    ):
+        self.openai_client = openai_client
+        self.model = model
+        self.deployment = deployment
+        self.conversation_store = conversation_store
+        self.max_tokens = max_tokens
+        self.keep_messages = keep_messages
+        self.summary_token_limit = summary_token_limit
+        self._tasks: dict[str, asyncio.Task] = {}
+
+    def maybe_summarize(self, conversation_id: str, conversation: Conversation):
+        """
+        Starts summarizing a conversation in the background if it's long enough and not already being summarized.
+        """
+        if conversation_id in self._tasks or conversation.get_unsummarized_token_count() <= self.max_tokens:
+            return
+        if len(conversation.messages) - self.keep_messages - conversation.summarized_count < 2:
+            return
+        task = asyncio.create_task(self.summarize(conversation_id, conversation))
+        self._tasks[conversation_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(conversation_id, None))
+
+    def count_summarizable(self, conversation: Conversation) -> int:
+        """
+        Returns the number of oldest unsummarized messages, up to the newest keep_messages,
+        that fit in the model with the summary prompt, the earlier summary and the answer.
+        """
+        prompt = [self.summary_prompt] if conversation.summary is None else [self.summary_prompt, conversation.summary]
+        max_tokens = get_token_limit(self.model) - self.summary_token_limit - 2 * self.MESSAGE_TOKEN_COUNT
+        token_count = sum(token_counter.count_texts(prompt, self.model))
+        contents = [
+            message["content"]
+            for message in conversation.messages[
+                conversation.summarized_count : len(conversation.messages) - self.keep_messages
+            ]
+        ]
+        count = 0
+        for message_token_count in token_counter.count_texts(contents, self.model):
+            token_count += message_token_count + self.LINE_TOKEN_COUNT
+            if token_count > max_tokens:
+                break
+            count += 1
+        return count
+
+    async def summarize(self, conversation_id: str, conversation: Conversation):
+        try:
+            count = self.count_summarizable(conversation)
+            if count == 0:
+                raise ValueError(f"The oldest message to summarize doesn't fit in {self.model}")
+            summarized_count = conversation.summarized_count + count
+            transcript = "\n".join(
+                f"{message['role']}: {message['content']}"
+                for message in conversation.messages[conversation.summarized_count : summarized_count]
+            )
+            if conversation.summary is not None:
+                transcript = conversation.summary + "\n\n" + transcript
+            chat_completion = await self.openai_client.chat.completions.create(
+                # Azure Open AI takes the deployment name as the model name
+                model=self.deployment if self.deployment else self.model,
+                messages=[
+                    {"role": "system", "content": self.summary_prompt},
+                    {"role": "user", "content": transcript},
+                ],
+                temperature=0.0,
+                max_tokens=self.summary_token_limit,
+                n=1,
+            )
+            summary = chat_completion.choices[0].message.content
+            if not summary:
+                return
+            # The conversation may have gone on while it was summarized, so update its latest version
+            latest = await self.conversation_store.get(conversation_id, conversation.owner)
+            if (
+                latest is None
+                or latest.summarized_count >= summarized_count
+                or latest.messages[:summarized_count] != conversation.messages[:summarized_count]
+            ):
+                return
+            latest.summary = self.SUMMARY_PREFIX + summary
+            latest.summarized_count = summarized_count
+            latest.summary_token_count = token_counter.count_texts([latest.summary], self.conversation_store.model)[0]
+            await self.conversation_store.put(conversation_id, latest)
+        except Exception as error:
+            # The conversation is still answered from its messages, so a failed summary is only logged
+            logging.warning("Failed to summarize conversation history: %s", error)
+
+    async def close(self):
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,43 @@
+from typing import Optional
+
+import aiohttp
+
+
+class HTTPSessionRegistry:
+    """
+    App-scoped aiohttp sessions, so that calls made without an Azure SDK client reuse pooled keep-alive connections
+    instead of paying for DNS, TCP and TLS setup on every request.
+    Sessions are created on first use, one per name, and share the same connection limits.
+    """
+
+    def __init__(
+        self,
+        limit: int = 100,
+        limit_per_host: int = 20,
+        keepalive_timeout: float = 30,
+        timeout: Optional[float] = None,
+    ):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = timeout
+        self.sessions: dict[str, aiohttp.ClientSession] = {}
+
+    def get(self, name: str = "default") -> aiohttp.ClientSession:
+        # Sessions are created lazily, as they must be created from within the event loop
+        session = self.sessions.get(name)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+                ttl_dns_cache=300,
+            )
+            session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout))
+            self.sessions[name] = session
+        return session
+
+    async def close(self):
+        for session in self.sessions.values():
+            await session.close()
+        self.sessions.clear()
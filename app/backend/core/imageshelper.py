@@ -1,11 +1,18 @@
+import asyncio
 import base64
 import os
 from typing import Optional
 
+from azure.core import MatchConditions
+from azure.core.exceptions import HttpResponseError
 from azure.storage.blob.aio import ContainerClient
 from typing_extensions import Literal, Required, TypedDict
 
 from approaches.approach import Document
+from core.cache import LRUCache
+
+# Maximum number of page images downloaded at the same time for a single request
+MAX_CONCURRENT_IMAGE_FETCHES = 4
 
 
 class ImageURL(TypedDict, total=False):
@@ -16,21 +23,74 @@ class ImageURL(TypedDict, total=False):
     """Specifies the detail level of the image."""
 
 
-async def download_blob_as_base64(blob_container_client: ContainerClient, file_path: str) -> Optional[str]:
+async def download_blob_as_base64(
+    blob_container_client: ContainerClient,
+    file_path: str,
+    image_cache: Optional[LRUCache[tuple[str, str]]] = None,
+) -> Optional[str]:
     base_name, _ = os.path.splitext(file_path)
-    blob = await blob_container_client.get_blob_client(base_name + ".png").download_blob()
+    blob_name = base_name + ".png"
+    blob_client = blob_container_client.get_blob_client(blob_name)
+
+    # The cache holds (ETag, data URL) pairs, revalidated with a conditional download that has no body if unchanged
+    cached = image_cache.get(blob_name) if image_cache is not None else None
+    if cached:
+        try:
+            blob = await blob_client.download_blob(etag=cached[0], match_condition=MatchConditions.IfModified)
+        except HttpResponseError as error:
+            # Azure Storage answers with a 304 and a ConditionNotMet error code, raised as a ResourceModifiedError
+            if error.status_code == 304:
+                return cached[1]
+            raise
+    else:
+        blob = await blob_client.download_blob()
 
     if not blob.properties:
         return None
     img = base64.b64encode(await blob.readall()).decode("utf-8")
-    return f"data:image/png;base64,{img}"
+    data_url = f"data:image/png;base64,{img}"
+    if image_cache is not None and blob.properties.etag:
+        image_cache.put(blob_name, (blob.properties.etag, data_url))
+    return data_url
 
 
-async def fetch_image(blob_container_client: ContainerClient, result: Document) -> Optional[ImageURL]:
+async def fetch_image(
+    blob_container_client: ContainerClient,
+    result: Document,
+    image_cache: Optional[LRUCache[tuple[str, str]]] = None,
+) -> Optional[ImageURL]:
     if result.sourcepage:
-        img = await download_blob_as_base64(blob_container_client, result.sourcepage)
+        img = await download_blob_as_base64(blob_container_client, result.sourcepage, image_cache)
         if img:
             return {"url": img, "detail": "auto"}
         else:
             return None
     return None
+
+
+async def fetch_images(
+    blob_container_client: ContainerClient,
+    results: list[Document],
+    image_cache: Optional[LRUCache[tuple[str, str]]] = None,
+) -> list[ImageURL]:
+    """
+    Fetches the page image of each result concurrently, at most MAX_CONCURRENT_IMAGE_FETCHES at a time.
+    Results citing the same page share one download. Images are returned in the order of the results.
+    """
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_IMAGE_FETCHES)
+
+    async def fetch(result: Document) -> Optional[ImageURL]:
+        async with semaphore:
+            return await fetch_image(blob_container_client, result, image_cache)
+
+    fetches: dict[Optional[str], asyncio.Future] = {}
+    for result in results:
+        if result.sourcepage not in fetches:
+            fetches[result.sourcepage] = asyncio.ensure_future(fetch(result))
+    try:
+        await asyncio.gather(*fetches.values())
+    finally:
+        for future in fetches.values():
+            future.cancel()
+    images = [fetches[result.sourcepage].result() for result in results]
+    return [image for image in images if image]
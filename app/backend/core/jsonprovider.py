@@ -0,0 +1,49 @@
+import dataclasses
+from typing import Any
+
+import orjson
+from quart.json.provider import DefaultJSONProvider
+
+
+def dataclass_to_dict(o: Any) -> dict[str, Any]:
+    """
+    Returns the fields of a dataclass instance as a dict, leaving their values to the encoder
+    instead of copying them recursively like dataclasses.asdict.
+    """
+    return {field.name: getattr(o, field.name) for field in dataclasses.fields(o)}
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """
+    A JSON provider that serializes responses with orjson, with the same sorted keys as the default provider.
+    Requests are still parsed by the default provider, as orjson reads integers larger than 64 bits as floats.
+    Dataclasses are passed to default, so that their fields are sorted too, and anything orjson can't
+    serialize (like integers larger than 64 bits) falls back to the default provider.
+    """
+
+    option = orjson.OPT_SORT_KEYS | orjson.OPT_PASSTHROUGH_DATACLASS | orjson.OPT_PASSTHROUGH_DATETIME
+
+    @staticmethod
+    def default(o: Any) -> Any:
+        if dataclasses.is_dataclass(o) and not isinstance(o, type):
+            return dataclass_to_dict(o)
+        return DefaultJSONProvider.default(o)
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        if kwargs:
+            return super().dumps(obj, **kwargs)
+        try:
+            return orjson.dumps(obj, default=self.default, option=self.option).decode()
+        except orjson.JSONEncodeError:
+            return super().dumps(obj)
+
+    def response(self, *args: Any, **kwargs: Any):
+        obj = self._prepare_response_obj(args, kwargs)
+        option = self.option | orjson.OPT_APPEND_NEWLINE
+        if (self.compact is None and self._app.debug) or self.compact is False:
+            option |= orjson.OPT_INDENT_2
+        try:
+            body = orjson.dumps(obj, default=self.default, option=option)
+        except orjson.JSONEncodeError:
+            return super().response(*args, **kwargs)
+        return self._app.response_class(body, mimetype=self.mimetype)
@@ -1,5 +1,5 @@
 import unicodedata
-from typing import List, Union
+from typing import Any, List, Union
 
 from openai.types.chat import (
     ChatCompletionAssistantMessageParam,
@@ -9,7 +9,7 @@ from openai.types.chat import (
     ChatCompletionUserMessageParam,
 )
 
-from .modelhelper import num_tokens_from_messages
+from .modelhelper import num_tokens_from_messages, num_tokens_from_messages_batch
 
 
 class MessageBuilder:
@@ -22,6 +22,7 @@ class MessageBuilder:
     Methods:
         __init__(self, system_content: str, chatgpt_model: str): Initializes the MessageBuilder instance.
         insert_message(self, role: str, content: str, index: int = 1): Inserts a new message to the conversation.
+        make_message(self, role: str, content: str): Creates a normalized message without adding it.
     """
 
     def __init__(self, system_content: str, chatgpt_model: str):
@@ -39,6 +40,14 @@ class MessageBuilder:
             content (str | List[ChatCompletionContentPartParam]): The content of the message.
             index (int): The index at which to insert the message.
         """
+        self.messages.insert(index, self.make_message(role, content))
+
+    def make_message(
+        self, role: str, content: Union[str, List[ChatCompletionContentPartParam]]
+    ) -> ChatCompletionMessageParam:
+        """
+        Creates a message with normalized content, without adding it to the conversation.
+        """
         message: ChatCompletionMessageParam
         if role == "user":
             message = ChatCompletionUserMessageParam(role="user", content=self.normalize_content(content))
@@ -50,11 +59,14 @@ class MessageBuilder:
             )
         else:
             raise ValueError(f"Invalid role: {role}")
-        self.messages.insert(index, message)
+        return message
 
     def count_tokens_for_message(self, message: dict[str, str]):
         return num_tokens_from_messages(message, self.model)
 
+    def count_tokens_for_messages(self, messages: list[dict[str, Any]]) -> list[int]:
+        return num_tokens_from_messages_batch(messages, self.model)
+
     def normalize_content(self, content: Union[str, List[ChatCompletionContentPartParam]]):
         if isinstance(content, str):
             return unicodedata.normalize("NFC", content)
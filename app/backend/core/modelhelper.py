@@ -1,7 +1,14 @@
 from __future__ import annotations
 
+import hashlib
+import os
+from functools import lru_cache
+from typing import Any
+
 import tiktoken
 
+from .cache import LRUCache
+
 MODELS_2_TOKEN_LIMITS = {
     "gpt-35-turbo": 4000,
     "gpt-3.5-turbo": 4000,
@@ -22,6 +29,77 @@ def get_token_limit(model_id: str) -> int:
     return MODELS_2_TOKEN_LIMITS[model_id]
 
 
+@lru_cache(maxsize=None)
+def get_encoding(model: str) -> tiktoken.Encoding:
+    """Returns the tiktoken encoding of a model, resolved once per model."""
+    return tiktoken.encoding_for_model(get_oai_chatmodel_tiktok(model))
+
+
+class TokenCounter:
+    """
+    Counts tokens, remembering the count of each text by content hash in a bounded LRU cache,
+    so that the messages of a conversation are only encoded once across its turns.
+    Attributes:
+        counts (LRUCache): The token counts, keyed by encoding name and text digest.
+    """
+
+    def __init__(self, max_entries: int = 10000):
+        self.counts: LRUCache[int] = LRUCache(max_entries)
+
+    def count_texts(self, texts: list[str], model: str) -> list[int]:
+        """
+        Counts the tokens of several texts, encoding the ones not seen before in a single batch.
+        """
+        encoding = get_encoding(model)
+        keys = [self.make_key(encoding, text) for text in texts]
+        counts = [self.counts.get(key) for key in keys]
+        missing = {key: text for key, text, count in zip(keys, texts, counts) if count is None}
+        new_counts: dict[Any, int] = {}
+        if missing:
+            # Batches are encoded on a thread pool, which only pays off for larger batches and several CPUs
+            missing_texts = list(missing.values())
+            if len(missing_texts) >= 16 and (os.cpu_count() or 1) > 1:
+                encoded = encoding.encode_batch(missing_texts)
+            else:
+                encoded = [encoding.encode(text) for text in missing_texts]
+            for key, tokens in zip(missing.keys(), encoded):
+                self.counts.put(key, len(tokens))
+                new_counts[key] = len(tokens)
+        return [new_counts[key] if count is None else count for key, count in zip(keys, counts)]
+
+    def add_counts(self, texts: list[str], counts: list[int], model: str):
+        """
+        Remembers token counts made earlier, for example by another process, so that the texts aren't encoded again.
+        """
+        encoding = get_encoding(model)
+        for text, count in zip(texts, counts):
+            self.counts.put(self.make_key(encoding, text), count)
+
+    def make_key(self, encoding: tiktoken.Encoding, text: str) -> tuple[str, bytes]:
+        return (encoding.name, hashlib.blake2b(text.encode(), digest_size=16).digest())
+
+    def count_messages(self, messages: list[dict[str, Any]], model: str) -> list[int]:
+        """
+        Counts the tokens of each message, see num_tokens_from_messages.
+        """
+        texts_per_message = [
+            [
+                text
+                for value in message.values()
+                for text in (value if isinstance(value, list) else [value])
+                # TODO: Update token count for images https://github.com/openai/openai-cookbook/pull/881/files
+                if isinstance(text, str)
+            ]
+            for message in messages
+        ]
+        counts = iter(self.count_texts([text for texts in texts_per_message for text in texts], model))
+        # 2 tokens for the "role" and "content" keys
+        return [2 + sum(next(counts) for _ in texts) for texts in texts_per_message]
+
+
+token_counter = TokenCounter()
+
+
 def num_tokens_from_messages(message: dict[str, str], model: str) -> int:
     """
     Calculate the number of tokens required to encode a message.
@@ -36,18 +114,14 @@ def num_tokens_from_messages(message: dict[str, str], model: str) -> int:
         num_tokens_from_messages(message, model)
         output: 11
     """
+    return token_counter.count_messages([message], model)[0]
 
-    encoding = tiktoken.encoding_for_model(get_oai_chatmodel_tiktok(model))
-    num_tokens = 2  # For "role" and "content" keys
-    for key, value in message.items():
-        if isinstance(value, list):
-            for v in value:
-                # TODO: Update token count for images https://github.com/openai/openai-cookbook/pull/881/files
-                if isinstance(v, str):
-                    num_tokens += len(encoding.encode(v))
-        else:
-            num_tokens += len(encoding.encode(value))
-    return num_tokens
+
+def num_tokens_from_messages_batch(messages: list[dict[str, Any]], model: str) -> list[int]:
+    """
+    Calculate the number of tokens required to encode each of several messages, in a single batch.
+    """
+    return token_counter.count_messages(messages, model)
 
 
 def get_oai_chatmodel_tiktok(aoaimodel: str) -> str:
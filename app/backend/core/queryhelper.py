@@ -0,0 +1,54 @@
+import re
+
+# Common English words that a generated keyword query usually drops from the question
+STOP_WORDS = frozenset(
+    """
+    a about am an and any are as at be by can could did do does for from had has have how i if in is it its
+    me my of on or our should so than that the their there these this those to was we were what when where
+    which who whom why will with would you your
+    """.split()
+)
+
+
+def query_terms(query: str) -> set[str]:
+    """
+    Returns the lowercased words of a query without stop words, or all of its words if they are all stop words.
+    """
+    words = re.findall(r"\w+", query.lower())
+    return {word for word in words if word not in STOP_WORDS} or set(words)
+
+
+def query_similarity(query: str, other_query: str) -> float:
+    """
+    Returns the Jaccard similarity of the terms of two queries, from 0 (nothing in common) to 1 (same terms).
+    """
+    terms, other_terms = query_terms(query), query_terms(other_query)
+    all_terms = terms | other_terms
+    if not all_terms:
+        return 1.0
+    return len(terms & other_terms) / len(all_terms)
+
+
+# Words that refer back to an earlier part of the conversation
+REFERENCE_WORDS = frozenset(
+    """
+    it its they them their theirs this that these those he him his she her hers above previous earlier
+    former latter same else again also
+    """.split()
+)
+
+# Openings of a question that continues the previous one
+FOLLOW_UP_OPENINGS = [("and",), ("but",), ("so",), ("then",), ("also",), ("what", "about"), ("how", "about")]
+
+
+def is_self_contained(question: str) -> bool:
+    """
+    Guesses whether a question can be searched for without the rest of the conversation:
+    it must have at least two terms, and no pronouns or other references to earlier messages.
+    """
+    words = re.findall(r"\w+", question.lower())
+    if any(tuple(words[: len(opening)]) == opening for opening in FOLLOW_UP_OPENINGS):
+        return False
+    if REFERENCE_WORDS.intersection(words):
+        return False
+    return len([word for word in words if word not in STOP_WORDS]) >= 2
@@ -0,0 +1,81 @@
+import hashlib
+import json
+import logging
+import time
+from array import array
+from typing import Awaitable, Callable, Generic, Hashable, List, Optional, TypeVar
+
+from azure.search.documents.models import VectorQuery
+
+from .cache import LRUCache
+
+V = TypeVar("V")
+
+
+def vector_fingerprint(vectors: List[VectorQuery]) -> str:
+    """
+    Returns a digest of the vector queries, hashing the vectors as float32 so the key stays small.
+    """
+    digest = hashlib.sha256()
+    for vector_query in vectors:
+        parameters = {name: value for name, value in vector_query.as_dict().items() if name != "vector"}
+        digest.update(json.dumps(parameters, sort_keys=True, default=str).encode())
+        if vector := getattr(vector_query, "vector", None):
+            digest.update(array("f", vector).tobytes())
+    return digest.hexdigest()
+
+
+class SearchCache(Generic[V]):
+    """
+    A short-lived cache of search results, bounded by their approximate size in bytes.
+    Keys are stamped with a generation, so that ingestion can invalidate every cached result by bumping it.
+    The generation is read with load_generation, at most once every generation_check_interval seconds.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int,
+        ttl: float,
+        weigh: Callable[[V], int],
+        load_generation: Optional[Callable[[], Awaitable[Optional[str]]]] = None,
+        generation_check_interval: float = 60,
+    ):
+        self.results: LRUCache[V] = LRUCache(max_bytes, weigh=weigh, ttl=ttl)
+        self.load_generation = load_generation
+        self.generation_check_interval = generation_check_interval
+        self.generation: Optional[str] = None
+        self.generation_checked_at = float("-inf")
+
+    def bump_generation(self, generation: Optional[str] = None):
+        self.generation = generation if generation is not None else str(time.time_ns())
+        self.results.clear()
+
+    async def refresh_generation(self):
+        if self.load_generation is None:
+            return
+        now = time.monotonic()
+        if now - self.generation_checked_at < self.generation_check_interval:
+            return
+        # Set before awaiting, so that concurrent requests don't all check the generation
+        self.generation_checked_at = now
+        try:
+            generation = await self.load_generation()
+        except Exception as error:
+            logging.warning("Unable to check the search cache generation, keeping the cached results: %s", error)
+            return
+        if generation != self.generation:
+            if self.generation is not None:
+                logging.info("Search cache generation changed to %s, clearing the cached results", generation)
+            self.bump_generation(generation)
+
+    async def get_or_search(self, key: Hashable, search: Callable[[], Awaitable[V]]) -> V:
+        await self.refresh_generation()
+        return await self.results.get_or_load((self.generation, key), search)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "hits": self.results.hits,
+            "misses": self.results.misses,
+            "evictions": self.results.evictions,
+            "bytes": self.results.weight,
+        }
@@ -0,0 +1,134 @@
+import asyncio
+from typing import (
+    Any,
+    AsyncGenerator,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Hashable,
+    Optional,
+)
+
+
+def with_session_state(result: dict[str, Any], session_state: Any) -> dict[str, Any]:
+    """
+    Returns a shallow copy of a response or response chunk carrying the given session state,
+    so that a shared result can be handed to each caller without leaking another caller's state.
+    """
+    choices = result.get("choices")
+    if not choices or "session_state" not in choices[0]:
+        return result
+    return {**result, "choices": [{**choices[0], "session_state": session_state}, *choices[1:]]}
+
+
+class StreamFlight:
+    """
+    A streamed response shared by all the callers that asked for it while it was in flight.
+    Chunks are buffered so that a late subscriber replays the chunks it missed before following the live stream.
+    The upstream stream is cancelled once every subscriber has gone away, and a subscriber that joined
+    just before that gets an error rather than a truncated stream.
+    """
+
+    def __init__(
+        self, open_stream: Callable[[], Awaitable[AsyncIterator[dict[str, Any]]]], on_done: Callable[[], None]
+    ):
+        self.events: list[dict[str, Any]] = []
+        self.done = False
+        self.error: Optional[Exception] = None
+        self.subscribers = 0
+        self._updated = asyncio.Event()
+        self._on_done = on_done
+        self._task = asyncio.ensure_future(self._produce(open_stream))
+
+    async def _produce(self, open_stream: Callable[[], Awaitable[AsyncIterator[dict[str, Any]]]]):
+        try:
+            async for event in await open_stream():
+                self.events.append(event)
+                self._notify()
+        except asyncio.CancelledError:
+            self.error = RuntimeError("The shared stream was cancelled once all of its subscribers left")
+            raise
+        except Exception as error:
+            self.error = error
+        finally:
+            self.done = True
+            self._notify()
+            self._on_done()
+
+    def _notify(self):
+        self._updated.set()
+        self._updated = asyncio.Event()
+
+    async def subscribe(self, session_state: Any = None) -> AsyncGenerator[dict[str, Any], None]:
+        self.subscribers += 1
+        index = 0
+        try:
+            while True:
+                while index < len(self.events):
+                    yield with_session_state(self.events[index], session_state)
+                    index += 1
+                if self.done:
+                    if self.error:
+                        raise self.error
+                    return
+                await self._updated.wait()
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0 and not self.done:
+                # Leave the registry right away, so that no new caller joins the stream while it is cancelled
+                self._on_done()
+                self._task.cancel()
+
+
+class RequestCoalescer:
+    """
+    Coalesces identical concurrent requests, so that only the first one (the leader) calls the approach
+    and the others (the followers) attach to its in-flight result. Nothing is kept once the result is complete.
+    Callers are responsible for only sharing a key between requests that are allowed to see the same answer.
+    """
+
+    def __init__(self):
+        self.leaders = 0
+        self.followers = 0
+        self._results: dict[Hashable, asyncio.Future] = {}
+        self._streams: dict[Hashable, StreamFlight] = {}
+
+    async def run(
+        self, key: Hashable, call: Callable[[], Awaitable[dict[str, Any]]], session_state: Any = None
+    ) -> dict[str, Any]:
+        future = self._results.get(key)
+        if future is None:
+            self.leaders += 1
+            future = asyncio.ensure_future(call())
+            self._results[key] = future
+            future.add_done_callback(lambda done: self._results.pop(key, None))
+        else:
+            self.followers += 1
+        # Shield the shared call, so that a cancelled caller doesn't cancel it for the others
+        return with_session_state(await asyncio.shield(future), session_state)
+
+    def stream(
+        self,
+        key: Hashable,
+        open_stream: Callable[[], Awaitable[AsyncIterator[dict[str, Any]]]],
+        session_state: Any = None,
+    ) -> AsyncGenerator[dict[str, Any], None]:
+        flight = self._streams.get(key)
+        if flight is None:
+            self.leaders += 1
+            flight = StreamFlight(open_stream, on_done=lambda: self._finish_stream(key, flight))
+            self._streams[key] = flight
+        else:
+            self.followers += 1
+        return flight.subscribe(session_state)
+
+    def _finish_stream(self, key: Hashable, flight: Optional[StreamFlight]):
+        if self._streams.get(key) is flight:
+            del self._streams[key]
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "leaders": self.leaders,
+            "followers": self.followers,
+            "in_flight": len(self._results) + len(self._streams),
+        }
@@ -0,0 +1,61 @@
+import re
+from typing import Optional
+
+# Number of words of each shingle compared between sources
+SHINGLE_SIZE = 5
+
+
+def shingles(text: str) -> set[int]:
+    """
+    Returns the hashes of the overlapping sequences of SHINGLE_SIZE words of a text,
+    ignoring case, spacing and punctuation.
+    """
+    words = re.findall(r"\w+", text.lower())
+    if len(words) <= SHINGLE_SIZE:
+        return {hash(" ".join(words))}
+    return {hash(" ".join(words[i : i + SHINGLE_SIZE])) for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+
+def merge_overlapping(text: str, other_text: str, min_overlap: int) -> Optional[str]:
+    """
+    Returns the text made of two chunks when one of them contains the other, or when one ends with
+    at least min_overlap characters that the other starts with, as chunks split with an overlap do.
+    Returns None if the chunks don't overlap.
+    """
+    if other_text in text:
+        return text
+    if text in other_text:
+        return other_text
+    for first, second in ((text, other_text), (other_text, text)):
+        if len(second) < min_overlap:
+            continue
+        # Each occurrence of the start of the second chunk in the first one may be where the overlap starts
+        start = first.find(second[:min_overlap])
+        while start != -1:
+            if second.startswith(first[start:]):
+                return first[:start] + second
+            start = first.find(second[:min_overlap], start + 1)
+    return None
+
+
+def deduplicate_sources(sources: list[str], min_overlap: int = 20, max_similarity: float = 0.9) -> list[str]:
+    """
+    Returns the sources, formatted as "citation: content", without repeated content:
+    overlapping chunks with the same citation are merged into the first one, and a source whose shingles
+    are at least max_similarity contained in an earlier source is left out.
+    """
+    kept: list[tuple[str, str, set[int]]] = []
+    for source in sources:
+        citation, _, content = source.partition(": ")
+        for index, (kept_citation, kept_content, _) in enumerate(kept):
+            if kept_citation == citation and (merged := merge_overlapping(kept_content, content, min_overlap)):
+                kept[index] = (citation, merged, shingles(merged))
+                break
+        else:
+            content_shingles = shingles(content)
+            if not any(
+                len(content_shingles & kept_shingles) >= max_similarity * len(content_shingles)
+                for _, _, kept_shingles in kept
+            ):
+                kept.append((citation, content, content_shingles))
+    return [f"{citation}: {content}" for citation, content, _ in kept]
@@ -0,0 +1,46 @@
+import re
+
+from .modelhelper import get_encoding, token_counter
+
+# The end of a sentence: a full stop, question or exclamation mark followed by whitespace or the end of the text
+SENTENCE_END = re.compile(r"[.!?。！？](?=\s|$)")
+
+
+def truncate_at_sentence(text: str, max_tokens: int, model: str, min_length: int = 0) -> str:
+    """
+    Returns the longest start of the text that fits in max_tokens tokens and ends a sentence,
+    or an empty string if no sentence ends after the first min_length characters.
+    """
+    if max_tokens <= 0:
+        return ""
+    encoding = get_encoding(model)
+    tokens = encoding.encode(text)
+    if len(tokens) <= max_tokens:
+        return text
+    start = encoding.decode(tokens[:max_tokens])
+    end = max((match.end() for match in SENTENCE_END.finditer(start, min_length)), default=0)
+    return start[:end]
+
+
+def pack_sources(sources: list[str], max_tokens: int, model: str) -> list[str]:
+    """
+    Returns the sources, in their ranking order, that fit in max_tokens tokens once joined by newlines.
+    A source that doesn't fit is truncated at the end of a sentence, or left out if not even one sentence fits,
+    and the following sources are still added if they fit.
+    Sources are formatted as "citation: content", and are never truncated to their citation alone.
+    """
+    packed = []
+    remaining = max_tokens
+    # Counts are cached by content, so the sources retrieved again in later turns are not encoded again
+    for source, count in zip(sources, token_counter.count_texts(sources, model)):
+        # The newline between sources is counted as one more token
+        if count + 1 > remaining:
+            source = truncate_at_sentence(source, remaining - 1, model, min_length=source.find(": ") + 2)
+            if not source:
+                continue
+            count = token_counter.count_texts([source], model)[0]
+            if count + 1 > remaining:
+                continue
+        packed.append(source)
+        remaining -= count + 1
+    return packed
@@ -0,0 +1,65 @@
+import asyncio
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+class SQLiteTable:
+    """
+    A table of expiring rows in a SQLite database, shared by the worker processes of an instance.
+    Rows whose expires_at column has passed are deleted once every PURGE_INTERVAL writes.
+    Attributes:
+        path (str): The path of the database file.
+        name (str): The name of the table, which must have an expires_at column.
+    """
+
+    PURGE_INTERVAL = 100
+
+    def __init__(self, path: str, name: str, columns: str):
+        self.path = path
+        self.name = name
+        self.columns = columns
+        self._writes = 0
+        self._connection: Optional[sqlite3.Connection] = None
+        # A single thread owns the connection, so that the event loop never waits on the database
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=name)
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            connection = sqlite3.connect(self.path, timeout=5)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(f"CREATE TABLE IF NOT EXISTS {self.name} ({self.columns})")
+            connection.commit()
+            self._connection = connection
+        return self._connection
+
+    def _write(self, operation: Callable[[sqlite3.Connection], T]) -> T:
+        connection = self._connect()
+        with connection:
+            result = operation(connection)
+            self._writes += 1
+            if self._writes % self.PURGE_INTERVAL == 0:
+                connection.execute(f"DELETE FROM {self.name} WHERE expires_at < ?", (time.time(),))
+        return result
+
+    async def read(self, operation: Callable[[sqlite3.Connection], T]) -> T:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, lambda: operation(self._connect()))
+
+    async def write(self, operation: Callable[[sqlite3.Connection], T]) -> T:
+        """
+        Runs an operation in a transaction, and deletes the expired rows if it is time to.
+        """
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self._write, operation)
+
+    async def close(self):
+        def close_connection():
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+        await asyncio.get_running_loop().run_in_executor(self._executor, close_connection)
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,157 @@
+import asyncio
+from typing import Any, AsyncGenerator, AsyncIterator, Optional
+
+from openai.types.chat import ChatCompletionChunk
+from openai.types.chat.chat_completion_chunk import Choice, ChoiceDelta
+from pydantic import BaseModel
+
+# The fields chunk_to_dict reads, in the order model_dump writes them
+CHUNK_FIELDS = ("id", "choices", "created", "model", "object", "system_fingerprint")
+CHOICE_FIELDS = ("delta", "finish_reason", "index")
+DELTA_FIELDS = ("content", "function_call", "role", "tool_calls")
+
+
+def has_fields(model_class: type[BaseModel], names: tuple[str, ...]) -> bool:
+    return tuple(model_class.model_fields) == names
+
+
+# Other versions of the SDK may add fields (like logprobs), in which case chunks are dumped with model_dump
+CAN_PROJECT_CHUNKS = (
+    has_fields(ChatCompletionChunk, CHUNK_FIELDS)
+    and has_fields(Choice, CHOICE_FIELDS)
+    and has_fields(ChoiceDelta, DELTA_FIELDS)
+)
+
+
+def chunk_to_dict(chunk: ChatCompletionChunk) -> dict[str, Any]:
+    """
+    Returns the same dict as chunk.model_dump(), reading the fields of the chunk directly instead of
+    going through pydantic's serializer, which is costly when called for every streamed token.
+    Chunks with function or tool calls, which need nested models to be dumped, fall back to model_dump,
+    and so do all chunks when the models of the installed SDK don't have exactly the fields read here.
+    """
+    if not CAN_PROJECT_CHUNKS or type(chunk) is not ChatCompletionChunk:
+        return chunk.model_dump()
+    choices = []
+    for choice in chunk.choices:
+        delta = choice.delta
+        if delta.function_call is not None or delta.tool_calls is not None:
+            return chunk.model_dump()
+        choices.append(
+            {
+                "delta": {
+                    "content": delta.content,
+                    "function_call": None,
+                    "role": delta.role,
+                    "tool_calls": None,
+                    # Fields unknown to the SDK, for example Azure OpenAI's content filter results, come last
+                    **(delta.model_extra or {}),
+                },
+                "finish_reason": choice.finish_reason,
+                "index": choice.index,
+                **(choice.model_extra or {}),
+            }
+        )
+    return {
+        "id": chunk.id,
+        "choices": choices,
+        "created": chunk.created,
+        "model": chunk.model,
+        "object": chunk.object,
+        "system_fingerprint": chunk.system_fingerprint,
+        **(chunk.model_extra or {}),
+    }
+
+
+def get_delta_content(event: dict[str, Any]) -> Optional[str]:
+    """
+    Returns the content of an event that only adds answer text, or None for any other event.
+    """
+    choices = event.get("choices")
+    if not choices or len(choices) != 1:
+        return None
+    choice = choices[0]
+    if "context" in choice or choice.get("finish_reason") is not None:
+        return None
+    delta = choice.get("delta") or {}
+    content = delta.get("content")
+    if not isinstance(content, str) or delta.get("function_call") or delta.get("tool_calls"):
+        return None
+    return content
+
+
+class ChunkCoalescer:
+    """
+    Merges the answer text of consecutive streamed events, so that a response is sent in fewer, larger writes.
+    Merged text is sent once it reaches max_chars characters, or max_delay seconds after it started buffering.
+    The first answer text and every other event (context, follow-up questions, the end of the answer or an error)
+    are sent immediately, after any buffered text.
+    """
+
+    def __init__(self, max_chars: int, max_delay: float):
+        self.max_chars = max_chars
+        self.max_delay = max_delay
+
+    async def coalesce(self, events: AsyncIterator[dict[str, Any]]) -> AsyncGenerator[dict[str, Any], None]:
+        # The events are read by a separate task, so that buffered text can be sent while waiting for the next one
+        queue: asyncio.Queue = asyncio.Queue()
+        producer = asyncio.ensure_future(self._produce(events, queue))
+        loop = asyncio.get_running_loop()
+        buffered: Optional[dict[str, Any]] = None
+        parts: list[str] = []
+        size = 0
+        deadline = 0.0
+        first_content_sent = False
+        next_item = asyncio.ensure_future(queue.get())
+        try:
+            while True:
+                if buffered is not None:
+                    # Waiting on the same get rather than cancelling it on timeout, so that no event can be lost
+                    await asyncio.wait({next_item}, timeout=max(deadline - loop.time(), 0))
+                    if not next_item.done():
+                        yield self._merge(buffered, parts)
+                        buffered, parts, size = None, [], 0
+                        continue
+                item = await next_item
+                next_item = asyncio.ensure_future(queue.get())
+                if isinstance(item, dict) and (content := get_delta_content(item)) is not None:
+                    if not first_content_sent:
+                        # Send the first answer text right away, so that the time to first token doesn't change
+                        first_content_sent = bool(content)
+                        yield item
+                        continue
+                    if buffered is None:
+                        buffered = item
+                        deadline = loop.time() + self.max_delay
+                    parts.append(content)
+                    size += len(content)
+                    if size >= self.max_chars:
+                        yield self._merge(buffered, parts)
+                        buffered, parts, size = None, [], 0
+                    continue
+                if buffered is not None:
+                    yield self._merge(buffered, parts)
+                    buffered, parts, size = None, [], 0
+                if item is None:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            next_item.cancel()
+            producer.cancel()
+
+    async def _produce(self, events: AsyncIterator[dict[str, Any]], queue: asyncio.Queue):
+        try:
+            async for event in events:
+                await queue.put(event)
+        except Exception as error:
+            await queue.put(error)
+        finally:
+            await queue.put(None)
+
+    def _merge(self, event: dict[str, Any], parts: list[str]) -> dict[str, Any]:
+        if len(parts) == 1:
+            return event
+        choice = event["choices"][0]
+        return {**event, "choices": [{**choice, "delta": {**choice["delta"], "content": "".join(parts)}}]}
@@ -0,0 +1,76 @@
+import dataclasses
+import json
+import secrets
+import sqlite3
+import time
+from typing import Any, Optional
+
+from .sqlitetable import SQLiteTable
+
+
+class ThoughtStore:
+    """
+    A short-lived store of the heavy thoughts (the search results and the prompt) left out of lean responses,
+    so that they are only sent to the users who open the thought process.
+    Thoughts are kept in a SQLite database, so that every worker process of an instance can serve them,
+    and can only be fetched by the user they were made for.
+    Attributes:
+        ttl (float): The number of seconds a thought can be fetched for.
+    """
+
+    HEAVY_THOUGHT_TITLES = ("Results", "Prompt")
+
+    def __init__(self, path: str, ttl: float = 600):
+        self.ttl = ttl
+        self.table = SQLiteTable(
+            path,
+            "thoughts",
+            "id TEXT PRIMARY KEY, owner TEXT, expires_at REAL NOT NULL, description TEXT NOT NULL",
+        )
+
+    async def make_lean(self, thoughts: list[Any], owner: Optional[str]) -> list[Any]:
+        """
+        Stores the description of each heavy thought, and returns a copy of the thoughts
+        where it is replaced by the ID to fetch it with.
+        """
+        expires_at = time.time() + self.ttl
+        lean_thoughts = []
+        rows = []
+        for thought in thoughts:
+            if thought.title in self.HEAVY_THOUGHT_TITLES and thought.description is not None:
+                thought_id = secrets.token_urlsafe(16)
+                rows.append((thought_id, owner, expires_at, thought.description))
+                thought = dataclasses.replace(
+                    thought, description=None, props={**(thought.props or {}), "thought_id": thought_id}
+                )
+            lean_thoughts.append(thought)
+        if rows:
+
+            def insert(connection: sqlite3.Connection):
+                connection.executemany(
+                    "INSERT INTO thoughts (id, owner, expires_at, description) VALUES (?, ?, ?, ?)",
+                    [
+                        (thought_id, owner, expires_at, json.dumps(description, ensure_ascii=False))
+                        for thought_id, owner, expires_at, description in rows
+                    ],
+                )
+
+            await self.table.write(insert)
+        return lean_thoughts
+
+    async def get(self, thought_id: str, owner: Optional[str]) -> Optional[Any]:
+        """
+        Returns the description of a stored thought, or None if it expired or belongs to another user.
+        """
+
+        def select(connection: sqlite3.Connection) -> Optional[Any]:
+            row = connection.execute(
+                "SELECT description FROM thoughts WHERE id = ? AND owner IS ? AND expires_at >= ?",
+                (thought_id, owner, time.time()),
+            ).fetchone()
+            return json.loads(row[0]) if row else None
+
+        return await self.table.read(select)
+
+    async def close(self):
+        await self.table.close()
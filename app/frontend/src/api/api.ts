@@ -49,6 +49,20 @@ export async function chatApi(request: ChatAppRequest, idToken: string | undefin
     });
 }
 
+export async function thoughtApi(thoughtId: string, idToken: string | undefined): Promise<any> {
+    const response = await fetch(`${BACKEND_URI}/thoughts/${encodeURIComponent(thoughtId)}`, {
+        method: "GET",
+        headers: getHeaders(idToken)
+    });
+
+    const parsedResponse = await response.json();
+    if (response.status > 299 || !response.ok) {
+        throw Error(parsedResponse.error || "Unknown error");
+    }
+
+    return parsedResponse.description;
+}
+
 export function getCitationFilePath(citation: string): string {
     return `${BACKEND_URI}/content/${citation}`;
 }
@@ -32,6 +32,7 @@ export type ChatAppRequestOverrides = {
     use_gpt4v?: boolean;
     gpt4v_input?: GPT4VInput;
     vector_fields: VectorFieldOptions[];
+    lean_thoughts?: boolean;
 };
 
 export type ResponseMessage = {
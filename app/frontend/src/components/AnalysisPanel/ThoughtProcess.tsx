@@ -1,41 +1,80 @@
+import { useEffect, useState } from "react";
 import { Stack } from "@fluentui/react";
 import SyntaxHighlighter from "react-syntax-highlighter";
+import { useMsal } from "@azure/msal-react";
 
 import styles from "./AnalysisPanel.module.css";
 
-import { Thoughts } from "../../api";
+import { Thoughts, thoughtApi } from "../../api";
+import { useLogin, getToken } from "../../authConfig";
 
 interface Props {
     thoughts: Thoughts[];
 }
 
+// Lean responses leave out the description of heavy thoughts, which is fetched when the thought process is opened
+const useThoughtDescription = (thought: Thoughts): any => {
+    const client = useLogin ? useMsal().instance : undefined;
+    const thoughtId: string | undefined = thought.description == null ? thought.props?.thought_id : undefined;
+    const [description, setDescription] = useState<any>(thought.description);
+
+    useEffect(() => {
+        setDescription(thought.description);
+        if (!thoughtId) {
+            return;
+        }
+        let cancelled = false;
+        (async () => {
+            const token = client ? await getToken(client) : undefined;
+            try {
+                const fetched = await thoughtApi(thoughtId, token);
+                !cancelled && setDescription(fetched);
+            } catch {
+                !cancelled && setDescription("This thought is no longer available.");
+            }
+        })();
+        return () => {
+            cancelled = true;
+        };
+    }, [thought, thoughtId]);
+
+    return description;
+};
+
+const ThoughtItem = ({ thought }: { thought: Thoughts }) => {
+    const description = useThoughtDescription(thought);
+    const props = thought.props && Object.keys(thought.props).filter(k => k !== "thought_id");
+
+    return (
+        <li className={styles.tListItem}>
+            <div className={styles.tStep}>{thought.title}</div>
+            {Array.isArray(description) ? (
+                <SyntaxHighlighter language="json" wrapLongLines className={styles.tCodeBlock}>
+                    {JSON.stringify(description, null, 2)}
+                </SyntaxHighlighter>
+            ) : (
+                <>
+                    <div>{description}</div>
+                    <Stack horizontal tokens={{ childrenGap: 5 }}>
+                        {props &&
+                            props.map((k: any) => (
+                                <span className={styles.tProp}>
+                                    {k}: {JSON.stringify(thought.props?.[k])}
+                                </span>
+                            ))}
+                    </Stack>
+                </>
+            )}
+        </li>
+    );
+};
+
 export const ThoughtProcess = ({ thoughts }: Props) => {
     return (
         <ul className={styles.tList}>
-            {thoughts.map(t => {
-                return (
-                    <li className={styles.tListItem}>
-                        <div className={styles.tStep}>{t.title}</div>
-                        {Array.isArray(t.description) ? (
-                            <SyntaxHighlighter language="json" wrapLongLines className={styles.tCodeBlock}>
-                                {JSON.stringify(t.description, null, 2)}
-                            </SyntaxHighlighter>
-                        ) : (
-                            <>
-                                <div>{t.description}</div>
-                                <Stack horizontal tokens={{ childrenGap: 5 }}>
-                                    {t.props &&
-                                        (Object.keys(t.props) || []).map((k: any) => (
-                                            <span className={styles.tProp}>
-                                                {k}: {JSON.stringify(t.props?.[k])}
-                                            </span>
-                                        ))}
-                                </Stack>
-                            </>
-                        )}
-                    </li>
-                );
-            })}
+            {thoughts.map(t => (
+                <ThoughtItem thought={t} />
+            ))}
         </ul>
     );
 };
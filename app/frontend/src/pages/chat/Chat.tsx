@@ -129,8 +129,11 @@ const Chat = () => {
                 { content: a[1].choices[0].message.content, role: "assistant" }
             ]);
 
+            // ChatAppProtocol: Client must pass on any session state received from the server
+            const sessionState = answers.length ? answers[answers.length - 1][1].choices[0].session_state : null;
             const request: ChatAppRequest = {
-                messages: [...messages, { content: question, role: "user" }],
+                // A session state references the conversation kept on the server, which only needs the new message
+                messages: sessionState ? [{ content: question, role: "user" }] : [...messages, { content: question, role: "user" }],
                 stream: shouldStream,
                 context: {
                     overrides: {
@@ -148,11 +151,14 @@ const Chat = () => {
                         gpt4v_input: gpt4vInput
                     }
                 },
-                // ChatAppProtocol: Client must pass on any session state received from the server
-                session_state: answers.length ? answers[answers.length - 1][1].choices[0].session_state : null
+                session_state: sessionState
             };
 
-            const response = await chatApi(request, token);
+            let response = await chatApi(request, token);
+            if (response.status === 410) {
+                // The conversation expired on the server, so start a new one with all of its messages
+                response = await chatApi({ ...request, messages: [...messages, { content: question, role: "user" }], session_state: null }, token);
+            }
             if (!response.body) {
                 throw Error("No response body");
             }
@@ -2,6 +2,7 @@ import datetime
 import io
 import os
 import re
+import time
 from typing import List, Optional, Union
 
 import fitz  # type: ignore
@@ -19,6 +20,8 @@ class BlobManager:
     Class to manage uploading and deleting blobs containing citation information from a blob storage account
     """
 
+    SEARCH_GENERATION_METADATA = "search_generation"
+
     def __init__(
         self,
         endpoint: str,
@@ -145,6 +148,21 @@ class BlobManager:
                     print(f"\tRemoving blob {blob_path}")
                 await container_client.delete_blob(blob_path)
 
+    async def bump_search_generation(self):
+        """
+        Records that the indexed content changed, so that the app drops its cached search results.
+        The app reads this container metadata periodically when its search cache is enabled.
+        """
+        async with BlobServiceClient(
+            account_url=self.endpoint, credential=self.credential
+        ) as service_client, service_client.get_container_client(self.container) as container_client:
+            if not await container_client.exists():
+                return
+            properties = await container_client.get_container_properties()
+            metadata = dict(properties.metadata or {})
+            metadata[BlobManager.SEARCH_GENERATION_METADATA] = str(time.time_ns())
+            await container_client.set_container_metadata(metadata)
+
     @classmethod
     def sourcepage_from_file_page(cls, filename, page=0) -> str:
         if os.path.splitext(filename)[1].lower() == ".pdf":
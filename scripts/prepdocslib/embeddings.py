@@ -190,32 +190,47 @@ class ImageEmbeddings:
     To learn more, please visit https://learn.microsoft.com/azure/ai-services/computer-vision/how-to/image-retrieval#call-the-vectorize-image-api
     """
 
-    def __init__(self, credential: str, endpoint: str, verbose: bool = False):
+    def __init__(self, credential: str, endpoint: str, verbose: bool = False, limit_per_host: int = 10):
         self.credential = credential
         self.endpoint = endpoint
         self.verbose = verbose
+        self.limit_per_host = limit_per_host
+        self.session: Optional[aiohttp.ClientSession] = None
+
+    def get_session(self) -> aiohttp.ClientSession:
+        # One pooled session is kept for the whole ingestion run, so connections are reused across files
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                headers={"Ocp-Apim-Subscription-Key": self.credential},
+                connector=aiohttp.TCPConnector(limit_per_host=self.limit_per_host, keepalive_timeout=30),
+            )
+        return self.session
 
     async def create_embeddings(self, blob_urls: List[str]) -> List[List[float]]:
-        headers = {"Ocp-Apim-Subscription-Key": self.credential}
         params = {"api-version": "2023-02-01-preview", "modelVersion": "latest"}
         endpoint = urljoin(self.endpoint, "computervision/retrieval:vectorizeImage")
         embeddings: List[List[float]] = []
-        async with aiohttp.ClientSession(headers=headers) as session:
-            for blob_url in blob_urls:
-                async for attempt in AsyncRetrying(
-                    retry=retry_if_exception_type(Exception),
-                    wait=wait_random_exponential(min=15, max=60),
-                    stop=stop_after_attempt(15),
-                    before_sleep=self.before_retry_sleep,
-                ):
-                    with attempt:
-                        body = {"url": blob_url}
-                        async with session.post(url=endpoint, params=params, json=body) as resp:
-                            resp_json = await resp.json()
-                            embeddings.append(resp_json["vector"])
+        session = self.get_session()
+        for blob_url in blob_urls:
+            async for attempt in AsyncRetrying(
+                retry=retry_if_exception_type(Exception),
+                wait=wait_random_exponential(min=15, max=60),
+                stop=stop_after_attempt(15),
+                before_sleep=self.before_retry_sleep,
+            ):
+                with attempt:
+                    body = {"url": blob_url}
+                    async with session.post(url=endpoint, params=params, json=body) as resp:
+                        resp_json = await resp.json()
+                        embeddings.append(resp_json["vector"])
 
         return embeddings
 
+    async def close(self):
+        if self.session:
+            await self.session.close()
+            self.session = None
+
     def before_retry_sleep(self, retry_state):
         if self.verbose:
             print("Rate limited on the Vision embeddings API, sleeping before retrying...")
@@ -57,31 +57,39 @@ class FileStrategy(Strategy):
 
     async def run(self, search_info: SearchInfo):
         search_manager = SearchManager(search_info, self.search_analyzer_name, self.use_acls, self.embeddings)
-        if self.document_action == DocumentAction.Add:
-            files = self.list_file_strategy.list()
-            async for file in files:
-                try:
-                    pages = [page async for page in self.pdf_parser.parse(content=file.content)]
-                    if search_info.verbose:
-                        print(f"Splitting '{file.filename()}' into sections")
-                    sections = [
-                        Section(split_page, content=file, category=self.category)
-                        for split_page in self.text_splitter.split_pages(pages)
-                    ]
+        try:
+            if self.document_action == DocumentAction.Add:
+                files = self.list_file_strategy.list()
+                async for file in files:
+                    try:
+                        pages = [page async for page in self.pdf_parser.parse(content=file.content)]
+                        if search_info.verbose:
+                            print(f"Splitting '{file.filename()}' into sections")
+                        sections = [
+                            Section(split_page, content=file, category=self.category)
+                            for split_page in self.text_splitter.split_pages(pages)
+                        ]
 
-                    blob_sas_uris = await self.blob_manager.upload_blob(file)
-                    blob_image_embeddings: Optional[List[List[float]]] = None
-                    if self.image_embeddings and blob_sas_uris:
-                        blob_image_embeddings = await self.image_embeddings.create_embeddings(blob_sas_uris)
-                    await search_manager.update_content(sections, blob_image_embeddings)
-                finally:
-                    if file:
-                        file.close()
-        elif self.document_action == DocumentAction.Remove:
-            paths = self.list_file_strategy.list_paths()
-            async for path in paths:
-                await self.blob_manager.remove_blob(path)
-                await search_manager.remove_content(path)
-        elif self.document_action == DocumentAction.RemoveAll:
-            await self.blob_manager.remove_blob()
-            await search_manager.remove_content()
+                        blob_sas_uris = await self.blob_manager.upload_blob(file)
+                        blob_image_embeddings: Optional[List[List[float]]] = None
+                        if self.image_embeddings and blob_sas_uris:
+                            blob_image_embeddings = await self.image_embeddings.create_embeddings(blob_sas_uris)
+                        await search_manager.update_content(sections, blob_image_embeddings)
+                    finally:
+                        if file:
+                            file.close()
+            elif self.document_action == DocumentAction.Remove:
+                paths = self.list_file_strategy.list_paths()
+                async for path in paths:
+                    await self.blob_manager.remove_blob(path)
+                    await search_manager.remove_content(path)
+            elif self.document_action == DocumentAction.RemoveAll:
+                await self.blob_manager.remove_blob()
+                await search_manager.remove_content()
+        finally:
+            try:
+                # Even a failed run may have changed the index, so the cached search results are stale
+                await self.blob_manager.bump_search_generation()
+            finally:
+                if self.image_embeddings:
+                    await self.image_embeddings.close()
@@ -0,0 +1,104 @@
+"""
+Microbenchmark of ChatApproach.get_messages_from_history, comparing it with the previous implementation
+that inserted each history message in the middle of the list and counted its tokens one at a time.
+
+Run it from the repository root with:
+    python tests/benchmark_history.py
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "app", "backend"))
+
+from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach  # noqa: E402
+from core.messagebuilder import MessageBuilder  # noqa: E402
+from core.modelhelper import token_counter  # noqa: E402
+
+MODEL = "gpt-35-turbo"
+
+
+def make_approach() -> ChatReadRetrieveReadApproach:
+    return ChatReadRetrieveReadApproach(
+        search_client=None,
+        auth_helper=None,
+        openai_client=None,
+        chatgpt_model=MODEL,
+        chatgpt_deployment="chat",
+        embedding_deployment="embeddings",
+        embedding_model="text-",
+        sourcepage_field="",
+        content_field="",
+        query_language="en-us",
+        query_speller="lexicon",
+    )
+
+
+def make_history(turns: int) -> list[dict[str, str]]:
+    history = []
+    for turn in range(turns):
+        history.append(
+            {"role": "user", "content": f"Question {turn}: what does my plan cover for visit number {turn}?"}
+        )
+        history.append(
+            {
+                "role": "assistant",
+                "content": f"Answer {turn}: the plan covers in-network visits, see the benefits guide [Benefit_Options-{turn}.pdf].",
+            }
+        )
+    history.append({"role": "user", "content": "And what about out of network providers?"})
+    return history
+
+
+def legacy_get_messages_from_history(approach, system_prompt, model_id, history, user_content, max_tokens, few_shots):
+    message_builder = MessageBuilder(system_prompt, model_id)
+    for shot in reversed(few_shots):
+        message_builder.insert_message(shot.get("role"), shot.get("content"))
+    append_index = len(few_shots) + 1
+    message_builder.insert_message(approach.USER, user_content, index=append_index)
+    total_token_count = message_builder.count_tokens_for_message(dict(message_builder.messages[-1]))
+    for message in reversed(history[:-1]):
+        potential_message_count = message_builder.count_tokens_for_message(message)
+        if (total_token_count + potential_message_count) > max_tokens:
+            break
+        message_builder.insert_message(message["role"], message["content"], index=append_index)
+        total_token_count += potential_message_count
+    return message_builder.messages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--turns", type=int, nargs="+", default=[10, 50, 200])
+    parser.add_argument("--number", type=int, default=200, help="Calls per measurement")
+    parser.add_argument("--cold", action="store_true", help="Clear the memoized token counts before every call")
+    parser.add_argument("--keep", type=float, default=0.5, help="Share of the history tokens that fit in the budget")
+    args = parser.parse_args()
+
+    approach = make_approach()
+    print(f"{'turns':>6} {'legacy (ms)':>12} {'packed (ms)':>12} {'speedup':>8}")
+    for turns in args.turns:
+        history = make_history(turns)
+        # By default, a budget that keeps about half of the history, so that both the scan and the cutoff are exercised
+        max_tokens = int(sum(token_counter.count_messages(history, MODEL)) * args.keep)
+        call_args = ("You are a helpful assistant.", MODEL, history, history[-1]["content"], max_tokens)
+
+        def legacy():
+            if args.cold:
+                token_counter.counts.clear()
+            return legacy_get_messages_from_history(approach, *call_args, approach.query_prompt_few_shots)
+
+        def packed():
+            if args.cold:
+                token_counter.counts.clear()
+            return approach.get_messages_from_history(*call_args, few_shots=approach.query_prompt_few_shots)
+
+        assert legacy() == packed(), f"Packed history differs from the legacy one at {turns} turns"
+        legacy_time = min(timeit.repeat(legacy, number=args.number, repeat=5)) / args.number
+        packed_time = min(timeit.repeat(packed, number=args.number, repeat=5)) / args.number
+        print(f"{turns:>6} {legacy_time * 1000:>12.3f} {packed_time * 1000:>12.3f} {legacy_time / packed_time:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
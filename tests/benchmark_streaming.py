@@ -0,0 +1,79 @@
+"""
+Benchmark of the serialization of streamed chat completion chunks, comparing model_dump and json.dumps
+with chunk_to_dict and the precompiled NDJSON encoder. It runs on a single thread, so it reports chunks/sec per core.
+
+Run it from the repository root with:
+    python tests/benchmark_streaming.py
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "app", "backend"))
+
+from openai.types.chat import ChatCompletionChunk  # noqa: E402
+
+from app import NDJSON_ENCODER, JSONEncoder  # noqa: E402
+from core.streaming import chunk_to_dict  # noqa: E402
+
+
+def make_chunks(count: int, content_filter_results: bool) -> list[ChatCompletionChunk]:
+    chunks = []
+    for index in range(count):
+        choice = {"delta": {"content": f" token{index}"}, "index": 0, "finish_reason": None}
+        if content_filter_results:
+            choice["content_filter_results"] = {
+                category: {"filtered": False, "severity": "safe"}
+                for category in ("hate", "self_harm", "sexual", "violence")
+            }
+        chunks.append(
+            ChatCompletionChunk.model_validate(
+                {
+                    "id": "chatcmpl-123",
+                    "object": "chat.completion.chunk",
+                    "created": 1,
+                    "model": "gpt-35-turbo",
+                    "choices": [choice],
+                }
+            )
+        )
+    return chunks
+
+
+def model_dump_lines(chunks: list[ChatCompletionChunk]) -> list[str]:
+    return [json.dumps(chunk.model_dump(), ensure_ascii=False, cls=JSONEncoder) + "\n" for chunk in chunks]
+
+
+def projected_lines(chunks: list[ChatCompletionChunk]) -> list[str]:
+    return [NDJSON_ENCODER.encode(chunk_to_dict(chunk)) + "\n" for chunk in chunks]
+
+
+def chunks_per_second(serialize, chunks: list[ChatCompletionChunk], repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        serialize(chunks)
+        best = min(best, time.perf_counter() - start)
+    return len(chunks) / best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chunks", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'chunks':<28} {'model_dump/s':>14} {'projected/s':>14} {'speedup':>8}")
+    for label, content_filter_results in (("OpenAI", False), ("Azure OpenAI content filters", True)):
+        chunks = make_chunks(args.chunks, content_filter_results)
+        assert model_dump_lines(chunks) == projected_lines(chunks), "The projected chunks don't match model_dump"
+        before = chunks_per_second(model_dump_lines, chunks, args.repeat)
+        after = chunks_per_second(projected_lines, chunks, args.repeat)
+        print(f"{label:<28} {before:>14,.0f} {after:>14,.0f} {after / before:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,8 @@
+import asyncio
 import json
 import logging
 import os
+import sys
 from unittest import mock
 
 import pytest
@@ -9,6 +11,9 @@ from httpx import Request, Response
 from openai import BadRequestError
 
 import app
+from core.conversationstore import MemoryConversationStore
+from core.historysummarizer import HistorySummarizer
+from core.thoughtstore import ThoughtStore
 
 
 def fake_response(http_code):
@@ -54,6 +59,41 @@ async def test_missing_env_vars():
                 test_app.test_client()
 
 
+@pytest.mark.asyncio
+async def test_sqlite_conversation_store_private_directory(monkeypatch, mock_env, tmp_path):
+    monkeypatch.setenv("CONVERSATION_STORE", "sqlite")
+    monkeypatch.setenv("APP_DATA_DIR", str(tmp_path / "data"))
+    quart_app = app.create_app()
+
+    async with quart_app.test_app() as test_app:
+        conversation_store = test_app.app.config[app.CONFIG_CONVERSATION_STORE]
+        assert conversation_store.table.path == str(tmp_path / "data" / "conversations.sqlite3")
+        assert os.stat(tmp_path / "data").st_mode & 0o777 == 0o700
+
+
+@pytest.mark.asyncio
+async def test_redis_conversation_store_not_installed(monkeypatch, mock_env):
+    monkeypatch.setenv("CONVERSATION_STORE", "redis")
+    monkeypatch.setenv("CONVERSATION_STORE_REDIS_URL", "redis://localhost:6379")
+    monkeypatch.setitem(sys.modules, "redis.asyncio", None)
+    quart_app = app.create_app()
+
+    with pytest.raises(quart.testing.app.LifespanError, match="The redis package must be installed"):
+        async with quart_app.test_app() as test_app:
+            test_app.test_client()
+
+
+@pytest.mark.asyncio
+async def test_invalid_skip_query_rewrite(monkeypatch, mock_env):
+    # A typo must not silently turn skipping on
+    monkeypatch.setenv("SKIP_QUERY_REWRITE", "none")
+    quart_app = app.create_app()
+
+    with pytest.raises(quart.testing.app.LifespanError, match="Unknown SKIP_QUERY_REWRITE value: none"):
+        async with quart_app.test_app() as test_app:
+            test_app.test_client()
+
+
 @pytest.mark.asyncio
 async def test_index(client):
     response = await client.get("/")
@@ -653,3 +693,193 @@ async def test_format_as_ndjson():
 
     result = [line async for line in app.format_as_ndjson(gen())]
     assert result == ['{"a": "I ❤️ 🐍"}\n', '{"b": "Newlines inside \\n strings are fine"}\n']
+
+
+@pytest.mark.asyncio
+async def test_chat_lean_thoughts(client, tmp_path):
+    client.app.config[app.CONFIG_THOUGHT_STORE] = ThoughtStore(str(tmp_path / "thoughts.sqlite3"))
+    response = await client.post(
+        "/chat",
+        json={
+            "messages": [{"content": "What is the capital of France?", "role": "user"}],
+            "context": {"overrides": {"retrieval_mode": "text", "lean_thoughts": True}},
+        },
+    )
+    assert response.status_code == 200
+    result = await response.get_json()
+    thoughts = {thought["title"]: thought for thought in result["choices"][0]["context"]["thoughts"]}
+    assert thoughts["Results"]["description"] is None
+    assert thoughts["Prompt"]["description"] is None
+    assert thoughts["Original user query"]["description"] == "What is the capital of France?"
+
+    response = await client.get(f"/thoughts/{thoughts['Results']['props']['thought_id']}")
+    assert response.status_code == 200
+    result = await response.get_json()
+    assert result["description"][0]["sourcepage"] == "Benefit_Options-2.pdf"
+
+    response = await client.get("/thoughts/unknown")
+    assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_chat_stream_lean_thoughts(client, tmp_path):
+    client.app.config[app.CONFIG_THOUGHT_STORE] = ThoughtStore(str(tmp_path / "thoughts.sqlite3"))
+    response = await client.post(
+        "/chat",
+        json={
+            "stream": True,
+            "messages": [{"content": "What is the capital of France?", "role": "user"}],
+            "context": {"overrides": {"retrieval_mode": "text", "lean_thoughts": True}},
+        },
+    )
+    assert response.status_code == 200
+    events = [json.loads(line) for line in (await response.get_data()).splitlines()]
+    thoughts = {thought["title"]: thought for thought in events[0]["choices"][0]["context"]["thoughts"]}
+    assert thoughts["Prompt"]["description"] is None
+
+    response = await client.get(f"/thoughts/{thoughts['Prompt']['props']['thought_id']}")
+    assert response.status_code == 200
+    result = await response.get_json()
+    assert (
+        result["description"][-1]
+        == "{'role': 'user', 'content': 'What is the capital of France?\\n\\nSources:\\nBenefit_Options-2.pdf: There is a whistleblower policy.'}"
+    )
+
+
+@pytest.mark.asyncio
+async def test_chat_lean_thoughts_disabled(client):
+    # Without LEAN_THOUGHTS there's no thought store, so the override is ignored
+    response = await client.post(
+        "/chat",
+        json={
+            "messages": [{"content": "What is the capital of France?", "role": "user"}],
+            "context": {"overrides": {"retrieval_mode": "text", "lean_thoughts": True}},
+        },
+    )
+    assert response.status_code == 200
+    result = await response.get_json()
+    thoughts = {thought["title"]: thought for thought in result["choices"][0]["context"]["thoughts"]}
+    assert thoughts["Results"]["description"][0]["sourcepage"] == "Benefit_Options-2.pdf"
+
+    response = await client.get("/thoughts/unknown")
+    assert response.status_code == 404
+
+
+def test_make_private_directory(tmp_path):
+    path = app.make_private_directory(str(tmp_path / "data"))
+    assert os.stat(path).st_mode & 0o777 == 0o700
+
+    shared_path = tmp_path / "shared"
+    shared_path.mkdir(mode=0o777)
+    shared_path.chmod(0o777)
+    with pytest.raises(ValueError):
+        app.make_private_directory(str(shared_path))
+
+
+@pytest.mark.asyncio
+async def test_thoughts_other_user(auth_client, tmp_path):
+    auth_client.config[app.CONFIG_THOUGHT_STORE] = ThoughtStore(str(tmp_path / "thoughts.sqlite3"))
+    response = await auth_client.post(
+        "/ask",
+        headers={"Authorization": "Bearer MockToken"},
+        json={
+            "messages": [{"content": "What is the capital of France?", "role": "user"}],
+            "context": {"overrides": {"retrieval_mode": "text", "lean_thoughts": True}},
+        },
+    )
+    assert response.status_code == 200
+    result = await response.get_json()
+    thoughts = {thought["title"]: thought for thought in result["choices"][0]["context"]["thoughts"]}
+    thought_id = thoughts["Results"]["props"]["thought_id"]
+
+    response = await auth_client.get(f"/thoughts/{thought_id}", headers={"Authorization": "Bearer MockToken"})
+    assert response.status_code == 200
+    # Without a token, the thought can't be fetched by anyone but its owner
+    response = await auth_client.get(f"/thoughts/{thought_id}")
+    assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("stream", [False, True])
+async def test_chat_conversation_store(client, stream):
+    conversation_store = MemoryConversationStore("gpt-35-turbo", 60, max_bytes=1024 * 1024)
+    client.app.config[app.CONFIG_CONVERSATION_STORE] = conversation_store
+
+    async def post(messages, session_state):
+        response = await client.post(
+            "/chat",
+            json={
+                "stream": stream,
+                "messages": messages,
+                "context": {"overrides": {"retrieval_mode": "text"}},
+                "session_state": session_state,
+            },
+        )
+        if not stream or response.status_code != 200:
+            return response.status_code, await response.get_json()
+        events = [json.loads(line) for line in (await response.get_data()).splitlines()]
+        content = "".join(event["choices"][0]["delta"].get("content") or "" for event in events if event["choices"])
+        return 200, {
+            "choices": [{"message": {"content": content}, "session_state": events[0]["choices"][0]["session_state"]}]
+        }
+
+    status, result = await post([{"content": "What is the capital of France?", "role": "user"}], None)
+    assert status == 200
+    conversation_id = result["choices"][0]["session_state"]
+    answer = result["choices"][0]["message"]["content"]
+
+    # The next turn only sends the new message
+    status, result = await post([{"content": "And of Spain?", "role": "user"}], conversation_id)
+    assert status == 200
+    assert result["choices"][0]["session_state"] == conversation_id
+    conversation = await conversation_store.get(conversation_id, None)
+    assert conversation.messages == [
+        {"content": "What is the capital of France?", "role": "user"},
+        {"content": answer, "role": "assistant"},
+        {"content": "And of Spain?", "role": "user"},
+        {"content": result["choices"][0]["message"]["content"], "role": "assistant"},
+    ]
+    assert len(conversation.token_counts) == 4
+
+    status, result = await post([{"content": "And of Italy?", "role": "user"}], "expired")
+    assert status == 410
+
+
+@pytest.mark.asyncio
+async def test_chat_history_summarizer(client):
+    conversation_store = MemoryConversationStore("gpt-35-turbo", 60, max_bytes=1024 * 1024)
+    summarizer = HistorySummarizer(
+        client.app.config[app.CONFIG_OPENAI_CLIENT], "gpt-35-turbo", None, conversation_store, 1, keep_messages=0
+    )
+    client.app.config[app.CONFIG_CONVERSATION_STORE] = conversation_store
+    client.app.config[app.CONFIG_HISTORY_SUMMARIZER] = summarizer
+
+    response = await client.post(
+        "/chat",
+        json={
+            "messages": [{"content": "What is the capital of France?", "role": "user"}],
+            "context": {"overrides": {"retrieval_mode": "text"}},
+        },
+    )
+    assert response.status_code == 200
+    conversation_id = (await response.get_json())["choices"][0]["session_state"]
+    await asyncio.gather(*summarizer._tasks.values())
+
+    conversation = await conversation_store.get(conversation_id, None)
+    assert conversation.summarized_count == 2
+    assert conversation.summary.startswith(HistorySummarizer.SUMMARY_PREFIX)
+
+    # The next turn is answered from the summary instead of the summarized messages
+    response = await client.post(
+        "/chat",
+        json={
+            "messages": [{"content": "And of Spain?", "role": "user"}],
+            "context": {"overrides": {"retrieval_mode": "text"}},
+            "session_state": conversation_id,
+        },
+    )
+    assert response.status_code == 200
+    thoughts = (await response.get_json())["choices"][0]["context"]["thoughts"]
+    prompt = next(thought for thought in thoughts if thought["title"] == "Prompt")["description"]
+    assert any("'role': 'system', 'content': 'Summary of the earlier conversation" in message for message in prompt)
+    assert not any("What is the capital of France?" in message for message in prompt)
@@ -1,3 +1,10 @@
+import asyncio
+import base64
+import json
+import threading
+import time
+
+import msal
 import pytest
 from azure.search.documents.indexes.models import SearchField, SearchIndex
 
@@ -32,6 +39,49 @@ async def test_get_auth_claims_success(mock_confidential_client_success):
     assert auth_claims.get("groups") == ["GROUP_Y", "GROUP_Z"]
 
 
+def create_jwt(claims: dict) -> str:
+    payload = base64.urlsafe_b64encode(json.dumps(claims).encode()).decode().rstrip("=")
+    return f"eyJhbGciOiJub25lIn0.{payload}.signature"
+
+
+@pytest.mark.asyncio
+async def test_get_auth_claims_cached(monkeypatch):
+    exchanges = []
+
+    def mock_acquire_token_on_behalf_of(self, *args, **kwargs):
+        # The exchange runs off the event loop thread
+        exchanges.append((kwargs["user_assertion"], threading.current_thread().name))
+        return {"access_token": "MockToken", "id_token_claims": {"oid": "OID_X", "groups": ["GROUP_Y"]}}
+
+    monkeypatch.setattr(msal.ConfidentialClientApplication, "__init__", lambda self, *args, **kwargs: None)
+    monkeypatch.setattr(
+        msal.ConfidentialClientApplication, "acquire_token_on_behalf_of", mock_acquire_token_on_behalf_of
+    )
+    helper = create_authentication_helper()
+    token = create_jwt({"oid": "OID_X", "exp": time.time() + 3600})
+
+    for _ in range(3):
+        auth_claims = await helper.get_auth_claims_if_enabled(headers={"Authorization": f"Bearer {token}"})
+        assert auth_claims == {"oid": "OID_X", "groups": ["GROUP_Y"]}
+    assert len(exchanges) == 1
+    assert exchanges[0][0] == token
+    assert exchanges[0][1].startswith("obo")
+
+    # Expired tokens and tokens without a readable expiry are not cached
+    for other_token in [create_jwt({"oid": "OID_X", "exp": time.time() - 10}), "Token"]:
+        await helper.get_auth_claims_if_enabled(headers={"Authorization": f"Bearer {other_token}"})
+        await helper.get_auth_claims_if_enabled(headers={"Authorization": f"Bearer {other_token}"})
+    assert len(exchanges) == 5
+    await helper.close()
+
+
+def test_get_token_expiry():
+    assert AuthenticationHelper.get_token_expiry(create_jwt({"exp": 1700000000})) == 1700000000
+    assert AuthenticationHelper.get_token_expiry(create_jwt({"oid": "OID_X"})) is None
+    assert AuthenticationHelper.get_token_expiry("Token") is None
+    assert AuthenticationHelper.get_token_expiry("a.!!!.c") is None
+
+
 @pytest.mark.asyncio
 async def test_get_auth_claims_unauthorized(mock_confidential_client_unauthorized):
     helper = create_authentication_helper()
@@ -184,3 +234,43 @@ def test_build_security_filters(mock_confidential_client_success):
         )
         == "oids/any(g:search.in(g, ''))"
     )
+
+
+@pytest.mark.asyncio
+async def test_get_groups_cached(monkeypatch):
+    now = 1000.0
+    monkeypatch.setattr("core.authentication.time.monotonic", lambda: now)
+    monkeypatch.setattr("core.cache.time.monotonic", lambda: now)
+    calls = []
+
+    async def mock_list_groups(graph_resource_access_token, session=None):
+        calls.append(graph_resource_access_token["access_token"])
+        return [f"GROUP_{len(calls)}"]
+
+    monkeypatch.setattr(AuthenticationHelper, "list_groups", mock_list_groups)
+    helper = AuthenticationHelper(
+        search_index=None,
+        use_authentication=False,
+        server_app_id=None,
+        server_app_secret=None,
+        client_app_id=None,
+        tenant_id=None,
+        groups_cache_ttl=60,
+    )
+
+    assert await helper.get_groups("OID_X", {"access_token": "Token1"}) == ["GROUP_1"]
+    assert await helper.get_groups("OID_X", {"access_token": "Token2"}) == ["GROUP_1"]
+    assert calls == ["Token1"]
+
+    # A stale entry is returned right away, and refreshed in the background
+    now += 120
+    assert await helper.get_groups("OID_X", {"access_token": "Token3"}) == ["GROUP_1"]
+    assert await helper.get_groups("OID_X", {"access_token": "Token4"}) == ["GROUP_1"]
+    await asyncio.sleep(0)
+    assert calls == ["Token1", "Token3"]
+    assert await helper.get_groups("OID_X", {"access_token": "Token5"}) == ["GROUP_2"]
+
+    # Past the maximum staleness, the groups are read again before answering
+    now += AuthenticationHelper.groups_max_staleness + 1
+    assert await helper.get_groups("OID_X", {"access_token": "Token6"}) == ["GROUP_3"]
+    await helper.close()
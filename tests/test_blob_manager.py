@@ -3,6 +3,7 @@ import sys
 from tempfile import NamedTemporaryFile
 
 import pytest
+from azure.storage.blob import ContainerProperties
 
 from .mocks import MockAzureCredential
 from scripts.prepdocslib.blobmanager import BlobManager
@@ -163,6 +164,33 @@ async def test_dont_remove_if_no_container(monkeypatch, mock_env, blob_manager):
     await blob_manager.remove_blob()
 
 
+@pytest.mark.asyncio
+@pytest.mark.skipif(sys.version_info.minor < 10, reason="requires Python 3.10 or higher")
+async def test_bump_search_generation(monkeypatch, mock_env, blob_manager):
+    async def mock_exists(*args, **kwargs):
+        return True
+
+    monkeypatch.setattr("azure.storage.blob.aio.ContainerClient.exists", mock_exists)
+
+    async def mock_get_container_properties(*args, **kwargs):
+        return ContainerProperties(metadata={"owner": "docs", "search_generation": "1"})
+
+    monkeypatch.setattr(
+        "azure.storage.blob.aio.ContainerClient.get_container_properties", mock_get_container_properties
+    )
+
+    updated_metadata = {}
+
+    async def mock_set_container_metadata(self, metadata, *args, **kwargs):
+        updated_metadata.update(metadata)
+
+    monkeypatch.setattr("azure.storage.blob.aio.ContainerClient.set_container_metadata", mock_set_container_metadata)
+
+    await blob_manager.bump_search_generation()
+    assert updated_metadata["owner"] == "docs"
+    assert updated_metadata["search_generation"] not in ("", "1")
+
+
 def test_sourcepage_from_file_page():
     assert BlobManager.sourcepage_from_file_page("test.pdf", 0) == "test.pdf#page=1"
     assert BlobManager.sourcepage_from_file_page("test.html", 0) == "test.html"
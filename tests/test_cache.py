@@ -0,0 +1,59 @@
+import pytest
+
+from core.cache import LRUCache
+
+
+def test_lru_cache_evicts_least_recently_used():
+    evicted = []
+    cache: LRUCache[str] = LRUCache(max_weight=6, weigh=len, on_evict=lambda key, value: evicted.append(key))
+    cache.put("a", "aa")
+    cache.put("b", "bb")
+    cache.put("c", "cc")
+    assert cache.get("a") == "aa"
+    cache.put("d", "dd")
+    assert evicted == ["b"]
+    assert cache.keys() == ["c", "a", "d"]
+    assert cache.weight == 6
+    assert cache.put("e", "eeeeeee") is False
+    assert "e" not in cache
+
+
+def test_lru_cache_ttl(monkeypatch):
+    now = 1000.0
+    monkeypatch.setattr("core.cache.time.monotonic", lambda: now)
+    cache: LRUCache[str] = LRUCache(max_weight=10, ttl=60)
+    cache.put("a", "value")
+    assert cache.get("a") == "value"
+    now += 61
+    assert "a" not in cache
+    assert cache.get("a") is None
+    assert len(cache) == 0
+    assert cache.hits == 1
+    assert cache.misses == 1
+
+    # A value can expire sooner than the cache ttl, but not later
+    cache.put("b", "value", ttl=10)
+    cache.put("c", "value", ttl=600)
+    now += 30
+    assert "b" not in cache
+    assert "c" in cache
+    now += 31
+    assert "c" not in cache
+
+
+@pytest.mark.asyncio
+async def test_lru_cache_get_or_load_failure_not_cached():
+    cache: LRUCache[str] = LRUCache(max_weight=10)
+
+    async def fail():
+        raise ValueError("boom")
+
+    with pytest.raises(ValueError):
+        await cache.get_or_load("a", fail)
+    assert "a" not in cache
+
+    async def load():
+        return "value"
+
+    assert await cache.get_or_load("a", load) == "value"
+    assert cache.get("a") == "value"
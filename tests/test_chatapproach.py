@@ -1,9 +1,14 @@
+import asyncio
 import json
 
 import pytest
-from openai.types.chat import ChatCompletion
+from openai.types.chat import ChatCompletion, ChatCompletionChunk, ChatCompletionMessage
+from openai.types.chat.chat_completion import Choice
 
+from approaches.approach import Document
 from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
+from core.messagebuilder import MessageBuilder
+from core.modelhelper import num_tokens_from_messages_batch
 
 
 @pytest.fixture
@@ -209,3 +214,370 @@ def test_get_messages_from_history_few_shots(chat_approach):
     assert messages[4]["role"] == "assistant"
     assert messages[5]["role"] == "user"
     assert messages[5]["content"] == user_query_request
+
+
+def test_get_messages_from_history_long(chat_approach):
+    history = []
+    for turn in range(40):
+        history.append({"role": "user", "content": f"Question {turn}"})
+        history.append({"role": "assistant", "content": f"Answer {turn}"})
+    history.append({"role": "user", "content": "Last question"})
+    # Each history message is 6 tokens, and the user message is 5 tokens
+    messages = chat_approach.get_messages_from_history(
+        system_prompt="You are a bot.",
+        model_id=chat_approach.chatgpt_model,
+        history=history,
+        user_content="Last question",
+        max_tokens=5 + 6 * 31,
+    )
+    # Only the newest messages that fit are kept, across several counting batches, in their original order
+    assert messages == [{"role": "system", "content": "You are a bot."}, *history[-32:]]
+
+    messages = chat_approach.get_messages_from_history(
+        system_prompt="You are a bot.",
+        model_id=chat_approach.chatgpt_model,
+        history=history,
+        user_content="Last question",
+        max_tokens=10000,
+    )
+    assert messages == [{"role": "system", "content": "You are a bot."}, *history]
+
+
+def test_get_messages_from_history_stops_counting(monkeypatch, chat_approach):
+    history = []
+    for turn in range(40):
+        history.append({"role": "user", "content": f"Question {turn}"})
+        history.append({"role": "assistant", "content": f"Answer {turn}"})
+    history.append({"role": "user", "content": "Last question"})
+    counted = []
+    original_count = MessageBuilder.count_tokens_for_messages
+
+    def count_tokens_for_messages(self, messages):
+        counted.extend(messages)
+        return original_count(self, messages)
+
+    monkeypatch.setattr(MessageBuilder, "count_tokens_for_messages", count_tokens_for_messages)
+    messages = chat_approach.get_messages_from_history(
+        system_prompt="You are a bot.",
+        model_id=chat_approach.chatgpt_model,
+        history=history,
+        user_content="Last question",
+        max_tokens=5 + 6 * 4,
+    )
+    assert messages == [{"role": "system", "content": "You are a bot."}, *history[-5:]]
+    # The older messages past the cutoff are never counted
+    assert len(counted) < 10
+
+
+def test_get_sources_token_limit(chat_approach):
+    history = []
+    for turn in range(40):
+        history.append({"role": "user", "content": f"Question {turn}"})
+        history.append({"role": "assistant", "content": f"Answer {turn}"})
+    history.append({"role": "user", "content": "Last question"})
+    prompt_token_count = sum(
+        num_tokens_from_messages_batch(
+            [{"role": "system", "content": "You are a bot."}, {"role": "user", "content": "Last question"}],
+            chat_approach.chatgpt_model,
+        )
+    )
+    # Each history message is 6 tokens, and only the newest ones that fit in half of the tokens are reserved
+    sources_token_limit = chat_approach.get_sources_token_limit(
+        "You are a bot.", chat_approach.chatgpt_model, history, "Last question", prompt_token_count + 200
+    )
+    assert sources_token_limit == 200 - 6 * 16
+
+    sources_token_limit = chat_approach.get_sources_token_limit(
+        "You are a bot.", chat_approach.chatgpt_model, history, "Last question", prompt_token_count + 10000
+    )
+    assert sources_token_limit == 10000 - 6 * 80
+
+
+class MockRewriteOpenAIClient:
+    def __init__(self, search_query: str):
+        self.chat = self
+        self.completions = self
+        self.search_query = search_query
+        self.created = asyncio.Event()
+        self.models: list[str] = []
+
+    async def create(self, *args, **kwargs):
+        self.models.append(kwargs["model"])
+        if kwargs.get("functions"):
+            # Give the speculative search a chance to start while the query is generated
+            await asyncio.sleep(0.01)
+            self.created.set()
+            return ChatCompletion(
+                object="chat.completion",
+                choices=[
+                    Choice(
+                        message=ChatCompletionMessage(role="assistant", content=self.search_query),
+                        finish_reason="stop",
+                        index=0,
+                    )
+                ],
+                id="test-123",
+                created=0,
+                model="test-model",
+            )
+
+
+def make_document(content: str) -> Document:
+    return Document(
+        id=content,
+        content=content,
+        embedding=None,
+        image_embedding=None,
+        category=None,
+        sourcepage="page.pdf",
+        sourcefile="page.pdf",
+        oids=None,
+        groups=None,
+        captions=[],
+    )
+
+
+def mock_chat_approach(monkeypatch, search_query: str, **kwargs) -> ChatReadRetrieveReadApproach:
+    chat_approach = ChatReadRetrieveReadApproach(
+        search_client=None,
+        auth_helper=None,
+        openai_client=MockRewriteOpenAIClient(search_query),
+        chatgpt_model="gpt-35-turbo",
+        chatgpt_deployment="chat",
+        embedding_deployment="embeddings",
+        embedding_model="text-",
+        sourcepage_field="",
+        content_field="",
+        query_language="en-us",
+        query_speller="lexicon",
+        **kwargs,
+    )
+    monkeypatch.setattr(chat_approach, "build_filter", lambda overrides, auth_claims: None)
+    return chat_approach
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "search_query,speculative_retrieval,retrieved",
+    [
+        ("capital of France", True, ["What is the capital of France?"]),
+        ("French capital city", False, ["What is the capital of France?", "French capital city"]),
+    ],
+)
+async def test_speculative_retrieval(monkeypatch, search_query, speculative_retrieval, retrieved):
+    chat_approach = mock_chat_approach(monkeypatch, search_query, speculative_retrieval=True)
+    started = []
+    cancelled = []
+
+    async def mock_retrieve(query_text, *args):
+        started.append(query_text)
+        if len(started) == 1:
+            # The speculative search overlaps the generation of the search query
+            assert not chat_approach.openai_client.created.is_set()
+        try:
+            await asyncio.sleep(0.02)
+        except asyncio.CancelledError:
+            cancelled.append(query_text)
+            raise
+        return [make_document(query_text)]
+
+    monkeypatch.setattr(chat_approach, "retrieve", mock_retrieve)
+
+    extra_info, chat_coroutine = await chat_approach.run_until_final_call(
+        [{"role": "user", "content": "What is the capital of France?"}], {}, {}, should_stream=False
+    )
+    chat_coroutine.close()
+    search_thought = extra_info["thoughts"][1]
+    assert search_thought.description == search_query
+    assert search_thought.props["speculative_retrieval"] is speculative_retrieval
+    assert search_thought.props.get("searched_query") == (retrieved[-1] if speculative_retrieval else None)
+    assert started == retrieved
+    assert extra_info["data_points"]["text"] == [f"page.pdf: {retrieved[-1]}"]
+    # The speculative search is cancelled as soon as its results are known to be unused
+    assert cancelled == ([] if speculative_retrieval else ["What is the capital of France?"])
+
+
+@pytest.mark.asyncio
+async def test_speculative_retrieval_failed(monkeypatch):
+    chat_approach = mock_chat_approach(monkeypatch, "capital of France", speculative_retrieval=True)
+
+    async def mock_retrieve(query_text, *args):
+        if query_text == "What is the capital of France?":
+            raise ValueError("Search failed")
+        return [make_document(query_text)]
+
+    monkeypatch.setattr(chat_approach, "retrieve", mock_retrieve)
+
+    extra_info, chat_coroutine = await chat_approach.run_until_final_call(
+        [{"role": "user", "content": "What is the capital of France?"}], {}, {}, should_stream=False
+    )
+    chat_coroutine.close()
+    # A failed speculative search falls back to a search with the generated query
+    assert extra_info["thoughts"][1].props["speculative_retrieval"] is False
+    assert extra_info["data_points"]["text"] == ["page.pdf: capital of France"]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "skip_query_rewrite,history,query_rewrite,query_text",
+    [
+        ("never", [{"role": "user", "content": "What is the capital of France?"}], None, "capital of France"),
+        (
+            "first_turn",
+            [{"role": "user", "content": "What is the capital of France?"}],
+            "skipped_first_turn",
+            "What is the capital of France?",
+        ),
+        (
+            "first_turn",
+            [
+                {"role": "user", "content": "What is the capital of France?"},
+                {"role": "assistant", "content": "Paris [page.pdf]"},
+                {"role": "user", "content": "What is the capital of Spain?"},
+            ],
+            "generated",
+            "capital of France",
+        ),
+        (
+            "self_contained",
+            [
+                {"role": "user", "content": "What is the capital of France?"},
+                {"role": "assistant", "content": "Paris [page.pdf]"},
+                {"role": "user", "content": "What is the capital of Spain?"},
+            ],
+            "skipped_self_contained",
+            "What is the capital of Spain?",
+        ),
+        (
+            "self_contained",
+            [
+                {"role": "user", "content": "What is the capital of France?"},
+                {"role": "assistant", "content": "Paris [page.pdf]"},
+                {"role": "user", "content": "What about Spain?"},
+            ],
+            "generated",
+            "capital of France",
+        ),
+    ],
+)
+async def test_skip_query_rewrite(monkeypatch, skip_query_rewrite, history, query_rewrite, query_text):
+    chat_approach = mock_chat_approach(monkeypatch, "capital of France", skip_query_rewrite=skip_query_rewrite)
+    retrieved = []
+
+    async def mock_retrieve(query_text, *args):
+        retrieved.append(query_text)
+        return [make_document(query_text)]
+
+    monkeypatch.setattr(chat_approach, "retrieve", mock_retrieve)
+
+    extra_info, chat_coroutine = await chat_approach.run_until_final_call(history, {}, {}, should_stream=False)
+    chat_coroutine.close()
+    search_thought = extra_info["thoughts"][1]
+    assert search_thought.description == query_text
+    assert search_thought.props.get("query_rewrite") == query_rewrite
+    assert retrieved == [query_text]
+    # The chat model is only asked for a search query when the rewrite isn't skipped
+    assert chat_approach.openai_client.created.is_set() is (query_text == "capital of France")
+
+
+@pytest.mark.asyncio
+async def test_deduplicate_sources(monkeypatch):
+    chat_approach = mock_chat_approach(monkeypatch, "deductibles", deduplicate_sources=True)
+
+    async def mock_retrieve(query_text, *args):
+        return [
+            make_document("Overlake is in-network. Deductibles are $500 for employees and $1000 for families."),
+            make_document("Deductibles are $500 for employees and $1000 for families. Out-of-network ones are higher."),
+        ]
+
+    monkeypatch.setattr(chat_approach, "retrieve", mock_retrieve)
+
+    extra_info, chat_coroutine = await chat_approach.run_until_final_call(
+        [{"role": "user", "content": "What are the deductibles?"}], {}, {}, should_stream=False
+    )
+    chat_coroutine.close()
+    # The overlapping chunks of the page are sent once
+    assert extra_info["data_points"]["text"] == [
+        "page.pdf: Overlake is in-network. Deductibles are $500 for employees and $1000 for families. Out-of-network ones are higher."
+    ]
+    assert extra_info["thoughts"][1].props["deduplicated_tokens"] == 18
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "query_rewrite_model,query_rewrite_deployment,models,token_limit",
+    [
+        (None, None, ["chat", "chat"], 8100),
+        ("gpt-35-turbo", "rewrite", ["rewrite", "chat"], 4000),
+    ],
+)
+async def test_query_rewrite_deployment(
+    monkeypatch, query_rewrite_model, query_rewrite_deployment, models, token_limit
+):
+    chat_approach = ChatReadRetrieveReadApproach(
+        search_client=None,
+        auth_helper=None,
+        openai_client=MockRewriteOpenAIClient("capital of France"),
+        chatgpt_model="gpt-4",
+        chatgpt_deployment="chat",
+        embedding_deployment="embeddings",
+        embedding_model="text-",
+        sourcepage_field="",
+        content_field="",
+        query_language="en-us",
+        query_speller="lexicon",
+        query_rewrite_model=query_rewrite_model,
+        query_rewrite_deployment=query_rewrite_deployment,
+    )
+    monkeypatch.setattr(chat_approach, "build_filter", lambda overrides, auth_claims: None)
+
+    async def mock_retrieve(query_text, *args):
+        return [make_document(query_text)]
+
+    monkeypatch.setattr(chat_approach, "retrieve", mock_retrieve)
+
+    assert chat_approach.query_rewrite_token_limit == token_limit
+    _, chat_coroutine = await chat_approach.run_until_final_call(
+        [{"role": "user", "content": "What is the capital of France?"}], {}, {}, should_stream=False
+    )
+    await chat_coroutine
+    # The search query is generated by the query rewrite deployment, and the answer by the chat deployment
+    assert chat_approach.openai_client.models == models
+
+
+@pytest.mark.asyncio
+async def test_run_with_streaming_followup_questions(chat_approach, monkeypatch):
+    contents = ["Paris. <", "<What is the capital of Spain?>", "><<What about", " Italy?>>", None]
+
+    async def mock_stream():
+        for content in contents:
+            yield ChatCompletionChunk.model_validate(
+                {
+                    "id": "test-id",
+                    "object": "chat.completion.chunk",
+                    "created": 1,
+                    "model": "gpt-35-turbo",
+                    "choices": [{"delta": {"content": content}, "index": 0, "finish_reason": None}],
+                }
+            )
+
+    async def mock_run_until_final_call(history, overrides, auth_claims, should_stream):
+        async def open_stream():
+            return mock_stream()
+
+        return {}, open_stream()
+
+    monkeypatch.setattr(chat_approach, "run_until_final_call", mock_run_until_final_call)
+
+    events = [
+        event
+        async for event in chat_approach.run_with_streaming(
+            [{"role": "user", "content": "What is the capital of France?"}], {"suggest_followup_questions": True}, {}
+        )
+    ]
+    assert [event["choices"][0]["delta"].get("content") for event in events[1:]] == ["Paris. ", None, None]
+    # Each follow-up question is sent as soon as it is complete, along with the ones before it
+    assert [event["choices"][0].get("context") for event in events[2:]] == [
+        {"followup_questions": ["What is the capital of Spain?"]},
+        {"followup_questions": ["What is the capital of Spain?", "What about Italy?"]},
+    ]
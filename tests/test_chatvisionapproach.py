@@ -1,3 +1,4 @@
+import asyncio
 import json
 
 import pytest
@@ -5,10 +6,13 @@ from azure.search.documents.indexes.models import SearchField, SearchIndex
 from azure.search.documents.models import (
     RawVectorQuery,
 )
+from openai.types import CreateEmbeddingResponse, Embedding
 from openai.types.chat import ChatCompletion
+from openai.types.create_embedding_response import Usage
 
 from approaches.chatreadretrievereadvision import ChatReadRetrieveReadVisionApproach
 from core.authentication import AuthenticationHelper
+from core.cache import LRUCache
 
 
 class MockOpenAIClient:
@@ -85,3 +89,97 @@ async def test_compute_text_embedding(chat_approach, openai_client, mock_openai_
     assert result.vector == [0.0023064255, -0.009327292, -0.0028842222]
     assert result.k == 50
     assert result.fields == "embedding"
+
+
+@pytest.mark.asyncio
+async def test_compute_text_embedding_cached(chat_approach, openai_client, monkeypatch):
+    calls = []
+
+    async def mock_create(*args, **kwargs):
+        calls.append(kwargs["input"])
+        return CreateEmbeddingResponse(
+            object="list",
+            data=[Embedding(embedding=[0.0023064255, -0.009327292, -0.0028842222], index=0, object="embedding")],
+            model="text-embedding-ada-002",
+            usage=Usage(prompt_tokens=8, total_tokens=8),
+        )
+
+    monkeypatch.setattr(openai_client.embeddings, "create", mock_create)
+    chat_approach.embedding_cache = LRUCache(max_weight=1024, weigh=lambda vector: vector.itemsize * len(vector))
+
+    first, second, third = await asyncio.gather(
+        chat_approach.compute_text_embedding("test query"),
+        chat_approach.compute_text_embedding("test  query "),
+        chat_approach.compute_text_embedding("test query"),
+    )
+    # Concurrent and whitespace-only variants of the same query share a single request
+    assert calls == ["test query"]
+    assert first.vector == second.vector == third.vector
+    assert first.vector == pytest.approx([0.0023064255, -0.009327292, -0.0028842222])
+
+    await chat_approach.compute_text_embedding("another query")
+    assert calls == ["test query", "another query"]
+    assert chat_approach.embedding_cache.hits == 0
+    await chat_approach.compute_text_embedding("test query")
+    assert chat_approach.embedding_cache.hits == 1
+
+
+@pytest.mark.asyncio
+async def test_compute_vectors_concurrently(chat_approach, monkeypatch):
+    started = []
+
+    async def mock_compute_text_embedding(q):
+        started.append("embedding")
+        await asyncio.sleep(0.01)
+        # Both computations run at the same time
+        assert started == ["embedding", "imageEmbedding"]
+        return RawVectorQuery(vector=[0.1], k=50, fields="embedding")
+
+    async def mock_compute_image_embedding(q, vision_endpoint, vision_key):
+        started.append("imageEmbedding")
+        await asyncio.sleep(0.01)
+        return RawVectorQuery(vector=[0.2], k=50, fields="imageEmbedding")
+
+    monkeypatch.setattr(chat_approach, "compute_text_embedding", mock_compute_text_embedding)
+    monkeypatch.setattr(chat_approach, "compute_image_embedding", mock_compute_image_embedding)
+
+    vectors, skipped_fields = await chat_approach.compute_vectors("test query", ["embedding", "imageEmbedding"])
+    assert [vector.fields for vector in vectors] == ["embedding", "imageEmbedding"]
+    assert skipped_fields == []
+
+
+@pytest.mark.asyncio
+async def test_compute_vectors_fallback(chat_approach, monkeypatch):
+    cancelled = []
+
+    async def mock_compute_text_embedding(q):
+        return RawVectorQuery(vector=[0.1], k=50, fields="embedding")
+
+    async def mock_compute_image_embedding_slow(q, vision_endpoint, vision_key):
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    monkeypatch.setattr(chat_approach, "compute_text_embedding", mock_compute_text_embedding)
+    monkeypatch.setattr(chat_approach, "compute_image_embedding", mock_compute_image_embedding_slow)
+    chat_approach.embedding_timeout = 0.01
+
+    vectors, skipped_fields = await chat_approach.compute_vectors("test query", ["embedding", "imageEmbedding"])
+    assert [vector.fields for vector in vectors] == ["embedding"]
+    assert skipped_fields == ["imageEmbedding"]
+    await asyncio.sleep(0)
+    assert cancelled == [True]
+
+    async def mock_compute_image_embedding_error(q, vision_endpoint, vision_key):
+        raise ConnectionError("vision is unavailable")
+
+    monkeypatch.setattr(chat_approach, "compute_image_embedding", mock_compute_image_embedding_error)
+    vectors, skipped_fields = await chat_approach.compute_vectors("test query", ["embedding", "imageEmbedding"])
+    assert [vector.fields for vector in vectors] == ["embedding"]
+    assert skipped_fields == ["imageEmbedding"]
+
+    # Without any vector, the error is raised
+    with pytest.raises(ConnectionError):
+        await chat_approach.compute_vectors("test query", ["imageEmbedding"])
@@ -1,3 +1,4 @@
+import asyncio
 import os
 
 import aiohttp
@@ -14,69 +15,91 @@ import app
 
 from .mocks import MockAzureCredential
 
+MOCK_CONTENT = b"test content"
+MOCK_ETAG = '"0x8DBE9B4BF5A2B8D"'
+
+
+class MockAiohttpClientResponse404(aiohttp.ClientResponse):
+    def __init__(self, url, body_bytes, headers=None):
+        self._body = body_bytes
+        self._headers = headers
+        self._cache = {}
+        self.status = 404
+        self.reason = "Not Found"
+        self._url = url
+
+
+class MockAiohttpClientResponse(aiohttp.ClientResponse):
+    def __init__(self, url, body_bytes, headers=None, status=200):
+        self._body = body_bytes
+        self._headers = headers
+        self._cache = {}
+        self.status = status
+        self.reason = "OK"
+        self._url = url
+
+
+class MockTransport(AsyncHttpTransport):
+    def __init__(self):
+        self.requests = []
+
+    async def send(self, request: HttpRequest, **kwargs) -> AioHttpTransportResponse:
+        self.requests.append(request)
+        if request.url.endswith("notfound.pdf"):
+            raise ResourceNotFoundError(MockAiohttpClientResponse404(request.url, b""))
+        headers = {
+            "Content-Type": "application/octet-stream",
+            "ETag": MOCK_ETAG,
+            "Last-Modified": "Wed, 13 Dec 2023 22:15:38 GMT",
+        }
+        if request.method == "HEAD":
+            headers["Content-Length"] = str(len(MOCK_CONTENT))
+            return AioHttpTransportResponse(request, MockAiohttpClientResponse(request.url, b"", headers))
+        # Blob downloads are always ranged requests, honour the range like the storage service does
+        start, end = request.headers["x-ms-range"].replace("bytes=", "").split("-")
+        body = MOCK_CONTENT[int(start) : int(end) + 1]
+        headers["Content-Length"] = str(len(body))
+        headers["Content-Range"] = f"bytes {start}-{int(start) + len(body) - 1}/{len(MOCK_CONTENT)}"
+        return AioHttpTransportResponse(request, MockAiohttpClientResponse(request.url, body, headers, status=206))
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+
+@pytest.fixture
+def mock_transport():
+    return MockTransport()
+
+
+@pytest.fixture
+def content_client(mock_env, mock_acs_search, mock_transport):
+    async def create_client():
+        # Then we can plug this into any SDK via kwargs:
+        blob_client = BlobServiceClient(
+            f"https://{os.environ['AZURE_STORAGE_ACCOUNT']}.blob.core.windows.net",
+            credential=MockAzureCredential(),
+            transport=mock_transport,
+            retry_total=0,  # Necessary to avoid unnecessary network requests during tests
+        )
+        return blob_client.get_container_client(os.environ["AZURE_STORAGE_CONTAINER"])
+
+    return create_client
 
-@pytest.mark.asyncio
-async def test_content_file(monkeypatch, mock_env, mock_acs_search):
-    class MockAiohttpClientResponse404(aiohttp.ClientResponse):
-        def __init__(self, url, body_bytes, headers=None):
-            self._body = body_bytes
-            self._headers = headers
-            self._cache = {}
-            self.status = 404
-            self.reason = "Not Found"
-            self._url = url
-
-    class MockAiohttpClientResponse(aiohttp.ClientResponse):
-        def __init__(self, url, body_bytes, headers=None):
-            self._body = body_bytes
-            self._headers = headers
-            self._cache = {}
-            self.status = 200
-            self.reason = "OK"
-            self._url = url
-
-    class MockTransport(AsyncHttpTransport):
-        async def send(self, request: HttpRequest, **kwargs) -> AioHttpTransportResponse:
-            if request.url.endswith("notfound.pdf"):
-                raise ResourceNotFoundError(MockAiohttpClientResponse404(request.url, b""))
-            else:
-                return AioHttpTransportResponse(
-                    request,
-                    MockAiohttpClientResponse(
-                        request.url,
-                        b"test content",
-                        {
-                            "Content-Type": "application/octet-stream",
-                            "Content-Range": "bytes 0-27/28",
-                            "Content-Length": "28",
-                        },
-                    ),
-                )
-
-        async def __aenter__(self):
-            return self
-
-        async def __aexit__(self, *args):
-            pass
-
-        async def open(self):
-            pass
-
-        async def close(self):
-            pass
-
-    # Then we can plug this into any SDK via kwargs:
-    blob_client = BlobServiceClient(
-        f"https://{os.environ['AZURE_STORAGE_ACCOUNT']}.blob.core.windows.net",
-        credential=MockAzureCredential(),
-        transport=MockTransport(),
-        retry_total=0,  # Necessary to avoid unnecessary network requests during tests
-    )
-    blob_container_client = blob_client.get_container_client(os.environ["AZURE_STORAGE_CONTAINER"])
 
+@pytest.mark.asyncio
+async def test_content_file(content_client):
     quart_app = app.create_app()
     async with quart_app.test_app() as test_app:
-        quart_app.config.update({"blob_container_client": blob_container_client})
+        quart_app.config.update({"blob_container_client": await content_client()})
 
         client = test_app.test_client()
         response = await client.get("/content/notfound.pdf")
@@ -85,9 +108,113 @@ async def test_content_file(monkeypatch, mock_env, mock_acs_search):
         response = await client.get("/content/role_library.pdf")
         assert response.status_code == 200
         assert response.headers["Content-Type"] == "application/pdf"
+        assert response.headers["Accept-Ranges"] == "bytes"
+        assert response.headers["ETag"] == MOCK_ETAG
+        assert response.headers["Last-Modified"] == "Wed, 13 Dec 2023 22:15:38 GMT"
         assert await response.get_data() == b"test content"
 
         response = await client.get("/content/role_library.pdf#page=10")
         assert response.status_code == 200
         assert response.headers["Content-Type"] == "application/pdf"
         assert await response.get_data() == b"test content"
+
+
+@pytest.mark.asyncio
+async def test_content_file_range(content_client, mock_transport):
+    quart_app = app.create_app()
+    async with quart_app.test_app() as test_app:
+        quart_app.config.update({"blob_container_client": await content_client()})
+
+        client = test_app.test_client()
+        response = await client.get("/content/role_library.pdf", headers={"Range": "bytes=5-"})
+        assert response.status_code == 206
+        assert response.headers["Content-Range"] == "bytes 5-11/12"
+        assert response.headers["Content-Length"] == "7"
+        assert await response.get_data() == b"content"
+        assert mock_transport.requests[1].headers["x-ms-range"] == "bytes=5-11"
+
+        response = await client.get("/content/role_library.pdf", headers={"Range": "bytes=0-3"})
+        assert response.status_code == 206
+        assert response.headers["Content-Range"] == "bytes 0-3/12"
+        assert await response.get_data() == b"test"
+
+        response = await client.get("/content/role_library.pdf", headers={"Range": "bytes=20-30"})
+        assert response.status_code == 416
+        assert response.headers["Content-Range"] == "bytes */12"
+
+        # A stale If-Range falls back to sending the whole file
+        response = await client.get(
+            "/content/role_library.pdf", headers={"Range": "bytes=0-3", "If-Range": '"0xOLDETAG"'}
+        )
+        assert response.status_code == 200
+        assert await response.get_data() == b"test content"
+
+
+@pytest.mark.asyncio
+async def test_content_file_not_modified(content_client, mock_transport):
+    quart_app = app.create_app()
+    async with quart_app.test_app() as test_app:
+        quart_app.config.update({"blob_container_client": await content_client()})
+
+        client = test_app.test_client()
+        response = await client.get("/content/role_library.pdf", headers={"If-None-Match": MOCK_ETAG})
+        assert response.status_code == 304
+        assert response.headers["ETag"] == MOCK_ETAG
+        assert await response.get_data() == b""
+        # Only the properties were fetched, nothing was downloaded
+        assert [request.method for request in mock_transport.requests] == ["HEAD"]
+
+        response = await client.get("/content/role_library.pdf", headers={"If-None-Match": '"0xOLDETAG"'})
+        assert response.status_code == 200
+        assert await response.get_data() == b"test content"
+
+
+@pytest.mark.asyncio
+async def test_content_file_cached(content_client, mock_transport):
+    quart_app = app.create_app()
+    async with quart_app.test_app() as test_app:
+        quart_app.config.update({"blob_container_client": await content_client()})
+
+        client = test_app.test_client()
+        response = await client.get("/content/role_library.pdf")
+        assert await response.get_data() == b"test content"
+        assert [request.method for request in mock_transport.requests] == ["HEAD", "GET"]
+
+        response = await client.get("/content/role_library.pdf")
+        assert response.status_code == 200
+        assert await response.get_data() == b"test content"
+        response = await client.get("/content/role_library.pdf", headers={"Range": "bytes=5-"})
+        assert response.status_code == 206
+        assert await response.get_data() == b"content"
+        # Later requests only revalidate the properties
+        assert [request.method for request in mock_transport.requests] == ["HEAD", "GET", "HEAD", "HEAD"]
+
+        stats = quart_app.config[app.CONFIG_CONTENT_CACHE].stats()
+        assert stats["hits"] == 2
+        assert stats["misses"] == 1
+
+
+@pytest.mark.asyncio
+async def test_content_file_range_cached(content_client, mock_transport):
+    quart_app = app.create_app()
+    async with quart_app.test_app() as test_app:
+        quart_app.config.update({"blob_container_client": await content_client()})
+        content_cache = quart_app.config[app.CONFIG_CONTENT_CACHE]
+
+        client = test_app.test_client()
+        response = await client.get("/content/role_library.pdf", headers={"Range": "bytes=5-"})
+        assert response.status_code == 206
+        assert await response.get_data() == b"content"
+        # The range is sent right away, and the whole blob is downloaded into the cache in the background
+        await asyncio.gather(*content_cache._fills.values())
+        assert [request.headers["x-ms-range"] for request in mock_transport.requests[1:]] == [
+            "bytes=5-11",
+            "bytes=0-33554431",
+        ]
+        assert content_cache.get("role_library.pdf", MOCK_ETAG) is not None
+
+        response = await client.get("/content/role_library.pdf", headers={"Range": "bytes=0-3"})
+        assert response.status_code == 206
+        assert await response.get_data() == b"test"
+        # Later ranges are served from the cache
+        assert [request.method for request in mock_transport.requests] == ["HEAD", "GET", "GET", "HEAD"]
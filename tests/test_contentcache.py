@@ -0,0 +1,140 @@
+import asyncio
+import os
+
+import pytest
+import pytest_asyncio
+
+from core.contentcache import ContentCache
+
+
+async def iterate(chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+async def read_all(generator):
+    return b"".join([chunk async for chunk in generator])
+
+
+@pytest_asyncio.fixture
+async def content_cache(tmp_path):
+    cache = ContentCache(
+        max_memory_bytes=10, max_memory_item_bytes=5, max_disk_bytes=20, disk_directory=str(tmp_path / "cache")
+    )
+    yield cache
+    await cache.close()
+
+
+@pytest.mark.asyncio
+async def test_memory_tier(content_cache):
+    assert content_cache.get("a.txt", "etag1") is None
+    assert await read_all(content_cache.store_stream("a.txt", "etag1", 4, iterate([b"ab", b"cd"]))) == b"abcd"
+
+    cached = content_cache.get("a.txt", "etag1")
+    assert cached.data == b"abcd"
+    assert await read_all(cached.iter_range(1, 2, chunk_size=1)) == b"bc"
+    assert content_cache.stats()["memory_hits"] == 1
+    assert content_cache.stats()["misses"] == 1
+
+
+@pytest.mark.asyncio
+async def test_disk_tier(content_cache):
+    data = b"0123456789"
+    assert await read_all(content_cache.store_stream("big.pdf", "etag1", 10, iterate([data[:6], data[6:]]))) == data
+    assert content_cache.stats()["disk_bytes"] == 10
+    assert len(os.listdir(content_cache.directory)) == 1
+
+    cached = content_cache.get("big.pdf", "etag1")
+    assert cached.file is not None
+    assert await read_all(cached.iter_range(2, 5, chunk_size=2)) == b"23456"
+    assert content_cache.stats()["disk_hits"] == 1
+
+
+@pytest.mark.asyncio
+async def test_disk_tier_eviction(content_cache):
+    for name in ["a.pdf", "b.pdf", "c.pdf"]:
+        await read_all(content_cache.store_stream(name, "etag", 8, iterate([b"x" * 8])))
+
+    assert content_cache.get("a.pdf", "etag") is None
+    assert content_cache.get("c.pdf", "etag") is not None
+    assert content_cache.stats()["disk_evictions"] == 1
+    assert len(os.listdir(content_cache.directory)) == 2
+
+
+@pytest.mark.asyncio
+async def test_new_etag_invalidates(content_cache):
+    await read_all(content_cache.store_stream("a.txt", "etag1", 3, iterate([b"old"])))
+    await read_all(content_cache.store_stream("a.txt", "etag2", 3, iterate([b"new"])))
+
+    assert content_cache.get("a.txt", "etag1") is None
+    assert content_cache.get("a.txt", "etag2").data == b"new"
+
+
+@pytest.mark.asyncio
+async def test_incomplete_stream_not_cached(content_cache):
+    await read_all(content_cache.store_stream("a.txt", "etag1", 4, iterate([b"ab"])))
+    await read_all(content_cache.store_stream("big.pdf", "etag1", 10, iterate([b"01234"])))
+
+    assert content_cache.get("a.txt", "etag1") is None
+    assert content_cache.get("big.pdf", "etag1") is None
+    assert os.listdir(content_cache.directory) == []
+
+
+@pytest.mark.asyncio
+async def test_fill_in_background(content_cache):
+    downloads = []
+
+    async def download():
+        downloads.append("big.pdf")
+        return iterate([b"01234", b"56789"])
+
+    content_cache.fill_in_background("big.pdf", "etag1", 10, download)
+    # A fill already under way isn't started again
+    content_cache.fill_in_background("big.pdf", "etag1", 10, download)
+    await asyncio.gather(*content_cache._fills.values())
+    assert downloads == ["big.pdf"]
+    assert await read_all(content_cache.get("big.pdf", "etag1").iter_range(0, 10, chunk_size=4)) == b"0123456789"
+
+    # Nothing is downloaded for blobs too big to cache
+    content_cache.fill_in_background("huge.pdf", "etag1", 30, download)
+    assert content_cache._fills == {}
+    assert downloads == ["big.pdf"]
+
+
+@pytest.mark.asyncio
+async def test_fill_in_background_error(content_cache, caplog):
+    async def download():
+        raise ConnectionError("connection reset")
+
+    content_cache.fill_in_background("a.txt", "etag1", 4, download)
+    await asyncio.gather(*content_cache._fills.values())
+    assert "connection reset" in caplog.text
+    assert content_cache.get("a.txt", "etag1") is None
+
+
+@pytest.mark.asyncio
+async def test_can_cache(tmp_path):
+    cache = ContentCache(max_memory_bytes=10, max_memory_item_bytes=5, max_disk_bytes=0)
+    assert cache.directory is None
+    assert cache.can_cache(5)
+    assert not cache.can_cache(6)
+    await cache.close()
+
+
+def test_disk_tier_requires_directory():
+    with pytest.raises(ValueError):
+        ContentCache(max_memory_bytes=10, max_memory_item_bytes=5, max_disk_bytes=20)
+
+
+@pytest.mark.asyncio
+async def test_stale_directories_removed(tmp_path, monkeypatch):
+    # Directories left by worker processes that exited without closing their cache
+    (tmp_path / "content-1001" / "file").mkdir(parents=True)
+    (tmp_path / "content-1002").mkdir()
+    (tmp_path / "other").mkdir()
+    monkeypatch.setattr("core.contentcache.process_exists", lambda pid: pid == 1002)
+
+    cache = ContentCache(max_memory_bytes=10, max_memory_item_bytes=5, max_disk_bytes=20, disk_directory=str(tmp_path))
+    assert sorted(os.listdir(tmp_path)) == sorted(["content-1002", f"content-{os.getpid()}", "other"])
+    await cache.close()
+    assert sorted(os.listdir(tmp_path)) == ["content-1002", "other"]
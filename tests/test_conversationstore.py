@@ -0,0 +1,87 @@
+import pytest
+
+from core.conversationstore import (
+    Conversation,
+    MemoryConversationStore,
+    RedisConversationStore,
+    SQLiteConversationStore,
+)
+from core.modelhelper import token_counter
+
+MODEL = "gpt-35-turbo"
+
+
+class MockRedis:
+    def __init__(self):
+        self.data: dict[str, bytes] = {}
+        self.expirations: dict[str, int] = {}
+
+    async def get(self, key):
+        return self.data.get(key)
+
+    async def set(self, key, value, ex=None):
+        self.data[key] = value.encode()
+        self.expirations[key] = ex
+
+    async def close(self):
+        pass
+
+
+@pytest.fixture(params=["memory", "sqlite", "redis"])
+def conversation_store(request, tmp_path):
+    if request.param == "memory":
+        return MemoryConversationStore(MODEL, 60, max_bytes=1024 * 1024)
+    if request.param == "sqlite":
+        return SQLiteConversationStore(MODEL, 60, path=str(tmp_path / "conversations.sqlite3"))
+    return RedisConversationStore(MODEL, 60, client=MockRedis())
+
+
+def test_add_messages():
+    conversation = Conversation(owner="OID_X")
+    conversation.add_messages([{"role": "user", "content": "Café hours?"}], MODEL)
+    conversation.add_messages([{"role": "assistant", "content": "From 9 to 5."}], MODEL)
+    assert conversation.messages == [
+        {"role": "user", "content": "Café hours?"},
+        {"role": "assistant", "content": "From 9 to 5."},
+    ]
+    assert conversation.token_counts == token_counter.count_texts(["Café hours?", "From 9 to 5."], MODEL)
+    assert conversation.encoding == "cl100k_base"
+
+    with pytest.raises(ValueError):
+        conversation.add_messages([{"role": "user", "content": [{"type": "text", "text": "Hi"}]}], MODEL)
+
+
+@pytest.mark.asyncio
+async def test_put_get(conversation_store):
+    conversation = Conversation(owner="OID_X")
+    conversation.add_messages([{"role": "user", "content": "What is included in my plan?"}], MODEL)
+    conversation_id = conversation_store.new_id()
+    await conversation_store.put(conversation_id, conversation)
+
+    assert await conversation_store.get(conversation_id, "OID_X") == conversation
+    # Only the user who started the conversation can continue it
+    assert await conversation_store.get(conversation_id, "OID_Y") is None
+    assert await conversation_store.get(conversation_id, None) is None
+    assert await conversation_store.get("unknown", "OID_X") is None
+    await conversation_store.close()
+
+
+@pytest.mark.asyncio
+async def test_get_remembers_token_counts(conversation_store):
+    conversation = Conversation(owner=None)
+    conversation.add_messages([{"role": "user", "content": "A question counted by another worker"}], MODEL)
+    conversation.token_counts = [42]
+    await conversation_store.put("conversation", conversation)
+
+    await conversation_store.get("conversation", None)
+    assert token_counter.count_texts(["A question counted by another worker"], MODEL) == [42]
+    token_counter.counts.clear()
+    await conversation_store.close()
+
+
+@pytest.mark.asyncio
+async def test_sqlite_expired(tmp_path):
+    conversation_store = SQLiteConversationStore(MODEL, -1, path=str(tmp_path / "conversations.sqlite3"))
+    await conversation_store.put("conversation", Conversation(owner=None))
+    assert await conversation_store.get("conversation", None) is None
+    await conversation_store.close()
@@ -0,0 +1,58 @@
+import random
+import re
+
+import pytest
+
+from core.followupquestions import FollowupQuestionParser
+
+
+def parse_chunks(chunks: list[str]) -> tuple[str, list[list[str]]]:
+    parser = FollowupQuestionParser()
+    answer = ""
+    questions_per_chunk = []
+    for chunk in chunks:
+        answer_content, questions = parser.feed(chunk)
+        answer += answer_content
+        questions_per_chunk.append(questions)
+    answer += parser.flush()
+    return answer, questions_per_chunk
+
+
+def test_parse_split_delimiters():
+    answer, questions_per_chunk = parse_chunks(
+        ["The capital of France is Paris. <", "<What is the capital of Spain?>", "><<What about", " Italy?>>"]
+    )
+    assert answer == "The capital of France is Paris. "
+    # Each question is returned as soon as its >> is read
+    assert questions_per_chunk == [[], [], ["What is the capital of Spain?"], ["What about Italy?"]]
+
+
+def test_parse_without_followup_questions():
+    answer, questions_per_chunk = parse_chunks(["1 < 2, ", "and 3 > 2 <"])
+    assert answer == "1 < 2, and 3 > 2 <"
+    assert questions_per_chunk == [[], []]
+
+
+@pytest.mark.parametrize(
+    "content",
+    [
+        "Paris. <<What is the capital of Spain?>> <<What about Italy?>>",
+        "Paris.<<Spain?>><<Italy?>>",
+        "Paris. <<Spain? <<Italy?>>",
+        "Paris. <<>> <<a>b>> <<Spain?>>",
+        "Paris. <<<Spain?>>>",
+        "Paris. <<Spain?>",
+        "Paris. < <Spain?>>",
+        "Paris. <<Spain?",
+    ],
+)
+def test_parse_matches_extract_followup_questions(content):
+    expected_answer, expected_questions = content.split("<<")[0], re.findall(r"<<([^>>]+)>>", content)
+    random.seed(content)
+    for _ in range(20):
+        # Split the content at random positions, including empty chunks
+        cuts = sorted(random.choices(range(len(content) + 1), k=random.randint(0, 8)))
+        chunks = [content[start:end] for start, end in zip([0, *cuts], [*cuts, len(content)])]
+        answer, questions_per_chunk = parse_chunks(chunks)
+        assert answer == expected_answer
+        assert [question for questions in questions_per_chunk for question in questions] == expected_questions
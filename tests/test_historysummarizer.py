@@ -0,0 +1,200 @@
+import asyncio
+import logging
+
+import pytest
+from openai.types.chat import ChatCompletion, ChatCompletionMessage
+from openai.types.chat.chat_completion import Choice
+
+from core.conversationstore import Conversation, MemoryConversationStore
+from core.historysummarizer import HistorySummarizer
+from core.modelhelper import get_token_limit, num_tokens_from_messages_batch
+
+MODEL = "gpt-35-turbo"
+
+
+class MockCompletions:
+    def __init__(self, answer="The user asked about capitals, the answer was Paris [capitals.pdf]."):
+        self.answer = answer
+        self.calls: list[dict] = []
+
+    async def create(self, **kwargs):
+        self.calls.append(kwargs)
+        if isinstance(self.answer, Exception):
+            raise self.answer
+        return ChatCompletion(
+            object="chat.completion",
+            choices=[
+                Choice(
+                    message=ChatCompletionMessage(role="assistant", content=self.answer), finish_reason="stop", index=0
+                )
+            ],
+            id="test-123",
+            created=0,
+            model="test-model",
+        )
+
+
+class MockOpenAIClient:
+    def __init__(self, completions):
+        self.chat = type("Chat", (), {"completions": completions})()
+
+
+def make_conversation(turns: int) -> Conversation:
+    conversation = Conversation(owner=None)
+    for turn in range(turns):
+        conversation.add_messages(
+            [
+                {"role": "user", "content": f"What is the capital of country {turn}?"},
+                {"role": "assistant", "content": f"The capital of country {turn} is city {turn}. [capitals.pdf]"},
+            ],
+            MODEL,
+        )
+    return conversation
+
+
+async def summarize(summarizer: HistorySummarizer, conversation_id: str, conversation: Conversation):
+    summarizer.maybe_summarize(conversation_id, conversation)
+    await asyncio.gather(*summarizer._tasks.values())
+
+
+@pytest.mark.asyncio
+async def test_summarize():
+    conversation_store = MemoryConversationStore(MODEL, 60, max_bytes=1024 * 1024)
+    completions = MockCompletions()
+    summarizer = HistorySummarizer(MockOpenAIClient(completions), MODEL, "deployment", conversation_store, 50)
+    conversation = make_conversation(4)
+    await conversation_store.put("conversation", conversation)
+
+    await summarize(summarizer, "conversation", conversation)
+    assert completions.calls[0]["model"] == "deployment"
+    assert "user: What is the capital of country 0?" in completions.calls[0]["messages"][1]["content"]
+    assert "country 2" not in completions.calls[0]["messages"][1]["content"]
+
+    summarized = await conversation_store.get("conversation", None)
+    assert summarized.summarized_count == 4
+    assert summarized.summary == HistorySummarizer.SUMMARY_PREFIX + completions.answer
+    assert summarized.summary_token_count > 0
+    # The summary replaces the summarized messages, the newest messages are kept as is
+    assert summarized.get_history() == [
+        {"role": "system", "content": summarized.summary},
+        *conversation.messages[4:],
+    ]
+    assert summarized.get_unsummarized_token_count() == sum(conversation.token_counts[4:])
+
+
+@pytest.mark.asyncio
+async def test_summarize_again():
+    conversation_store = MemoryConversationStore(MODEL, 60, max_bytes=1024 * 1024)
+    completions = MockCompletions()
+    summarizer = HistorySummarizer(MockOpenAIClient(completions), MODEL, None, conversation_store, 50)
+    conversation = make_conversation(4)
+    conversation.summary = HistorySummarizer.SUMMARY_PREFIX + "Earlier summary."
+    conversation.summarized_count = 2
+    await conversation_store.put("conversation", conversation)
+
+    await summarize(summarizer, "conversation", conversation)
+    transcript = completions.calls[0]["messages"][1]["content"]
+    # The earlier summary is summarized with the messages that followed it
+    assert transcript.startswith(conversation.summary)
+    assert "country 0" not in transcript
+    assert "country 1" in transcript
+    assert completions.calls[0]["model"] == MODEL
+    assert (await conversation_store.get("conversation", None)).summarized_count == 4
+
+
+@pytest.mark.asyncio
+async def test_summarize_under_limit():
+    conversation_store = MemoryConversationStore(MODEL, 60, max_bytes=1024 * 1024)
+    completions = MockCompletions()
+    summarizer = HistorySummarizer(MockOpenAIClient(completions), MODEL, None, conversation_store, 1000)
+    conversation = make_conversation(4)
+
+    summarizer.maybe_summarize("conversation", conversation)
+    assert summarizer._tasks == {}
+
+    # There must be older messages than the kept ones to summarize
+    summarizer = HistorySummarizer(MockOpenAIClient(completions), MODEL, None, conversation_store, 10, keep_messages=7)
+    summarizer.maybe_summarize("conversation", conversation)
+    assert summarizer._tasks == {}
+    assert completions.calls == []
+
+
+@pytest.mark.asyncio
+async def test_summarize_changed_conversation():
+    conversation_store = MemoryConversationStore(MODEL, 60, max_bytes=1024 * 1024)
+    summarizer = HistorySummarizer(MockOpenAIClient(MockCompletions()), MODEL, None, conversation_store, 50)
+    conversation = make_conversation(4)
+    # Another worker replaced the conversation while it was summarized
+    await conversation_store.put("conversation", make_conversation(1))
+
+    await summarize(summarizer, "conversation", conversation)
+    assert (await conversation_store.get("conversation", None)).summary is None
+
+
+@pytest.mark.asyncio
+async def test_summarize_error(caplog):
+    conversation_store = MemoryConversationStore(MODEL, 60, max_bytes=1024 * 1024)
+    completions = MockCompletions(answer=ZeroDivisionError("something bad happened"))
+    summarizer = HistorySummarizer(MockOpenAIClient(completions), MODEL, None, conversation_store, 50)
+    conversation = make_conversation(4)
+    await conversation_store.put("conversation", conversation)
+
+    with caplog.at_level(logging.WARNING):
+        await summarize(summarizer, "conversation", conversation)
+    assert "something bad happened" in caplog.text
+    assert (await conversation_store.get("conversation", None)).summary is None
+    assert summarizer._tasks == {}
+    await summarizer.close()
+
+
+@pytest.mark.asyncio
+async def test_summarize_over_model_limit():
+    conversation_store = MemoryConversationStore(MODEL, 60, max_bytes=1024 * 1024)
+    completions = MockCompletions()
+    summarizer = HistorySummarizer(MockOpenAIClient(completions), MODEL, None, conversation_store, 50)
+    conversation = Conversation(owner=None)
+    for turn in range(8):
+        conversation.add_messages(
+            [
+                {"role": "user", "content": f"Question {turn} " + "word " * 600},
+                {"role": "assistant", "content": f"Answer {turn} " + "word " * 600},
+            ],
+            MODEL,
+        )
+    await conversation_store.put("conversation", conversation)
+
+    await summarize(summarizer, "conversation", conversation)
+    # Only the oldest messages that fit in the model with the answer are summarized
+    transcript = completions.calls[0]["messages"][1]["content"]
+    assert (
+        sum(num_tokens_from_messages_batch(completions.calls[0]["messages"], MODEL))
+        <= get_token_limit(MODEL) - summarizer.summary_token_limit
+    )
+    assert "Question 0" in transcript
+    assert "Question 3" not in transcript
+    summarized = await conversation_store.get("conversation", None)
+    assert 0 < summarized.summarized_count < len(conversation.messages) - summarizer.keep_messages
+
+    # The next summary goes on from the messages left out
+    await summarize(summarizer, "conversation", summarized)
+    transcript = completions.calls[1]["messages"][1]["content"]
+    assert transcript.startswith(summarized.summary)
+    assert conversation.messages[summarized.summarized_count]["content"] in transcript
+    assert (await conversation_store.get("conversation", None)).summarized_count > summarized.summarized_count
+
+
+@pytest.mark.asyncio
+async def test_summarize_message_over_model_limit(caplog):
+    conversation_store = MemoryConversationStore(MODEL, 60, max_bytes=1024 * 1024)
+    completions = MockCompletions()
+    summarizer = HistorySummarizer(MockOpenAIClient(completions), MODEL, None, conversation_store, 50)
+    conversation = make_conversation(4)
+    conversation.messages[0] = {"role": "user", "content": "word " * 5000}
+    conversation.token_counts[0] = 5000
+    await conversation_store.put("conversation", conversation)
+
+    with caplog.at_level(logging.WARNING):
+        await summarize(summarizer, "conversation", conversation)
+    assert "doesn't fit in gpt-35-turbo" in caplog.text
+    assert completions.calls == []
+    assert (await conversation_store.get("conversation", None)).summary is None
@@ -0,0 +1,19 @@
+import pytest
+
+from core.httpsessions import HTTPSessionRegistry
+
+
+@pytest.mark.asyncio
+async def test_http_session_registry():
+    registry = HTTPSessionRegistry(limit_per_host=5, keepalive_timeout=10)
+    session = registry.get()
+    assert registry.get() is session
+    assert registry.get("graph") is not session
+    assert session.connector.limit_per_host == 5
+
+    await registry.close()
+    assert session.closed
+    # A closed registry opens new sessions on demand
+    new_session = registry.get()
+    assert new_session is not session
+    await registry.close()
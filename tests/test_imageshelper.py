@@ -0,0 +1,148 @@
+import asyncio
+
+import pytest
+from azure.core.credentials import AzureNamedKeyCredential
+from azure.core.pipeline.transport import AsyncHttpResponse, AsyncHttpTransport
+from azure.storage.blob.aio import ContainerClient
+
+from approaches.approach import Document
+from core.cache import LRUCache
+from core.imageshelper import MAX_CONCURRENT_IMAGE_FETCHES, fetch_images
+
+PNG_BYTES = b"\x89PNG"
+
+
+class MockStreamDownload:
+    def __init__(self, response):
+        self.response = response
+        self.chunks = [response.body()]
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self.chunks:
+            raise StopAsyncIteration
+        return self.chunks.pop()
+
+
+class MockImageResponse(AsyncHttpResponse):
+    def __init__(self, request, status_code, headers, body=b""):
+        super().__init__(request, None)
+        self.status_code = status_code
+        self.headers = headers
+        self.reason = "OK" if status_code == 200 else "Not Modified"
+        self.content_type = headers.get("Content-Type")
+        self._body = body
+
+    def body(self):
+        return self._body
+
+    async def load_body(self):
+        pass
+
+    def stream_download(self, pipeline, **kwargs):
+        return MockStreamDownload(self)
+
+
+class MockImageTransport(AsyncHttpTransport):
+    """
+    Answers blob downloads like Azure Storage, including the 304 of a conditional download of an unchanged blob.
+    """
+
+    def __init__(self):
+        self.etag = '"0x1"'
+        self.downloads = []
+        self.active = 0
+        self.max_active = 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def send(self, request, **kwargs):
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        await asyncio.sleep(0.01)
+        self.active -= 1
+        self.downloads.append(request.url.split("/")[-1])
+        if request.headers.get("If-None-Match") == self.etag:
+            return MockImageResponse(request, 304, {"ETag": self.etag, "x-ms-error-code": "ConditionNotMet"})
+        headers = {
+            "Content-Type": "image/png",
+            "Content-Length": str(len(PNG_BYTES)),
+            "Content-Range": f"bytes 0-{len(PNG_BYTES) - 1}/{len(PNG_BYTES)}",
+            "ETag": self.etag,
+            "Last-Modified": "Mon, 01 Jan 2024 00:00:00 GMT",
+            "x-ms-blob-type": "BlockBlob",
+        }
+        return MockImageResponse(request, 200, headers, PNG_BYTES)
+
+
+def make_container_client(transport):
+    return ContainerClient(
+        "https://test.blob.core.windows.net",
+        "test-container",
+        credential=AzureNamedKeyCredential("test", "a2V5"),
+        transport=transport,
+    )
+
+
+def make_document(sourcepage):
+    return Document(
+        id=None,
+        content=None,
+        embedding=None,
+        image_embedding=None,
+        category=None,
+        sourcepage=sourcepage,
+        sourcefile=None,
+        oids=None,
+        groups=None,
+        captions=[],
+    )
+
+
+@pytest.mark.asyncio
+async def test_fetch_images_concurrently():
+    transport = MockImageTransport()
+    container_client = make_container_client(transport)
+    results = [make_document(f"report-{page}.png") for page in range(8)] + [make_document("report-0.png")]
+
+    images = await fetch_images(container_client, results)
+    assert len(images) == 9
+    assert images[0] == images[8] == {"url": "data:image/png;base64,iVBORw==", "detail": "auto"}
+    # Results citing the same page share a download
+    assert sorted(transport.downloads) == sorted(f"report-{page}.png" for page in range(8))
+    assert transport.max_active == MAX_CONCURRENT_IMAGE_FETCHES
+    await container_client.close()
+
+
+@pytest.mark.asyncio
+async def test_fetch_images_cached():
+    transport = MockImageTransport()
+    container_client = make_container_client(transport)
+    image_cache: LRUCache[tuple[str, str]] = LRUCache(max_weight=1024)
+    results = [make_document("report-1.png")]
+
+    first = await fetch_images(container_client, results, image_cache)
+    assert image_cache.get("report-1.png") == ('"0x1"', first[0]["url"])
+
+    # The cached image is revalidated against the ETag, and reused while it didn't change
+    assert await fetch_images(container_client, results, image_cache) == first
+    assert image_cache.hits == 2
+
+    assert transport.downloads == ["report-1.png"] * 2
+
+    transport.etag = '"0x2"'
+    assert await fetch_images(container_client, results, image_cache) == first
+    assert image_cache.get("report-1.png")[0] == '"0x2"'
+    await container_client.close()
@@ -0,0 +1,44 @@
+import json
+from datetime import datetime, timezone
+
+import pytest
+from quart import Quart
+from quart.json.provider import DefaultJSONProvider
+
+from approaches.approach import ThoughtStep
+from core.jsonprovider import OrjsonProvider
+
+PAYLOAD = {
+    "choices": [
+        {
+            "message": {"content": "Paris est la capitale de la France. [Benefit_Options-2.pdf]", "role": "assistant"},
+            "context": {
+                "data_points": {"text": ["Benefit_Options-2.pdf: Café"]},
+                "thoughts": [
+                    ThoughtStep("Original user query", "Quelle est la capitale de la France?"),
+                    ThoughtStep("Generated search query", "capitale France", {"has_vector": True, "top": 3}),
+                ],
+            },
+            "index": 0,
+        }
+    ],
+    "created": datetime(2024, 1, 1, tzinfo=timezone.utc),
+    "usage": {"total_tokens": 2**70},
+}
+
+
+@pytest.mark.asyncio
+async def test_orjson_provider_matches_default():
+    app = Quart(__name__)
+    default_provider = DefaultJSONProvider(app)
+    orjson_provider = OrjsonProvider(app)
+
+    # Same values and same key order, including the fields of dataclasses
+    expected = json.dumps(json.loads(default_provider.dumps(PAYLOAD)))
+    assert json.dumps(json.loads(orjson_provider.dumps(PAYLOAD))) == expected
+    async with app.app_context():
+        response = orjson_provider.response(PAYLOAD)
+        assert response.mimetype == "application/json"
+        body = await response.get_data()
+    assert body.endswith(b"\n")
+    assert json.dumps(json.loads(body)) == expected
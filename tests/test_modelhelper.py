@@ -1,9 +1,11 @@
 import pytest
 
 from core.modelhelper import (
+    TokenCounter,
     get_oai_chatmodel_tiktok,
     get_token_limit,
     num_tokens_from_messages,
+    num_tokens_from_messages_batch,
 )
 
 
@@ -59,3 +61,23 @@ def test_get_oai_chatmodel_tiktok_error():
         get_oai_chatmodel_tiktok(None)
     with pytest.raises(ValueError, match="Expected Azure OpenAI ChatGPT model name"):
         get_oai_chatmodel_tiktok("gpt-3")
+
+
+def test_token_counter_memoizes_counts():
+    token_counter = TokenCounter()
+    assert token_counter.count_texts(["Hello, how are you?", "user"], "gpt-35-turbo") == [6, 1]
+    assert token_counter.counts.misses == 2
+    assert token_counter.count_texts(["Hello, how are you?", "Fine, thanks"], "gpt-35-turbo") == [6, 3]
+    assert token_counter.counts.hits == 1
+    assert token_counter.counts.misses == 3
+
+
+def test_num_tokens_from_messages_batch():
+    messages = [
+        {"role": "user", "content": "Hello, how are you?"},
+        {"role": "assistant", "content": "Fine, thanks"},
+        {"role": "user", "content": [{"type": "text", "text": "Describe this"}, "raw text"]},
+    ] * 10
+    counts = num_tokens_from_messages_batch(messages, "gpt-35-turbo")
+    assert counts == [num_tokens_from_messages(message, "gpt-35-turbo") for message in messages]
+    assert counts[:3] == [9, 6, 5]
@@ -0,0 +1,41 @@
+import pytest
+
+from core.queryhelper import is_self_contained, query_similarity, query_terms
+
+
+def test_query_terms():
+    assert query_terms("What is the deductible for Northwind Standard?") == {"deductible", "northwind", "standard"}
+    # A question made only of stop words keeps all of its words
+    assert query_terms("What is it?") == {"what", "is", "it"}
+    assert query_terms("") == set()
+
+
+@pytest.mark.parametrize(
+    "query,other_query,similarity",
+    [
+        ("capital of France", "What is the capital of France?", 1.0),
+        ("Northwind Standard deductible", "What is the deductible for Northwind Standard?", 1.0),
+        ("Northwind Plus vision coverage", "Does my plan cover eye exams?", 0.0),
+        ("interest rates 2023", "Are interest rates high?", 0.5),
+        ("", "", 1.0),
+    ],
+)
+def test_query_similarity(query, other_query, similarity):
+    assert query_similarity(query, other_query) == similarity
+
+
+@pytest.mark.parametrize(
+    "question,self_contained",
+    [
+        ("What is the deductible for Northwind Standard?", True),
+        ("Does Northwind Health Plus cover eye exams?", True),
+        ("Does it cover eye exams?", False),
+        ("What about dental?", False),
+        ("And for Northwind Standard?", False),
+        ("Is that plan cheaper?", False),
+        ("Why?", False),
+        ("What is covered?", False),
+    ],
+)
+def test_is_self_contained(question, self_contained):
+    assert is_self_contained(question) is self_contained
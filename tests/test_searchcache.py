@@ -0,0 +1,135 @@
+import pytest
+from azure.search.documents.models import RawVectorQuery
+
+from approaches.retrievethenread import RetrieveThenReadApproach
+from core.searchcache import SearchCache, vector_fingerprint
+
+from .mocks import MockAsyncSearchResultsIterator
+
+
+class MockSearchClient:
+    def __init__(self):
+        self.calls = 0
+        self.selects = []
+
+    async def search(self, search_text, vector_queries=None, **kwargs):
+        self.calls += 1
+        self.selects.append(kwargs.get("select"))
+        return MockAsyncSearchResultsIterator(search_text, vector_queries)
+
+
+@pytest.fixture
+def search_client():
+    return MockSearchClient()
+
+
+@pytest.fixture
+def search_cache():
+    return SearchCache(
+        max_bytes=1024 * 1024,
+        ttl=60,
+        weigh=lambda documents: sum(document.approximate_size() for document in documents),
+    )
+
+
+@pytest.fixture
+def ask_approach(search_client, search_cache):
+    return RetrieveThenReadApproach(
+        search_client=search_client,
+        openai_client=None,
+        auth_helper=None,
+        chatgpt_model="gpt-35-turbo",
+        chatgpt_deployment="chat",
+        embedding_model="text-embedding-ada-002",
+        embedding_deployment="embeddings",
+        sourcepage_field="sourcepage",
+        content_field="content",
+        query_language="en-us",
+        query_speller="lexicon",
+        search_cache=search_cache,
+    )
+
+
+def test_vector_fingerprint():
+    vector = RawVectorQuery(vector=[0.1, 0.2, 0.3], k=50, fields="embedding")
+    assert vector_fingerprint([vector]) == vector_fingerprint(
+        [RawVectorQuery(vector=[0.1, 0.2, 0.3], k=50, fields="embedding")]
+    )
+    assert vector_fingerprint([vector]) != vector_fingerprint(
+        [RawVectorQuery(vector=[0.1, 0.2, 0.3], k=10, fields="embedding")]
+    )
+    assert vector_fingerprint([vector]) != vector_fingerprint(
+        [RawVectorQuery(vector=[0.1, 0.2, 0.4], k=50, fields="embedding")]
+    )
+    assert vector_fingerprint([]) != vector_fingerprint([vector])
+
+
+@pytest.mark.asyncio
+async def test_search_cached(ask_approach, search_client, search_cache):
+    vectors = [RawVectorQuery(vector=[0.1, 0.2, 0.3], k=50, fields="embedding")]
+    first = await ask_approach.search(3, "whistleblower", None, vectors, True, True)
+    second = await ask_approach.search(3, "whistleblower", None, vectors, True, True)
+    assert search_client.calls == 1
+    assert first == second
+    assert first is not second
+    assert first[0].content == "There is a whistleblower policy."
+
+    # Any other search option is a different search
+    await ask_approach.search(3, "whistleblower", "category ne 'x'", vectors, True, True)
+    await ask_approach.search(5, "whistleblower", None, vectors, True, True)
+    await ask_approach.search(3, "whistleblower", None, vectors, False, False)
+    await ask_approach.search(3, "whistleblower", None, [], True, True)
+    assert search_client.calls == 5
+    assert search_cache.stats()["hits"] == 1
+
+
+@pytest.mark.asyncio
+async def test_search_project_fields(ask_approach, search_client, search_cache):
+    await ask_approach.search(3, "whistleblower", None, [], True, True)
+    ask_approach.project_search_fields = True
+    await ask_approach.search(3, "whistleblower", None, [], True, True)
+    results = await ask_approach.search(3, "whistleblower", None, [], True, False)
+    assert search_client.selects == [
+        None,
+        ["sourcepage", "sourcefile", "category"],
+        ["sourcepage", "sourcefile", "category", "content"],
+    ]
+    assert not hasattr(results[0], "__dict__")
+
+
+@pytest.mark.asyncio
+async def test_search_cache_generation(ask_approach, search_client, search_cache):
+    generation = "1"
+
+    async def load_generation():
+        return generation
+
+    search_cache.load_generation = load_generation
+    search_cache.generation_check_interval = 0
+
+    await ask_approach.search(3, "whistleblower", None, [], True, True)
+    await ask_approach.search(3, "whistleblower", None, [], True, True)
+    assert search_client.calls == 1
+
+    # Ingestion bumped the generation, so the cached results are dropped
+    generation = "2"
+    await ask_approach.search(3, "whistleblower", None, [], True, True)
+    assert search_client.calls == 2
+    assert search_cache.generation == "2"
+
+    search_cache.bump_generation()
+    await ask_approach.search(3, "whistleblower", None, [], True, True)
+    assert search_client.calls == 3
+
+
+@pytest.mark.asyncio
+async def test_search_cache_generation_error(ask_approach, search_client, search_cache):
+    async def load_generation():
+        raise ConnectionError("storage is unavailable")
+
+    search_cache.load_generation = load_generation
+    search_cache.generation_check_interval = 0
+
+    await ask_approach.search(3, "whistleblower", None, [], True, True)
+    await ask_approach.search(3, "whistleblower", None, [], True, True)
+    assert search_client.calls == 1
@@ -0,0 +1,138 @@
+import asyncio
+
+import pytest
+
+from core.singleflight import RequestCoalescer
+
+
+@pytest.mark.asyncio
+async def test_run_shares_result():
+    coalescer = RequestCoalescer()
+    calls = 0
+    release = asyncio.Event()
+
+    async def call():
+        nonlocal calls
+        calls += 1
+        await release.wait()
+        return {"choices": [{"message": {"content": "answer"}, "session_state": None}]}
+
+    leader = asyncio.create_task(coalescer.run("key", call, session_state="leader"))
+    follower = asyncio.create_task(coalescer.run("key", call, session_state="follower"))
+    other = asyncio.create_task(coalescer.run("other key", call))
+    await asyncio.sleep(0)
+    release.set()
+    leader_result, follower_result, _ = await asyncio.gather(leader, follower, other)
+
+    assert calls == 2
+    assert leader_result["choices"][0]["session_state"] == "leader"
+    assert follower_result["choices"][0]["session_state"] == "follower"
+    assert follower_result["choices"][0]["message"] is leader_result["choices"][0]["message"]
+    assert coalescer.stats() == {"leaders": 2, "followers": 1, "in_flight": 0}
+
+    # Once complete, the same request runs again
+    await coalescer.run("key", call)
+    assert calls == 3
+
+
+@pytest.mark.asyncio
+async def test_run_error_is_shared_and_not_kept():
+    coalescer = RequestCoalescer()
+
+    async def fail():
+        await asyncio.sleep(0)
+        raise ValueError("boom")
+
+    results = await asyncio.gather(coalescer.run("key", fail), coalescer.run("key", fail), return_exceptions=True)
+    assert [type(result) for result in results] == [ValueError, ValueError]
+    assert coalescer.stats()["in_flight"] == 0
+
+
+def make_stream(chunks: list[str], release: asyncio.Event, opened: list):
+    async def generate():
+        yield {"choices": [{"delta": {"role": "assistant"}, "context": {}, "session_state": None}]}
+        for chunk in chunks:
+            await release.wait()
+            yield {"choices": [{"delta": {"content": chunk}}]}
+
+    async def open_stream():
+        opened.append(True)
+        return generate()
+
+    return open_stream
+
+
+@pytest.mark.asyncio
+async def test_stream_fans_out_chunks():
+    coalescer = RequestCoalescer()
+    release = asyncio.Event()
+    opened: list = []
+    open_stream = make_stream(["The", " answer"], release, opened)
+
+    async def collect(session_state):
+        return [event async for event in coalescer.stream("key", open_stream, session_state)]
+
+    leader = asyncio.create_task(collect("leader"))
+    await asyncio.sleep(0.01)
+    # The follower joins after the first chunk was sent, and replays it
+    follower = asyncio.create_task(collect("follower"))
+    await asyncio.sleep(0)
+    release.set()
+    leader_events, follower_events = await asyncio.gather(leader, follower)
+
+    assert len(opened) == 1
+    assert leader_events[0]["choices"][0]["session_state"] == "leader"
+    assert follower_events[0]["choices"][0]["session_state"] == "follower"
+    assert leader_events[1:] == follower_events[1:]
+    assert [event["choices"][0]["delta"]["content"] for event in follower_events[1:]] == ["The", " answer"]
+    assert coalescer.stats() == {"leaders": 1, "followers": 1, "in_flight": 0}
+
+
+@pytest.mark.asyncio
+async def test_stream_cancelled_when_all_subscribers_leave():
+    coalescer = RequestCoalescer()
+    release = asyncio.Event()
+    opened: list = []
+    stream = coalescer.stream("key", make_stream(["The"], release, opened), None)
+
+    first_event = await stream.__anext__()
+    assert first_event["choices"][0]["delta"] == {"role": "assistant"}
+    await stream.aclose()
+    await asyncio.sleep(0)
+    assert coalescer.stats()["in_flight"] == 0
+
+
+@pytest.mark.asyncio
+async def test_stream_not_joined_while_cancelled():
+    coalescer = RequestCoalescer()
+    release = asyncio.Event()
+    opened: list = []
+    open_stream = make_stream(["The"], release, opened)
+    stream = coalescer.stream("key", open_stream, None)
+    # This follower attached before the last subscriber left, but only starts reading afterwards
+    late_follower = coalescer.stream("key", open_stream, None)
+
+    await stream.__anext__()
+    await stream.aclose()
+    # A new caller starts its own stream instead of joining the cancelled one
+    assert coalescer.stats()["in_flight"] == 0
+    new_stream = coalescer.stream("key", open_stream, None)
+    await new_stream.__anext__()
+    assert len(opened) == 2
+    await new_stream.aclose()
+
+    with pytest.raises(RuntimeError):
+        async for _ in late_follower:
+            pass
+
+
+@pytest.mark.asyncio
+async def test_stream_error_reaches_subscribers():
+    coalescer = RequestCoalescer()
+
+    async def open_stream():
+        raise ValueError("boom")
+
+    with pytest.raises(ValueError):
+        async for _ in coalescer.stream("key", open_stream):
+            pass
@@ -0,0 +1,43 @@
+from core.sourcededuper import deduplicate_sources, merge_overlapping, shingles
+
+
+def test_shingles():
+    assert shingles("One two three four five six.") == shingles("one  two, three four five SIX")
+    assert len(shingles("One two three four five six")) == 2
+    assert len(shingles("Too short")) == 1
+
+
+def test_merge_overlapping():
+    first = "Overlake is in-network. Deductibles are $500 for employees and $1000 for families."
+    second = "Deductibles are $500 for employees and $1000 for families. Out-of-network deductibles are higher."
+    merged = "Overlake is in-network. Deductibles are $500 for employees and $1000 for families. Out-of-network deductibles are higher."
+    assert merge_overlapping(first, second, 20) == merged
+    # In either order
+    assert merge_overlapping(second, first, 20) == merged
+    assert merge_overlapping(merged, second, 20) == merged
+    assert merge_overlapping(first, "Out-of-network deductibles are higher.", 20) is None
+    # Too short an overlap is not enough
+    assert merge_overlapping("It is covered.", "covered. It is not.", 20) is None
+
+
+def test_deduplicate_sources():
+    sources = [
+        "Benefit_Options-2.pdf: Overlake is in-network. Deductibles are $500 for employees and $1000 for families.",
+        "Northwind_Standard-3.pdf: The plan covers preventive care, including vaccines and screenings every year.",
+        "Benefit_Options-2.pdf: Deductibles are $500 for employees and $1000 for families. Out-of-network deductibles are higher.",
+        "Northwind_Plus-3.pdf: The plan covers preventive care, including vaccines and screenings every year!",
+        "Northwind_Plus-4.pdf: The plan covers preventive care, including vaccines and screenings.",
+        "Benefit_Options-3.pdf: Deductibles are $500 for employees and $1000 for families. Out-of-network deductibles are higher.",
+    ]
+    assert deduplicate_sources(sources) == [
+        "Benefit_Options-2.pdf: Overlake is in-network. Deductibles are $500 for employees and $1000 for families. Out-of-network deductibles are higher.",
+        "Northwind_Standard-3.pdf: The plan covers preventive care, including vaccines and screenings every year.",
+    ]
+
+
+def test_deduplicate_sources_distinct():
+    sources = [
+        "Benefit_Options-2.pdf: Overlake is in-network.",
+        "Benefit_Options-3.pdf: Deductibles are $500 for employees.",
+    ]
+    assert deduplicate_sources(sources) == sources
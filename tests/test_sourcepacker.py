@@ -0,0 +1,49 @@
+from core.modelhelper import get_encoding
+from core.sourcepacker import pack_sources, truncate_at_sentence
+
+MODEL = "gpt-35-turbo"
+
+
+def count(text: str) -> int:
+    return len(get_encoding(MODEL).encode(text))
+
+
+def test_truncate_at_sentence():
+    text = "First sentence. Second sentence! Third sentence? Fourth sentence."
+    assert truncate_at_sentence(text, 100, MODEL) == text
+    assert truncate_at_sentence(text, count("First sentence. Second sentence! Third"), MODEL) == (
+        "First sentence. Second sentence!"
+    )
+    assert truncate_at_sentence(text, count("First sentence."), MODEL) == "First sentence."
+    assert truncate_at_sentence(text, count("First sentence"), MODEL) == ""
+    assert truncate_at_sentence(text, 0, MODEL) == ""
+
+
+def test_truncate_at_sentence_min_length():
+    # A full stop inside a citation is not the end of a sentence
+    assert truncate_at_sentence("Benefit_Options.pdf: No sentence ends here", 8, MODEL, min_length=21) == ""
+    assert truncate_at_sentence("info1.txt: First. Second", 6, MODEL, min_length=11) == "info1.txt: First."
+
+
+def test_pack_sources_fit():
+    sources = ["info1.txt: In-network deductibles are $500.", "info2.pdf: Overlake is in-network."]
+    assert pack_sources(sources, 1000, MODEL) == sources
+
+
+def test_pack_sources_truncated():
+    long_source = "info1.txt: " + " ".join(f"Sentence number {i} is here." for i in range(100))
+    short_source = "info2.pdf: Overlake is in-network."
+    budget = count(short_source) + 1 + 40
+    packed = pack_sources([short_source, long_source], budget, MODEL)
+    assert packed[0] == short_source
+    assert long_source.startswith(packed[1])
+    assert packed[1].endswith(".")
+    assert count("\n".join(packed)) <= budget
+
+
+def test_pack_sources_skips_too_long():
+    # A source without a sentence that fits is left out, and the next ones are still added if they fit
+    long_source = "info1.txt: " + "word " * 200
+    short_source = "info2.pdf: Overlake is in-network."
+    assert pack_sources([long_source, short_source], count(short_source) + 5, MODEL) == [short_source]
+    assert pack_sources([long_source, short_source], 0, MODEL) == []
@@ -0,0 +1,28 @@
+import time
+
+import pytest
+
+from core.sqlitetable import SQLiteTable
+
+
+@pytest.mark.asyncio
+async def test_read_write(tmp_path):
+    table = SQLiteTable(str(tmp_path / "items.sqlite3"), "items", "id TEXT PRIMARY KEY, expires_at REAL NOT NULL")
+    await table.write(lambda connection: connection.execute("INSERT INTO items VALUES (?, ?)", ("a", time.time() + 60)))
+
+    assert await table.read(lambda connection: connection.execute("SELECT id FROM items").fetchall()) == [("a",)]
+    await table.close()
+
+
+@pytest.mark.asyncio
+async def test_purge(tmp_path, monkeypatch):
+    monkeypatch.setattr(SQLiteTable, "PURGE_INTERVAL", 2)
+    table = SQLiteTable(str(tmp_path / "items.sqlite3"), "items", "id TEXT PRIMARY KEY, expires_at REAL NOT NULL")
+    await table.write(lambda connection: connection.execute("INSERT INTO items VALUES (?, ?)", ("a", time.time() - 1)))
+    count = await table.read(lambda connection: connection.execute("SELECT COUNT(*) FROM items").fetchone()[0])
+    assert count == 1
+
+    # Expired rows are deleted on every second write
+    await table.write(lambda connection: connection.execute("INSERT INTO items VALUES (?, ?)", ("b", time.time() + 60)))
+    assert await table.read(lambda connection: connection.execute("SELECT id FROM items").fetchall()) == [("b",)]
+    await table.close()
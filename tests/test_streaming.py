@@ -0,0 +1,185 @@
+import asyncio
+import json
+from typing import List, Optional
+
+import pytest
+from openai.types.chat import ChatCompletionChunk
+from openai.types.chat.chat_completion_chunk import Choice
+from pydantic import BaseModel
+
+from core.streaming import (
+    CAN_PROJECT_CHUNKS,
+    CHOICE_FIELDS,
+    ChunkCoalescer,
+    chunk_to_dict,
+    has_fields,
+)
+
+
+@pytest.mark.parametrize(
+    "chunk",
+    [
+        {"id": "test-id", "object": "chat.completion.chunk", "created": 1, "model": "gpt-35-turbo", "choices": []},
+        {
+            "id": "test-id",
+            "object": "chat.completion.chunk",
+            "created": 1,
+            "model": "gpt-35-turbo",
+            "choices": [{"delta": {"role": "assistant"}, "index": 0, "finish_reason": None}],
+        },
+        {
+            "id": "test-id",
+            "object": "chat.completion.chunk",
+            "created": 1,
+            "model": "gpt-35-turbo",
+            "choices": [{"delta": {"content": "Paris"}, "index": 0, "finish_reason": None}],
+        },
+        {
+            "id": "test-id",
+            "object": "chat.completion.chunk",
+            "created": 1,
+            "model": "gpt-35-turbo",
+            "choices": [{"delta": {"content": None}, "index": 0, "finish_reason": "stop"}],
+        },
+        # Azure OpenAI adds content filter results to the chunks
+        {
+            "id": "test-id",
+            "object": "chat.completion.chunk",
+            "created": 1,
+            "model": "gpt-35-turbo",
+            "prompt_filter_results": [
+                {"prompt_index": 0, "content_filter_results": {"hate": {"filtered": False, "severity": "safe"}}}
+            ],
+            "choices": [
+                {
+                    "delta": {"content": "Paris"},
+                    "index": 0,
+                    "finish_reason": None,
+                    "content_filter_results": {"hate": {"filtered": False, "severity": "safe"}},
+                }
+            ],
+        },
+        {
+            "id": "test-id",
+            "object": "chat.completion.chunk",
+            "created": 1,
+            "model": "gpt-35-turbo",
+            "choices": [
+                {
+                    "delta": {"function_call": {"name": "search_sources", "arguments": "{"}},
+                    "index": 0,
+                    "finish_reason": None,
+                }
+            ],
+        },
+    ],
+)
+def test_chunk_to_dict(chunk):
+    assert CAN_PROJECT_CHUNKS
+    event_chunk = ChatCompletionChunk.model_validate(chunk)
+    # The events must serialize exactly like model_dump, so that the streamed responses don't change
+    assert json.dumps(chunk_to_dict(event_chunk)) == json.dumps(event_chunk.model_dump())
+
+
+class TokenLogprob(BaseModel):
+    token: str
+    logprob: float
+
+
+class NewerChoice(Choice):
+    logprobs: Optional[List[TokenLogprob]] = None
+
+
+class NewerChatCompletionChunk(ChatCompletionChunk):
+    choices: List[NewerChoice]
+    usage: Optional[dict] = None
+
+
+def test_chunk_to_dict_newer_sdk():
+    # Fields added by newer versions of the SDK are kept, in the same order as model_dump
+    assert not has_fields(NewerChoice, CHOICE_FIELDS)
+    event_chunk = NewerChatCompletionChunk.model_validate(
+        {
+            "id": "test-id",
+            "object": "chat.completion.chunk",
+            "created": 1,
+            "model": "gpt-35-turbo",
+            "choices": [
+                {
+                    "delta": {"content": "Paris"},
+                    "index": 0,
+                    "finish_reason": None,
+                    "logprobs": [{"token": "Paris", "logprob": -0.1}],
+                }
+            ],
+            "usage": None,
+        }
+    )
+    assert json.dumps(chunk_to_dict(event_chunk)) == json.dumps(event_chunk.model_dump())
+    assert chunk_to_dict(event_chunk)["choices"][0]["logprobs"] == [{"token": "Paris", "logprob": -0.1}]
+
+
+def content_event(content):
+    return {"choices": [{"delta": {"content": content}, "finish_reason": None, "index": 0}], "object": "chunk"}
+
+
+async def stream_events(events, delays=None):
+    for index, event in enumerate(events):
+        if delays:
+            await asyncio.sleep(delays[index])
+        if isinstance(event, Exception):
+            raise event
+        yield event
+
+
+async def coalesce(coalescer, events, delays=None):
+    return [event async for event in coalescer.coalesce(stream_events(events, delays))]
+
+
+@pytest.mark.asyncio
+async def test_coalesce_by_size():
+    context_event = {"choices": [{"delta": {"role": "assistant"}, "context": {}, "finish_reason": None, "index": 0}]}
+    followup_event = {"choices": [{"delta": {"role": "assistant"}, "context": {"followup_questions": ["Why?"]}}]}
+    events = [
+        context_event,
+        content_event(""),
+        content_event("The"),
+        content_event(" capital"),
+        content_event(" of"),
+        content_event(" France"),
+        content_event(" is"),
+        followup_event,
+        content_event(" Paris."),
+    ]
+    coalesced = await coalesce(ChunkCoalescer(max_chars=10, max_delay=10), events)
+    assert coalesced == [
+        context_event,
+        content_event(""),
+        # The first token is sent right away
+        content_event("The"),
+        content_event(" capital of"),
+        # Other events are sent immediately, after the buffered text
+        content_event(" France is"),
+        followup_event,
+        content_event(" Paris."),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_coalesce_by_delay():
+    events = [content_event("The"), content_event(" capital"), content_event(" of"), content_event(" France")]
+    coalesced = await coalesce(ChunkCoalescer(max_chars=1000, max_delay=0.05), events, delays=[0, 0, 0, 0.2])
+    # The buffered text is sent once the delay has passed, without waiting for the next token
+    assert coalesced == [content_event("The"), content_event(" capital of"), content_event(" France")]
+
+
+@pytest.mark.asyncio
+async def test_coalesce_error():
+    events = [content_event("The"), content_event(" capital"), content_event(" of"), ValueError("Stream failed")]
+    coalescer = ChunkCoalescer(max_chars=1000, max_delay=10)
+    coalesced = []
+    with pytest.raises(ValueError, match="Stream failed"):
+        async for event in coalescer.coalesce(stream_events(events)):
+            coalesced.append(event)
+    # The buffered text is sent before the error
+    assert coalesced == [content_event("The"), content_event(" capital of")]
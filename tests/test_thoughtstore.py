@@ -0,0 +1,94 @@
+import sqlite3
+
+import pytest
+
+from approaches.approach import ThoughtStep
+from core.sqlitetable import SQLiteTable
+from core.thoughtstore import ThoughtStore
+
+
+@pytest.mark.asyncio
+async def test_make_lean(tmp_path):
+    store = ThoughtStore(str(tmp_path / "thoughts.sqlite3"))
+    thoughts = [
+        ThoughtStep("Original user query", "What is the deductible?"),
+        ThoughtStep("Results", [{"sourcepage": "Benefit_Options-2.pdf"}], {"count": 1}),
+        ThoughtStep("Prompt", ["system prompt", "user message"]),
+    ]
+    lean_thoughts = await store.make_lean(thoughts, "OID_X")
+
+    assert lean_thoughts[0] is thoughts[0]
+    assert lean_thoughts[1].description is None
+    assert lean_thoughts[1].props["count"] == 1
+    assert lean_thoughts[2].description is None
+    # The original thoughts are left untouched
+    assert thoughts[1].description == [{"sourcepage": "Benefit_Options-2.pdf"}]
+    assert await store.get(lean_thoughts[1].props["thought_id"], "OID_X") == [{"sourcepage": "Benefit_Options-2.pdf"}]
+    assert await store.get(lean_thoughts[2].props["thought_id"], "OID_X") == ["system prompt", "user message"]
+    await store.close()
+
+
+@pytest.mark.asyncio
+async def test_get_other_owner(tmp_path):
+    store = ThoughtStore(str(tmp_path / "thoughts.sqlite3"))
+    lean_thoughts = await store.make_lean([ThoughtStep("Prompt", ["user message"])], "OID_X")
+    thought_id = lean_thoughts[0].props["thought_id"]
+
+    assert await store.get(thought_id, "OID_Y") is None
+    assert await store.get(thought_id, None) is None
+    await store.close()
+
+
+@pytest.mark.asyncio
+async def test_get_without_owner(tmp_path):
+    store = ThoughtStore(str(tmp_path / "thoughts.sqlite3"))
+    lean_thoughts = await store.make_lean([ThoughtStep("Prompt", ["user message"])], None)
+
+    assert await store.get(lean_thoughts[0].props["thought_id"], None) == ["user message"]
+    assert await store.get("unknown", None) is None
+    await store.close()
+
+
+@pytest.mark.asyncio
+async def test_get_expired(tmp_path):
+    store = ThoughtStore(str(tmp_path / "thoughts.sqlite3"), ttl=-1)
+    lean_thoughts = await store.make_lean([ThoughtStep("Prompt", ["user message"])], None)
+
+    assert await store.get(lean_thoughts[0].props["thought_id"], None) is None
+    await store.close()
+
+
+@pytest.mark.asyncio
+async def test_shared_between_stores(tmp_path):
+    # Each worker process has its own store on the same database
+    store = ThoughtStore(str(tmp_path / "thoughts.sqlite3"))
+    other_store = ThoughtStore(str(tmp_path / "thoughts.sqlite3"))
+    lean_thoughts = await store.make_lean([ThoughtStep("Prompt", ["user message"])], None)
+
+    assert await other_store.get(lean_thoughts[0].props["thought_id"], None) == ["user message"]
+    await store.close()
+    await other_store.close()
+
+
+@pytest.mark.asyncio
+async def test_purge(tmp_path, monkeypatch):
+    monkeypatch.setattr(SQLiteTable, "PURGE_INTERVAL", 2)
+    store = ThoughtStore(str(tmp_path / "thoughts.sqlite3"), ttl=-1)
+    await store.make_lean([ThoughtStep("Prompt", ["first"])], None)
+    await store.make_lean([ThoughtStep("Prompt", ["second"])], None)
+
+    await store.close()
+    with sqlite3.connect(tmp_path / "thoughts.sqlite3") as connection:
+        assert connection.execute("SELECT COUNT(*) FROM thoughts").fetchone()[0] == 0
+
+
+@pytest.mark.asyncio
+async def test_stored_as_json(tmp_path):
+    store = ThoughtStore(str(tmp_path / "thoughts.sqlite3"))
+    await store.make_lean([ThoughtStep("Results", [{"sourcepage": "Benefit_Options-2.pdf"}])], None)
+
+    await store.close()
+    with sqlite3.connect(tmp_path / "thoughts.sqlite3") as connection:
+        assert connection.execute("SELECT description FROM thoughts").fetchone()[0] == (
+            '[{"sourcepage": "Benefit_Options-2.pdf"}]'
+        )